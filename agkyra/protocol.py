@@ -27,7 +27,7 @@ import logging
 import subprocess
 from agkyra.syncer import (
     syncer, setup, pithos_client, localfs_client, messaging, utils, database,
-    common)
+    common, transfer)
 from agkyra.config import AgkyraConfig, AGKYRA_DIR
 
 if getattr(sys, 'frozen', False):
@@ -234,7 +234,10 @@ class WebSocketProtocol(WebSocket):
             "directory": <local directory>,
             "exclude": <file path>,
             "language": <en|el>,
-            "ask_to_sync": <true|false>
+            "ask_to_sync": <true|false>,
+            "upload_limit": <bytes per second, e.g. 512K, empty for none>,
+            "download_limit": <bytes per second, e.g. 2M, empty for none>,
+            "bandwidth_schedule": <e.g. "08:00-18:00 512K/2M, ...">
         } or {<ERROR>: <ERROR CODE>}
 
     -- PUT SETTINGS --
@@ -246,10 +249,14 @@ class WebSocketProtocol(WebSocket):
             "directory": <local directory>,
             "exclude": <file path>,
             "language": <en|el>,
-            "ask_to_sync": <true|false>
+            "ask_to_sync": <true|false>,
+            "upload_limit": <bytes per second, e.g. 512K, empty for none>,
+            "download_limit": <bytes per second, e.g. 2M, empty for none>,
+            "bandwidth_schedule": <e.g. "08:00-18:00 512K/2M, ...">
         }
     HELPER: {"CREATED": 201, "action": "put settings",} or
         {<ERROR>: <ERROR CODE>, "action": "get settings",}
+    Bandwidth limits are applied to a running syncer without restarting it.
 
     -- GET STATUS --
     GUI: {"method": "get", "path": "status"}
@@ -257,6 +264,13 @@ class WebSocketProtocol(WebSocket):
             "synced": <int>, "unsynced": <int>, "failed": <int>,
             "action": "get status"
         } or {<ERROR>: <ERROR CODE>, "action": "get status"}
+
+    -- GET METRICS --
+    GUI: {"method": "get", "path": "metrics"}
+    HELPER: {"counters": {<name>: <int>, ...},
+            "connections": [<HTTP connection pool stats>, ...],
+            "action": "get metrics"
+        } or {<ERROR>: <ERROR CODE>, "action": "get metrics"}
     """
     status = utils.ThreadSafeDict()
     with status.lock() as d:
@@ -268,9 +282,12 @@ class WebSocketProtocol(WebSocket):
     settings = dict(
         token=None, url=None,
         container=None, directory=None,
-        exclude=None, ask_to_sync=True, language="en")
+        exclude=None, ask_to_sync=True, language="en",
+        upload_limit='', download_limit='', bandwidth_schedule='')
     cnf = AgkyraConfig()
     essentials = ('url', 'token', 'container', 'directory')
+    bandwidth_options = (
+        'upload_limit', 'download_limit', 'bandwidth_schedule')
 
     def get_status(self, key=None):
         """:return: updated status dict or value of specified key"""
@@ -280,6 +297,13 @@ class WebSocketProtocol(WebSocket):
             LOGGER.debug('Status is now %s' % d['code'])
             return d.get(key, None) if key else dict(d)
 
+    def get_metrics(self):
+        """:return: the work counters and connections of the syncer"""
+        syncer = self.syncer
+        if syncer is None:
+            return {"counters": {}, "connections": []}
+        return syncer.get_metrics()
+
     def set_status(self, **kwargs):
         with self.status.lock() as d:
             LOGGER.debug('Set status to %s' % kwargs)
@@ -366,6 +390,12 @@ class WebSocketProtocol(WebSocket):
                 LOGGER.debug('No %s is set' % option)
                 self.set_status(code=STATUS['SETTINGS MISSING'])
 
+        for option in self.bandwidth_options:
+            try:
+                self.settings[option] = self.cnf.get_sync(sync, option) or ''
+            except KeyError:
+                self.settings[option] = ''
+
         LOGGER.debug('Finished loading settings')
 
     def _dump_settings(self):
@@ -395,7 +425,7 @@ class WebSocketProtocol(WebSocket):
 
         LOGGER.debug('Save sync settings, name is %s' % sync)
         # for option in ('directory', 'container', 'exclude'):
-        for option in ('directory', 'container'):
+        for option in ('directory', 'container') + self.bandwidth_options:
             self.cnf.set_sync(sync, option, self.settings.get(option) or '')
 
         self.cnf.set('global', 'language', self.settings.get('language', 'en'))
@@ -482,6 +512,9 @@ class WebSocketProtocol(WebSocket):
             except KeyError:
                 pass
 
+        for option in self.bandwidth_options:
+            kwargs[option] = self.settings.get(option)
+
         syncer_ = None
         try:
             syncer_settings = setup.SyncerSettings(
@@ -545,6 +578,11 @@ class WebSocketProtocol(WebSocket):
         ok_not_syncing = [STATUS['READY'], STATUS['PAUSING'], STATUS['PAUSED']]
         active = ok_not_syncing + [STATUS['SYNCING']]
 
+        # reject invalid bandwidth limits before touching anything
+        for option in ('upload_limit', 'download_limit'):
+            transfer.parse_rate(new_settings.get(option))
+        transfer.parse_schedule(new_settings.get('bandwidth_schedule'))
+
         must_reset_syncing = self._essentials_changed(new_settings)
         if must_reset_syncing and old_status in active:
             LOGGER.debug('Temporary backend shutdown to save settings')
@@ -562,6 +600,12 @@ class WebSocketProtocol(WebSocket):
             leave_paused = old_status in ok_not_syncing
             LOGGER.debug('Restart backend')
             self.init_sync(leave_paused=leave_paused)
+        elif self.syncer:
+            LOGGER.debug('Apply bandwidth limits to running backend')
+            self.syncer.settings.transfer.set_limits(
+                self.settings['upload_limit'],
+                self.settings['download_limit'],
+                self.settings['bandwidth_schedule'])
 
     def _pause_syncer(self):
         syncer_ = self.syncer
@@ -647,6 +691,7 @@ class WebSocketProtocol(WebSocket):
             data = {
                 'settings': self.get_settings,
                 'status': self.get_status,
+                'metrics': self.get_metrics,
             }[action]()
             data['action'] = 'get %s' % action
             self.send_json(data)
@@ -670,6 +715,10 @@ class WebSocketProtocol(WebSocket):
             action = method + ' ' + r.get('path', '')
             self.send_json({'BAD REQUEST': 400, 'action': action})
             LOGGER.error('KEY ERROR: %s' % ke)
+        except ValueError as ve:
+            action = method + ' ' + r.get('path', '')
+            self.send_json({'BAD REQUEST': 400, 'action': action})
+            LOGGER.error('VALUE ERROR: %s' % ve)
         except setup.ClientError as ce:
             action = '%s %s' % (
                 method, r.get('path', 'ui_id' if 'ui_id' in r else ''))
@@ -20,11 +20,14 @@ from __future__ import unicode_literals
 from agkyra.syncer.setup import SyncerSettings
 from agkyra.syncer import localfs_client
 from agkyra.syncer.pithos_client import PithosFileClient
+from agkyra.syncer.blockstore import BlockStore
 from agkyra.syncer.syncer import FileSyncer
 import agkyra.syncer.syncer
-from agkyra.syncer import messaging, utils, common, database
+from agkyra.syncer import messaging, utils, common, database, transfer
+from agkyra.syncer import pithos_client
 import random
 import os
+import sys
 import time
 import shutil
 import unittest
@@ -32,10 +35,21 @@ import mock
 import sqlite3
 import tempfile
 import argparse
+import struct
+import errno
+import hashlib
+import StringIO
+import threading
+import datetime
+import json
+import BaseHTTPServer
+import SocketServer
 
 from functools import wraps
 from agkyra.config import AgkyraConfig, CONFIG_PATH
 from kamaki.clients import ClientError
+from kamaki.clients.pithos import PithosClient
+from kamaki.clients.utils import https
 
 import logging
 logger = logging.getLogger('agkyra')
@@ -763,7 +777,7 @@ class AgkyraTest(unittest.TestCase):
         state = self.db.get_state(self.s.SLAVE, fil)
         handle = self.slave.stage_file(state)
         staged_path = handle.staged_path
-        self.assertTrue(localfs_client.files_equal(f_path, staged_path))
+        self.assertTrue(self.slave.contents_equal(f_path, staged_path))
         handle.unstage_file()
         self.assertFalse(os.path.exists(staged_path))
 
@@ -771,7 +785,7 @@ class AgkyraTest(unittest.TestCase):
             f.write("content new")
         handle = self.slave.stage_file(state)
         self.assert_message(messaging.LiveInfoUpdateMessage)
-        self.assertTrue(localfs_client.files_equal(f_path, staged_path))
+        self.assertTrue(self.slave.contents_equal(f_path, staged_path))
         handle.unstage_file()
 
         f = open(f_path, "r")
@@ -804,7 +818,7 @@ class AgkyraTest(unittest.TestCase):
         # try to stage now
         handle.stage_file()
         self.assert_message(messaging.LiveInfoUpdateMessage)
-        self.assertTrue(localfs_client.files_equal(
+        self.assertTrue(self.slave.contents_equal(
             fln_path, handle.staged_path))
         handle.unstage_file()
 
@@ -841,6 +855,1942 @@ class AgkyraTest(unittest.TestCase):
             self.s.settings, handle.fspath)
         handle.check_staged(live_info)
 
+    def test_015_unchanged_container(self):
+        fil = "φ015"
+        last_modified = self.master.last_modification
+        self.master.get_pithos_candidates(last_modified=last_modified)
+        with mock.patch.object(
+                self.pithos, "list_objects",
+                wraps=self.pithos.list_objects) as mk:
+            candidates = self.master.get_pithos_candidates(
+                last_modified=last_modified)
+            self.assertEqual(candidates, {})
+            self.assertFalse(mk.called)
+
+            self.pithos.upload_from_string(fil, "content")
+            candidates = self.master.get_pithos_candidates(
+                last_modified=last_modified)
+            self.assertTrue(mk.called)
+            self.assertIn(fil, candidates)
+
+        self.s.probe_file(self.s.MASTER, fil)
+        self.assert_message(messaging.UpdateMessage)
+        self.pithos.del_object(fil)
+        self.master.container_state = None
+        candidates = self.master.get_pithos_candidates(
+            last_modified=self.master.last_modification)
+        self.assertEqual(candidates[fil]["info"], {})
+
+    def test_016_local_rename(self):
+        fil = "φ016"
+        fil_new = "φ016_new"
+        fil_path = self.get_path(fil)
+        fil_new_path = self.get_path(fil_new)
+        with open(fil_path, "w") as f:
+            f.write("content")
+        self.s.probe_file(self.s.SLAVE, fil)
+        self.assert_message(messaging.UpdateMessage)
+        self.s.decide_file_sync(fil)
+        self.s.launch_syncs()
+        self.assert_message(messaging.SyncMessage)
+        self.assert_message(messaging.AckSyncMessage)
+        etag = self.db.get_state(self.s.MASTER, fil).info["pithos_etag"]
+
+        os.rename(fil_path, fil_new_path)
+        self.slave.record_move(fil, fil_new)
+        self.s.probe_file(self.s.SLAVE, fil_new)
+        self.assert_message(messaging.UpdateMessage)
+        moves = self.settings.metrics.get("server_side_moves")
+        with mock.patch.object(
+                self.pithos, "object_put",
+                wraps=self.pithos.object_put) as mk:
+            self.s.decide_file_sync(fil_new)
+            self.s.launch_syncs()
+            self.assert_message(messaging.UpdateMessage)
+            self.assert_message(messaging.SyncMessage)
+            self.assert_message(messaging.AckSyncMessage)
+            self.assertEqual(mk.call_count, 1)
+            args, kwargs = mk.call_args
+            self.assertEqual(args[0], fil_new)
+            self.assertTrue(kwargs["move_from"].endswith("/" + fil))
+            self.assertEqual(kwargs["if_etag_not_match"], "*")
+        self.assertEqual(self.settings.metrics.get("server_side_moves"),
+                         moves + 1)
+
+        info = self.pithos.get_object_info(fil_new)
+        self.assertEqual(info["x-object-hash"], etag)
+        with self.assertRaises(ClientError):
+            self.pithos.get_object_info(fil)
+        for archive in [self.s.MASTER, self.s.SLAVE, self.s.SYNC]:
+            self.assertEqual(self.db.get_state(archive, fil).info, {})
+        sstate = self.db.get_state(self.s.SYNC, fil_new)
+        dstate = self.db.get_state(self.s.DECISION, fil_new)
+        self.assertEqual(sstate.info["pithos_etag"], etag)
+        self.assertEqual(dstate.serial, sstate.serial)
+
+    def test_017_local_dir_rename(self):
+        d = "φ017"
+        d_new = "φ017_new"
+        fils = [utils.join_objname(d, "a"), utils.join_objname(d, "b")]
+        os.mkdir(self.get_path(d))
+        for fil in fils:
+            with open(self.get_path(fil), "w") as f:
+                f.write(fil.encode("utf-8"))
+            self.s.probe_file(self.s.SLAVE, fil)
+            self.assert_message(messaging.UpdateMessage)
+        self.s.probe_file(self.s.SLAVE, d)
+        self.assert_message(messaging.UpdateMessage)
+        self.s.decide_file_syncs([d] + fils)
+        self.s.launch_syncs()
+        self.assert_messages({messaging.SyncMessage: 3,
+                              messaging.AckSyncMessage: 3})
+        etags = [self.db.get_state(self.s.MASTER, fil).info["pithos_etag"]
+                 for fil in fils]
+
+        os.rename(self.get_path(d), self.get_path(d_new))
+        self.slave.record_move(d, d_new)
+        self.s.probe_file(self.s.SLAVE, d_new)
+        self.assert_message(messaging.UpdateMessage)
+        self.s.decide_file_sync(d_new)
+        self.s.launch_syncs()
+        self.assert_message(messaging.UpdateMessage)
+        self.assert_message(messaging.SyncMessage)
+        self.assert_message(messaging.AckSyncMessage)
+
+        for fil, etag in zip(fils, etags):
+            new_fil = d_new + fil[len(d):]
+            info = self.pithos.get_object_info(new_fil)
+            self.assertEqual(info["x-object-hash"], etag)
+            with self.assertRaises(ClientError):
+                self.pithos.get_object_info(fil)
+            sstate = self.db.get_state(self.s.SYNC, new_fil)
+            self.assertEqual(sstate.info["pithos_etag"], etag)
+            self.assertEqual(
+                self.db.get_state(self.s.SLAVE, new_fil).serial,
+                sstate.serial)
+            self.assertEqual(self.db.get_state(self.s.SYNC, fil).info, {})
+        self.assertIn(d_new + fils[0][len(d):],
+                      self.slave.list_candidate_files())
+
+    def test_018_equal_content(self):
+        fil = "φ018"
+        content = "same content"
+        r = self.pithos.upload_from_string(fil, content)
+        etag = r["etag"]
+        with open(self.get_path(fil), "w") as f:
+            f.write(content)
+        self.s.probe_file(self.s.MASTER, fil)
+        self.assert_message(messaging.UpdateMessage)
+        self.s.probe_file(self.s.SLAVE, fil)
+        self.assert_message(messaging.UpdateMessage)
+
+        reconciled = self.settings.metrics.get("reconciled_files")
+        # the local file is hashed on the sync pool, not while deciding
+        with mock.patch.object(utils, "hash_file",
+                               wraps=utils.hash_file) as mk:
+            self.s.decide_file_sync(fil)
+            self.assertEqual(self.db.get_state(self.s.DECISION, fil).serial,
+                             self.db.get_state(self.s.SYNC, fil).serial)
+            self.s.wait_sync_threads()
+            self.assertEqual(mk.call_count, 1)
+            self.assertIn(fil, self.s.list_deciding())
+            self.s.decide_file_sync(fil)
+            self.assertEqual(mk.call_count, 1)
+        self.s.launch_syncs()
+        self.assert_no_message()
+        self.assertEqual(self.settings.metrics.get("reconciled_files"),
+                         reconciled + 1)
+        mstate = self.db.get_state(self.s.MASTER, fil)
+        lstate = self.db.get_state(self.s.SLAVE, fil)
+        sstate = self.db.get_state(self.s.SYNC, fil)
+        dstate = self.db.get_state(self.s.DECISION, fil)
+        self.assertEqual(sstate.info["pithos_etag"], etag)
+        self.assertEqual(sstate.info["localfs_size"], len(content))
+        self.assertEqual(dstate, sstate.set(archive=self.s.DECISION))
+        self.assertEqual(mstate.serial, sstate.serial)
+        self.assertEqual(lstate.serial, sstate.serial)
+        self.assertNotIn(fil, self.s.list_deciding())
+
+    def test_019_kernel_staged_copy(self):
+        fil = "φ019"
+        f_path = self.get_path(fil)
+        content = "kernel copy content"
+        with open(f_path, "w") as f:
+            f.write(content)
+        self.s.probe_file(self.s.SLAVE, fil)
+        self.assert_message(messaging.UpdateMessage)
+        state = self.db.get_state(self.s.SLAVE, fil)
+
+        def copier(modify=None, data=None):
+            def copy(src, dest, method):
+                with open(dest, "wb") as f:
+                    f.write(content if data is None else data)
+                if modify is not None:
+                    time.sleep(0.02)
+                    stats = os.stat(src)
+                    with open(src, "r+b") as f:
+                        f.write(modify)
+                    os.utime(src, (stats.st_atime, stats.st_mtime))
+            return copy
+
+        def stage(copy):
+            with mock.patch.object(
+                    self.settings, "stage_method", utils.COPY_SENDFILE), \
+                    mock.patch.object(
+                        localfs_client, "FINGERPRINT_RACY_WINDOW", -1), \
+                    mock.patch.object(utils, "copy_file_data", copy):
+                return self.slave.stage_file(state)
+
+        handle = stage(copier())
+        self.assertIsNotNone(handle.staged_key)
+        self.assertTrue(self.slave.contents_equal(
+            f_path, handle.staged_path))
+        handle.unstage_file()
+
+        # short copy with the source untouched
+        with self.assertRaises(common.ChangedBusyError):
+            stage(copier(data=content[:-1]))
+
+        # same-size rewrite with the mtime restored
+        with self.assertRaises(common.ChangedBusyError):
+            stage(copier(modify="K"))
+
+        # source grows while being copied
+        with self.assertRaises(common.ChangedBusyError):
+            stage(copier(modify=content + " more"))
+
+
+    def test_020_upload_fills_block_store(self):
+        fil = "φ020"
+        content = "content uploaded once"
+        with open(self.get_path(fil), "w") as f:
+            f.write(content)
+        store_path = tempfile.mkdtemp(dir=TMP)
+        store = BlockStore(store_path, 1024, self.settings.metrics)
+        try:
+            with mock.patch.object(self.settings, "block_store", store):
+                self.s.probe_file(self.s.SLAVE, fil)
+                self.assert_message(messaging.UpdateMessage)
+                self.s.decide_file_sync(fil)
+                self.s.launch_syncs()
+                self.assert_message(messaging.SyncMessage)
+                self.assert_message(messaging.AckSyncMessage)
+            block_hash = self.settings.block_hash
+            hash_type = utils.pithos_hash_type(
+                self.settings.block_size, block_hash)
+            block = utils.pithos_hash(content, block_hash)
+            self.assertEqual(store.get(hash_type, block_hash, block),
+                             content)
+        finally:
+            shutil.rmtree(store_path)
+
+    def test_021_resume_download(self):
+        fil = "φ021"
+        block_size = 4
+        data = "aaaabbbbccccdddde"
+        blocks = [data[i:i + block_size]
+                  for i in range(0, len(data), block_size)]
+        hashes = [utils.pithos_hash(block, "sha256") for block in blocks]
+        hashmap = {"block_size": block_size, "block_hash": "sha256",
+                   "bytes": len(data), "hashes": hashes}
+        etag = utils.pithos_top_hash(hashes, "sha256")
+        state = self.db.get_state(self.s.MASTER, fil)
+        handle = pithos_client.PithosSourceHandle(self.master, state)
+
+        # blocks 0 and 1 made it to disk; block 2 was torn
+        path = handle.register_fetch_name(fil)
+        with open(path, "wb") as f:
+            f.write("aaaabbbbcc")
+        transfer.TransferJournal(
+            self.master.client_dbtuple, fil, transfer.DOWNLOAD, etag,
+            handle.fetch_name, [0, 1, 2]).flush()
+        self.master.collect_stale_transfers()
+        journal, fetched_path = handle.resume_download()
+        self.assertEqual(fetched_path, path)
+        self.assertEqual(journal.blocks, set([0, 1, 2]))
+
+        served = {"data": data}
+        ranges = []
+
+        def object_get(objname, data_range=None, if_etag_match=None,
+                       **kwargs):
+            self.assertEqual(if_etag_match, etag)
+            start, end = [int(x) for x in
+                          data_range.split("=")[1].split("-")]
+            ranges.append((start, end))
+            return mock.Mock(content=served["data"][start:end + 1])
+
+        endpoint = mock.Mock(object_get=object_get)
+        resumed = self.settings.metrics.get("download_blocks_resumed")
+        with mock.patch.object(self.settings, "lane_endpoint",
+                               return_value=endpoint):
+            with open(fetched_path, "rb+") as f:
+                handle.delta_download(f, hashmap, etag, None, journal)
+            with open(fetched_path, "rb") as f:
+                self.assertEqual(f.read(), data)
+            self.assertEqual(sorted(ranges), [(8, 11), (12, 15), (16, 16)])
+            self.assertEqual(
+                self.settings.metrics.get("download_blocks_resumed"),
+                resumed + 2)
+            self.assertIsNone(transfer.TransferJournal.load(
+                self.master.client_dbtuple, fil, transfer.DOWNLOAD))
+
+            # fetched blocks are checked against the hashmap
+            served["data"] = "aaaabbbbXcccdddde"
+            with open(fetched_path, "wb+") as f:
+                with self.assertRaises(common.SyncError):
+                    handle.delta_download(f, hashmap, etag, None)
+            handle.discard_download_journal()
+            # and the hashmap against the etag
+            with open(fetched_path, "wb+") as f:
+                with self.assertRaises(common.SyncError):
+                    handle.delta_download(
+                        f, dict(hashmap, hashes=hashes[::-1]), etag, None)
+        os.unlink(fetched_path)
+
+    def test_022_collect_stale_transfers(self):
+        fetch_path = self.settings.cache_fetch_path
+        fetch_name = self.settings.cache_fetch_name
+        expired = time.time() - self.settings.transfer_journal_ttl - 10
+        names = ["fresh022", "old022", "journaled022", "gone022"]
+        with database.TransactedConnection(self.master.client_dbtuple) as db:
+            for name in names:
+                db.insert_cachename(utils.join_path(fetch_name, name),
+                                    "PithosSourceHandle", name)
+        for name in names[:3]:
+            with open(os.path.join(fetch_path, name), "w") as f:
+                f.write("partial")
+        for name in names[1:3]:
+            os.utime(os.path.join(fetch_path, name), (expired, expired))
+        transfer.TransferJournal(
+            self.master.client_dbtuple, "journaled022", transfer.DOWNLOAD,
+            "etag", utils.join_path(fetch_name, "journaled022")).flush()
+        with database.TransactedConnection(self.master.client_dbtuple) as db:
+            db.put_transfer("upload022", "upload", "etag", None, ["b"],
+                            time.time())
+
+        self.master.collect_stale_transfers()
+        self.assertTrue(os.path.exists(os.path.join(fetch_path, "fresh022")))
+        self.assertFalse(os.path.exists(os.path.join(fetch_path, "old022")))
+        self.assertTrue(
+            os.path.exists(os.path.join(fetch_path, "journaled022")))
+        with database.TransactedConnection(self.master.client_dbtuple) as db:
+            cachenames = set(db.list_cachenames("PithosSourceHandle"))
+            self.assertIsNone(db.get_transfer("upload022", "upload"))
+        self.assertEqual(
+            set(name for name in names
+                if utils.join_path(fetch_name, name) in cachenames),
+            set(["fresh022", "journaled022"]))
+        for name in ["fresh022", "journaled022"]:
+            os.unlink(os.path.join(fetch_path, name))
+
+    def sync_local(self, fil):
+        self.s.probe_file(self.s.SLAVE, fil)
+        self.assert_message(messaging.UpdateMessage)
+        self.s.decide_file_sync(fil)
+        self.s.launch_syncs()
+        self.assert_message(messaging.SyncMessage)
+        self.assert_message(messaging.AckSyncMessage)
+
+    def test_023_content_index(self):
+        fa = "φ023a"
+        fb = "φ023b"
+        content = "content to copy"
+        etag = self.pithos.upload_from_string(fa, content)["etag"]
+        self.master.get_pithos_candidates()
+        source = self.master.find_content(etag)
+        self.assertEqual(source[0], fa)
+        self.assertIsNotNone(source[1])
+        self.assertIsNone(self.master.find_content(etag, exclude=fa))
+
+        copies = self.settings.metrics.get("server_side_copies")
+        with open(self.get_path(fb), "w") as f:
+            f.write(content)
+        self.sync_local(fb)
+        self.assertEqual(self.settings.metrics.get("server_side_copies"),
+                         copies + 1)
+        name, version = self.master.find_content(etag, exclude=fa)
+        self.assertEqual(name, fb)
+        self.assertEqual(
+            version,
+            self.pithos.get_object_info(fb).get("x-object-version"))
+
+        # overwriting replaces the entry of the old content
+        with open(self.get_path(fb), "w") as f:
+            f.write("new content")
+        self.sync_local(fb)
+        self.assertIsNone(self.master.find_content(etag, exclude=fa))
+        new_etag = self.db.get_state(self.s.SYNC, fb).info["pithos_etag"]
+        self.assertEqual(self.master.find_content(new_etag)[0], fb)
+
+        os.unlink(self.get_path(fb))
+        self.sync_local(fb)
+        self.assertIsNone(self.master.find_content(new_etag))
+
+        # objects gone from a complete listing are dropped
+        self.pithos.del_object(fa)
+        self.master.get_pithos_candidates()
+        self.assertIsNone(self.master.find_content(etag))
+
+        # a copy needs to know the source version
+        self.master.index_content(fa, etag)
+        self.assertIsNone(self.master.find_content(etag))
+        self.master.unindex_content(fa)
+
+    def test_024_rename_onto_existing_upstream(self):
+        fa = "φ024a"
+        fb = "φ024b"
+        etag = self.pithos.upload_from_string(fa, "content a")["etag"]
+        self.pithos.upload_from_string(fb, "content b")
+        old_state = self.db.get_state(self.s.MASTER, fa)
+        sync_state = old_state.set(info={"pithos_etag": etag,
+                                         "pithos_type": common.T_FILE})
+        handle = self.master.prepare_target(
+            self.db.get_state(self.s.MASTER, fb))
+        with mock.patch.object(
+                self.master, "get_object",
+                wraps=self.master.get_object) as mk:
+            with self.assertRaises(common.CollisionError):
+                handle.rename_from(old_state, sync_state)
+            self.assertEqual(mk.call_count, 0)
+        self.assertEqual(self.pithos.get_object_info(fa)["x-object-hash"],
+                         etag)
+
+        # content changed upstream since the sync is not taken as synced
+        self.pithos.del_object(fb)
+        self.pithos.upload_from_string(fa, "changed content a")
+        with self.assertRaises(common.SyncError):
+            handle.rename_from(old_state, sync_state)
+        self.assertNotEqual(
+            self.pithos.get_object_info(fb)["x-object-hash"], etag)
+
+        # inodes are queued by the notifier and written on the next probe
+        fc = "φ024c"
+        with open(self.get_path(fc), "w") as f:
+            f.write("content c")
+        st = os.stat(self.get_path(fc))
+        self.slave.index_inode(fc)
+        with database.TransactedConnection(
+                self.slave.client_dbtuple, readonly=True) as db:
+            self.assertNotIn((st.st_dev, st.st_ino), db.list_inodes())
+        self.slave.list_candidate_files()
+        with database.TransactedConnection(
+                self.slave.client_dbtuple, readonly=True) as db:
+            self.assertEqual(db.list_inodes()[(st.st_dev, st.st_ino)], fc)
+        with self.slave.pending_inodes.lock() as d:
+            self.assertEqual(d, {})
+
+
+    def test_026_incremental_content_index(self):
+        fa = "φ026a"
+        fb = "φ026b"
+        etag_a = self.pithos.upload_from_string(fa, "content 026a")["etag"]
+        self.master.get_pithos_candidates()
+        self.s.probe_file(self.s.MASTER, fa)
+        self.assert_message(messaging.UpdateMessage)
+        self.assertEqual(self.master.find_content(etag_a)[0], fa)
+
+        indexed = []
+        index_listed_contents = self.master.index_listed_contents
+
+        def record(contents):
+            indexed.extend(name for name, _, _ in contents)
+            return index_listed_contents(contents)
+
+        def poll():
+            del indexed[:]
+            with mock.patch.object(self.master, "index_listed_contents",
+                                   side_effect=record):
+                self.master.get_pithos_candidates(
+                    last_modified=self.master.last_modification)
+
+        # only objects modified since the last listing are written
+        etag_b = self.pithos.upload_from_string(fb, "content 026b")["etag"]
+        poll()
+        self.assertEqual(indexed, [fb])
+        self.assertEqual(self.master.find_content(etag_b)[0], fb)
+
+        # objects gone from the listing are dropped
+        self.pithos.del_object(fa)
+        poll()
+        self.assertEqual(indexed, [])
+        self.assertIsNone(self.master.find_content(etag_a))
+        self.assertEqual(self.master.find_content(etag_b)[0], fb)
+
+    def test_027_copy_existing(self):
+        fil = "φ027"
+        hashmap = {"block_size": self.settings.block_size,
+                   "block_hash": self.settings.block_hash,
+                   "hash": "h027", "bytes": 10, "hashes": ["b027"]}
+        source_handle = mock.Mock()
+        source_handle.get_staged_hashmap.return_value = hashmap
+        handle = self.master.prepare_target(
+            self.db.get_state(self.s.MASTER, fil))
+        handle.endpoint = endpoint = mock.Mock()
+        endpoint.container = self.ID
+        find_content = mock.patch.object(self.master, "find_content")
+
+        with find_content as mk:
+            mk.return_value = None
+            self.assertIsNone(handle.copy_existing(source_handle, None))
+            mk.assert_called_once_with("h027", exclude=fil)
+        self.assertFalse(endpoint.object_put.called)
+
+        copies = self.settings.metrics.get("server_side_copies")
+        endpoint.object_put.return_value.headers = {
+            "etag": "h027", "x-object-version": "7"}
+        with find_content as mk:
+            mk.return_value = ("src", "5")
+            self.assertEqual(handle.copy_existing(source_handle, "old"),
+                             ("h027", "7"))
+        args, kwargs = endpoint.object_put.call_args
+        self.assertEqual(args, (fil,))
+        self.assertEqual(kwargs["copy_from"], "/%s/src" % self.ID)
+        self.assertEqual(kwargs["source_version"], "5")
+        self.assertEqual(kwargs["if_etag_match"], "old")
+        self.assertIsNone(kwargs["if_etag_not_match"])
+        self.assertEqual(self.settings.metrics.get("server_side_copies"),
+                         copies + 1)
+        self.assertEqual(self.master.get_cached_hashmap(fil, "h027"),
+                         hashmap)
+
+        # a source gone upstream is dropped from the index
+        endpoint.object_put.side_effect = ClientError("Not found", 404)
+        self.master.index_content("src", "h027", "5")
+        with find_content as mk:
+            mk.return_value = ("src", "5")
+            self.assertIsNone(handle.copy_existing(source_handle, None))
+        self.assertIsNone(self.master.find_content("h027"))
+
+        # a source that changed since listed is not trusted
+        endpoint.object_put.side_effect = None
+        endpoint.object_put.return_value.headers = {
+            "etag": "other", "x-object-version": "8"}
+        with find_content as mk:
+            mk.return_value = ("src", "5")
+            with mock.patch.object(handle, "upload_staged",
+                                   return_value=("h027", "9")) as upload:
+                self.assertEqual(
+                    handle.copy_existing(source_handle, None),
+                    ("h027", "9"))
+                upload.assert_called_once_with(source_handle, "other")
+        self.assertEqual(self.settings.metrics.get("server_side_copies"),
+                         copies + 1)
+
+    def test_025_fingerprint_transactions(self):
+        key = (1, 25, 3, 4.0, 5.0)
+        hashmap = {"hash": "h025", "hashes": ["b025"]}
+        db = database.get_db(self.slave.client_dbtuple)
+        self.assertEqual(
+            db.db.execute("pragma journal_mode").fetchone()[0], "wal")
+        reader = database.connect(db.dbname)
+        try:
+            reader.execute("begin deferred")
+            reader.execute("select count(*) from fingerprints").fetchone()
+            with mock.patch.object(db, "begin", wraps=db.begin) as mk:
+                self.slave.put_fingerprint(key, hashmap)
+                mk.assert_called_once_with(readonly=False)
+                mk.reset_mock()
+                known = self.slave.get_known_hashmap(key)
+                mk.assert_called_once_with(readonly=True)
+            self.assertEqual(known["hash"], "h025")
+            self.assertEqual(known["hashes"], ["b025"])
+            self.assertEqual(known["bytes"], 3)
+            # the reader keeps its snapshot while the writer commits
+            self.assertIsNone(reader.execute(
+                "select hash from fingerprints where ino = 25").fetchone())
+            reader.commit()
+            self.assertEqual(reader.execute(
+                "select hash from fingerprints where ino = 25").fetchone(),
+                ("h025",))
+        finally:
+            reader.close()
+        self.assertIsNone(self.slave.get_known_hashmap((1, 25, 3, 4.0, 6.0)))
+
+    def test_028_fingerprint_cache(self):
+        fil = "φ028"
+        f_path = self.get_path(fil)
+        with open(f_path, "w") as f:
+            f.write("content 028")
+        db = database.get_db(self.slave.client_dbtuple)
+
+        def rows():
+            stats = os.stat(f_path)
+            return db.db.execute(
+                "select count(*) from fingerprints where dev = ? and ino = ?",
+                (stats.st_dev, stats.st_ino)).fetchone()[0]
+
+        def fingerprint():
+            with mock.patch.object(
+                    localfs_client, "FINGERPRINT_RACY_WINDOW", -1), \
+                    mock.patch.object(
+                        utils, "hash_file", wraps=utils.hash_file) as mk:
+                return self.slave.get_fingerprint(f_path), mk.call_count
+
+        fp, hashed = fingerprint()
+        self.assertEqual(hashed, 1)
+        self.assertEqual(rows(), 1)
+        # a hit does not read the file
+        self.assertEqual(fingerprint(), (fp, 0))
+
+        # a changed mtime misses, even with the same contents
+        stats = os.stat(f_path)
+        os.utime(f_path, (stats.st_atime, stats.st_mtime - 10))
+        self.assertEqual(fingerprint(), (fp, 1))
+        self.assertEqual(fingerprint(), (fp, 0))
+
+        # a changed size misses and yields a new fingerprint
+        with open(f_path, "a") as f:
+            f.write(" more")
+        new_fp, hashed = fingerprint()
+        self.assertEqual(hashed, 1)
+        self.assertNotEqual(new_fp, fp)
+
+        self.slave.forget_fingerprint(f_path)
+        self.assertEqual(rows(), 0)
+        fingerprint()
+        self.assertEqual(rows(), 1)
+        # a walk drops the fingerprints of inodes no longer found
+        self.slave.rebuild_inode_index({})
+        self.assertEqual(rows(), 0)
+        os.unlink(f_path)
+
+        # unindexing an object drops its cached hashmaps
+        hashmap = {"block_size": 4, "block_hash": "sha256", "bytes": 3,
+                   "hashes": ["b028"], "hash": "e028"}
+        self.master.cache_hashmap(fil, "e028", hashmap)
+        self.assertEqual(self.master.get_cached_hashmap(fil, "e028"), hashmap)
+        self.master.unindex_content(fil)
+        self.assertIsNone(self.master.get_cached_hashmap(fil, "e028"))
+
+    def test_029_metrics(self):
+        self.settings.metrics.incr("test_029", 3)
+        metrics = self.s.get_metrics()
+        self.assertEqual(metrics["counters"]["test_029"], 3)
+        self.assertEqual(metrics["connections"], transfer.connection_stats())
+
+        logger = agkyra.syncer.syncer.logger
+        with mock.patch.object(self.s, "probe_all"), \
+                mock.patch.object(self.s, "decide_archive"), \
+                mock.patch.object(logger, "info") as mk:
+            with mock.patch.object(self.settings, "metrics_log_interval", 0):
+                self.s.decide_all_archives()
+                self.assertFalse(mk.called)
+                self.s.log_metrics(forced=True)
+            self.assertEqual(mk.call_count, 1)
+            logged = json.loads(mk.call_args[0][0][len("Metrics: "):])
+            self.assertEqual(logged["counters"]["test_029"], 3)
+            mk.reset_mock()
+            with mock.patch.object(self.settings, "metrics_log_interval", 60):
+                self.s.decide_all_archives()
+                self.assertFalse(mk.called)
+                self.s.metrics_logged -= 60
+                self.s.decide_all_archives()
+            self.assertEqual(mk.call_count, 1)
+
+    def test_030_iter_objects_pages(self):
+        names = ["a", "d", "d-x", "d/1", "d/2", "d/3", "e"]
+        markers = []
+
+        def list_objects(limit=None, marker=None):
+            markers.append(marker)
+            start = names.index(marker) + 1 if marker is not None else 0
+            return [{"name": name} for name in names[start:start + limit]]
+
+        endpoint = mock.Mock()
+        endpoint.list_objects.side_effect = list_objects
+        for page_size, expected in [
+                # the boundary after "d/1" falls inside the prefix "d/"
+                (4, [None, "d/1"]),
+                (2, [None, "d", "d/1", "d/3"]),
+                # a full last page is followed by an empty one
+                (7, [None, "e"]),
+                (10, [None])]:
+            del markers[:]
+            with mock.patch.object(self.master, "endpoint", endpoint), \
+                    mock.patch.object(self.settings, "pithos_list_page_size",
+                                      page_size):
+                listed = [obj["name"] for obj in self.master.iter_objects()]
+            self.assertEqual(listed, names)
+            self.assertEqual(markers, expected)
+
+    def test_031_probe_requeue(self):
+        fa = "φ031a"
+        fb = "φ031b"
+        for fil in [fa, fb]:
+            with open(self.get_path(fil), "w") as f:
+                f.write(b"content 031")
+            self.s.probe_file(self.s.SLAVE, fil)
+            self.assert_message(messaging.UpdateMessage)
+            self.s.decide_file_sync(fil)
+            self.s.launch_syncs()
+            self.assert_message(messaging.SyncMessage)
+            self.assert_message(messaging.AckSyncMessage)
+
+        probe_file = self.slave.probe_file
+
+        def probe_archive(fil, changed):
+            def probe(objname, *args):
+                live_state = probe_file(objname, *args)
+                changed()
+                return live_state
+
+            self.slave.add_candidates([fil])
+            with mock.patch.object(self.slave, "list_candidate_files",
+                                   return_value=[fil]), \
+                    mock.patch.object(self.slave, "probe_file",
+                                      side_effect=probe), \
+                    mock.patch.object(self.slave, "add_candidates",
+                                      wraps=self.slave.add_candidates) as mk:
+                self.s.probe_archive(self.s.SLAVE)
+            return mk
+
+        # the file changes after it was stat'ed; the notifier queues it
+        # again and the probe round does not drop it
+        def modify():
+            with open(self.get_path(fa), "a") as f:
+                f.write(b" more")
+            self.slave.add_candidates([fa])
+
+        probe_archive(fa, modify)
+        self.assert_no_message()
+        self.assertIn(fa, self.slave.list_candidate_files())
+        # the next round picks up the change
+        with mock.patch.object(self.slave, "list_candidate_files",
+                               return_value=[fa]):
+            self.s.probe_archive(self.s.SLAVE)
+        self.assert_message(messaging.UpdateMessage)
+        self.assertNotIn(fa, self.slave.list_candidate_files())
+
+        # the sync state moves on while probing; the probe is not stored
+        # and the object is requeued
+        def ack():
+            with database.TransactedConnection(self.s.syncer_dbtuple) as db:
+                sync_state = db.get_state(self.s.SYNC, fb)
+                db.put_state(sync_state.set(serial=sync_state.serial + 1))
+
+        with open(self.get_path(fb), "a") as f:
+            f.write(b" more")
+        slave_state = self.db.get_state(self.s.SLAVE, fb)
+        mk = probe_archive(fb, ack)
+        mk.assert_called_once_with([fb])
+        self.assert_no_message()
+        self.assertEqual(self.db.get_state(self.s.SLAVE, fb).serial,
+                         slave_state.serial)
+        self.assertIn(fb, self.slave.list_candidate_files())
+        self.slave.remove_candidates([fb], None)
+
+    def test_032_retry_soft_failure(self):
+        fil = "φ032"
+        with open(self.get_path(fil), "w") as f:
+            f.write(b"content 032")
+        self.s.probe_file(self.s.SLAVE, fil)
+        self.assert_message(messaging.UpdateMessage)
+
+        woken = threading.Event()
+        with mock.patch.object(self.settings, "action_max_wait", 0.5), \
+                mock.patch.object(self.s, "wake_decide",
+                                  side_effect=woken.set):
+            with mock.patch.object(self.slave, "stage_file",
+                                   side_effect=common.SyncError("soft")):
+                self.s.decide_file_sync(fil)
+                self.s.launch_syncs()
+                self.assert_message(messaging.SyncMessage)
+                self.assert_message(messaging.SyncErrorMessage)
+            self.s.wait_sync_threads()
+            woken.clear()
+            tstart = time.time()
+            # the failed run holds the object back; a wakeup is scheduled
+            # for when it is released
+            self.s.decide_file_sync(fil)
+            self.assert_message(messaging.HeartbeatSkipDecideMessage)
+            self.assertIsNotNone(self.s.retry_due)
+            self.assertTrue(woken.wait(2))
+            self.assertLess(time.time() - tstart, 1)
+            self.assertIsNone(self.s.retry_due)
+            self.s.decide_file_sync(fil)
+            self.s.launch_syncs()
+            self.assert_message(messaging.SyncMessage)
+            self.assert_message(messaging.AckSyncMessage)
+
+        # only the earliest wakeup is kept
+        now = utils.time_stamp()
+        later = now + datetime.timedelta(seconds=60)
+        with mock.patch.object(self.s, "wake_decide"):
+            self.s.wake_decide_at(later)
+            timer = self.s.retry_timer
+            self.s.wake_decide_at(later + datetime.timedelta(seconds=1))
+            self.assertIs(self.s.retry_timer, timer)
+            self.s.wake_decide_at(now)
+            self.assertIsNot(self.s.retry_timer, timer)
+            self.assertTrue(timer.finished.is_set())
+            time.sleep(0.2)
+            self.assertIsNone(self.s.retry_due)
+
+class UtilsTest(unittest.TestCase):
+
+    def test_001_waker(self):
+        waker = utils.Waker()
+        self.assertFalse(waker.wait(0))
+        waker.set()
+        waker.set()
+        self.assertTrue(waker.wait(0))
+        self.assertTrue(waker.wait(0))
+        waker.clear()
+        self.assertFalse(waker.wait(0.01))
+        waker.close()
+        waker.set()
+
+    def test_002_stoppable_thread_wake(self):
+        runs = []
+        thread = utils.StoppableThread(
+            30, lambda: runs.append(time.time()), coalesce=0.1)
+        thread.start()
+        time.sleep(0.1)
+        self.assertEqual(len(runs), 1)
+        thread.wake()
+        thread.wake()
+        time.sleep(0.3)
+        self.assertEqual(len(runs), 2)
+        tstart = time.time()
+        thread.stop()
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+        self.assertLess(time.time() - tstart, 0.5)
+        thread.wake()
+
+    def test_003_probe_copy_method(self):
+        def fail(err):
+            def copy(fsrc, fdest):
+                fdest.write("partial")
+                raise OSError(err, os.strerror(err))
+            return copy
+
+        def copy(fsrc, fdest):
+            shutil.copyfileobj(fsrc, fdest)
+
+        def corrupt(fsrc, fdest):
+            fdest.write(fsrc.read()[:-1])
+
+        d = tempfile.mkdtemp(dir=TMP)
+        try:
+            def probe(copiers):
+                with mock.patch.object(utils, "islinux", return_value=True), \
+                        mock.patch.dict(utils.KERNEL_COPIERS, copiers):
+                    return utils.probe_copy_method(d)
+
+            self.assertEqual(probe({utils.COPY_REFLINK: copy}),
+                             utils.COPY_REFLINK)
+            self.assertEqual(
+                probe({utils.COPY_REFLINK: fail(errno.EXDEV),
+                       utils.COPY_FILE_RANGE: fail(errno.ENOSYS),
+                       utils.COPY_SENDFILE: copy}),
+                utils.COPY_SENDFILE)
+            self.assertEqual(
+                probe({utils.COPY_REFLINK: fail(errno.EOPNOTSUPP),
+                       utils.COPY_FILE_RANGE: corrupt,
+                       utils.COPY_SENDFILE: copy}),
+                utils.COPY_SENDFILE)
+            self.assertEqual(
+                probe({utils.COPY_REFLINK: fail(errno.EXDEV),
+                       utils.COPY_FILE_RANGE: fail(errno.EINVAL),
+                       utils.COPY_SENDFILE: fail(errno.ENOSYS)}),
+                utils.COPY_USERSPACE)
+            # a real I/O error aborts probing
+            self.assertEqual(
+                probe({utils.COPY_REFLINK: fail(errno.EIO),
+                       utils.COPY_FILE_RANGE: copy,
+                       utils.COPY_SENDFILE: copy}),
+                utils.COPY_USERSPACE)
+            with mock.patch.object(utils, "islinux", return_value=False):
+                self.assertEqual(utils.probe_copy_method(d),
+                                 utils.COPY_USERSPACE)
+            self.assertEqual(os.listdir(d), [])
+
+            src = os.path.join(d, "src")
+            dest = os.path.join(d, "dest")
+            with open(src, "wb") as f:
+                f.write("data")
+            with mock.patch.object(utils, "islinux", return_value=True), \
+                    mock.patch.dict(utils.KERNEL_COPIERS,
+                                    {utils.COPY_SENDFILE: fail(errno.EXDEV)}):
+                with self.assertRaises(utils.CopyMethodUnsupported):
+                    utils.copy_file_data(src, dest, utils.COPY_SENDFILE)
+            self.assertEqual(os.path.getsize(dest), 0)
+            with self.assertRaises(utils.CopyMethodUnsupported):
+                utils.copy_file_data(src, dest, utils.COPY_USERSPACE)
+        finally:
+            shutil.rmtree(d)
+
+
+    def test_004_block_hasher(self):
+        data = b"".join(chr(i % 251) for i in range(10000))
+        hasher = utils.BlockHasher(1024, "sha256")
+        hasher.update(data)
+        hashmap = hasher.hashmap()
+        self.assertEqual(hashmap["bytes"], 10000)
+        self.assertEqual(hashmap["block_size"], 1024)
+        self.assertEqual(len(hashmap["hashes"]), 10)
+
+        # block hashes are those kamaki computes for an upload
+        hashes = []
+        PithosClient._calculate_blocks_for_upload.__func__(
+            None, 1024, "sha256", len(data), 10, hashes, {},
+            StringIO.StringIO(data))
+        self.assertEqual(hashmap["hashes"], hashes)
+
+        # chunks crossing block boundaries give the same hashmap
+        for chunk_size in [1, 7, 1000, 1024, 3000]:
+            hasher = utils.BlockHasher(1024, "sha256")
+            for i in range(0, len(data), chunk_size):
+                hasher.update(data[i:i + chunk_size])
+            self.assertEqual(hasher.hashmap(), hashmap)
+
+        d = tempfile.mkdtemp(dir=TMP)
+        try:
+            path = os.path.join(d, "data")
+            with open(path, "wb") as f:
+                f.write(data)
+            self.assertEqual(utils.hash_file(path, 1024, "sha256"), hashmap)
+        finally:
+            shutil.rmtree(d)
+
+        empty = utils.BlockHasher(1024, "sha256").hashmap()
+        self.assertEqual(empty["hashes"], [])
+        self.assertEqual(empty["bytes"], 0)
+        self.assertEqual(empty["hash"], hashlib.sha256(b"").hexdigest())
+
+    def test_005_pithos_top_hash(self):
+        def merkle(hashes):
+            # as computed by the Pithos backend (HashMap.hash)
+            h = [x.decode("hex") for x in hashes]
+            s = 2
+            while s < len(h):
+                s *= 2
+            h += [b"\x00" * len(h[0])] * (s - len(h))
+            while len(h) > 1:
+                h = [hashlib.sha256(h[x] + h[x + 1]).digest()
+                     for x in range(0, len(h), 2)]
+            return h[0].encode("hex")
+
+        blocks = [utils.pithos_hash(str(i) * 10, "sha256")
+                  for i in range(9)]
+        self.assertEqual(utils.pithos_top_hash(blocks[:1], "sha256"),
+                         blocks[0])
+        for n in [2, 3, 4, 5, 8, 9]:
+            self.assertEqual(utils.pithos_top_hash(blocks[:n], "sha256"),
+                             merkle(blocks[:n]))
+        self.assertEqual(utils.pithos_top_hash([], "sha256"),
+                         hashlib.sha256(b"").hexdigest())
+        # trailing zeros of a block are not hashed
+        self.assertEqual(utils.pithos_hash(b"ab\x00\x00", "sha256"),
+                         hashlib.sha256(b"ab").hexdigest())
+
+    def test_006_worker_pool_bounded(self):
+        pool = utils.WorkerPool(3, idle_timeout=0.2)
+        lock = threading.Lock()
+        running = [0, 0]
+        release = threading.Event()
+
+        def work():
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            release.wait(5)
+            with lock:
+                running[0] -= 1
+
+        jobs = [pool.submit(utils.WorkerJob(work)) for i in range(10)]
+        time.sleep(0.2)
+        self.assertEqual(running[0], 3)
+        self.assertEqual(len(pool.workers), 3)
+        release.set()
+        self.assertGreater(pool.wait(5), 0)
+        self.assertEqual(running, [0, 3])
+        self.assertFalse(any(job.is_alive() for job in jobs))
+        # idle workers exit
+        time.sleep(0.5)
+        self.assertEqual(len(pool.workers), 0)
+
+    def test_007_worker_pool_job_errors(self):
+        pool = utils.WorkerPool(1, idle_timeout=0.1)
+        done = []
+
+        def fail(e):
+            raise e
+
+        error = ValueError("job 007")
+        with mock.patch.object(utils.logger, "exception") as mk:
+            failed = pool.submit(utils.WorkerJob(fail, args=(error,)))
+            ok = pool.submit(utils.WorkerJob(done.append, args=(1,)))
+            self.assertGreater(pool.wait(5), 0)
+        failed.join(1)
+        self.assertFalse(failed.is_alive())
+        self.assertIs(failed.error, error)
+        self.assertEqual(mk.call_count, 1)
+        # the worker survives the failure and runs the next job
+        self.assertIsNone(ok.error)
+        self.assertEqual(done, [1])
+        self.assertEqual(pool.in_flight, 0)
+        time.sleep(0.3)
+        self.assertEqual(len(pool.workers), 0)
+
+    def test_008_worker_pool_stop_with_queued_jobs(self):
+        pool = utils.WorkerPool(1, idle_timeout=0.1)
+        release = threading.Event()
+        done = []
+
+        def work(i):
+            release.wait(5)
+            done.append(i)
+
+        jobs = [pool.submit(utils.WorkerJob(work, args=(i,)))
+                for i in range(3)]
+        # waiting for the jobs times out while they are still queued
+        tstart = time.time()
+        self.assertEqual(pool.wait(0.2), 0)
+        self.assertLess(time.time() - tstart, 1)
+        self.assertEqual(pool.in_flight, 3)
+        self.assertTrue(all(job.is_alive() for job in jobs))
+        jobs[-1].join(0.1)
+        self.assertTrue(jobs[-1].is_alive())
+        # queued jobs still run once the pool drains
+        release.set()
+        self.assertGreater(pool.wait(5), 0)
+        self.assertEqual(done, [0, 1, 2])
+        time.sleep(0.3)
+        self.assertEqual(len(pool.workers), 0)
+
+    def test_009_sorted_difference(self):
+        def diff(left, right):
+            return list(utils.sorted_difference(left, right))
+
+        self.assertEqual(diff([], []), [])
+        self.assertEqual(diff([], ["a", "b"]), [])
+        self.assertEqual(diff(["a", "b"], []), ["a", "b"])
+        self.assertEqual(diff(["a", "c", "e", "g"], ["b", "c", "d", "g"]),
+                         ["a", "e"])
+        self.assertEqual(diff(["b", "d"], ["a", "c", "e"]), ["b", "d"])
+        self.assertEqual(diff(["a", "b"], ["a", "b"]), [])
+        self.assertEqual(diff(["d", "d/1", "d0"], ["d-x", "d/1"]),
+                         ["d", "d0"])
+
+        # the right side is consumed to the end
+        consumed = []
+
+        def right():
+            for item in ["a", "x", "y"]:
+                consumed.append(item)
+                yield item
+        self.assertEqual(diff(["b"], right()), ["b"])
+        self.assertEqual(consumed, ["a", "x", "y"])
+
+        # duplicates and unsorted input on either side are rejected
+        for left, right in [(["a", "a"], []), (["a"], ["b", "b"]),
+                            (["b", "a"], ["c"]), (["a"], ["c", "b"])]:
+            with self.assertRaises(utils.UnsortedError):
+                diff(left, right)
+
+
+class PithosHandleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(dir=TMP)
+        self.client = mock.Mock()
+        self.settings = self.client.settings
+        self.settings.metrics = utils.Metrics()
+        self.settings.block_store = None
+        self.endpoint = self.settings.endpoint
+        state = common.FileState(archive="PithosFileClient", objname="obj",
+                                 serial=1, info={})
+        self.handle = pithos_client.PithosTargetHandle(self.client, state)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def staged(self, data, block_size=4):
+        path = os.path.join(self.path, "staged")
+        with open(path, "wb") as f:
+            f.write(data)
+        source_handle = mock.Mock()
+        source_handle.staged_path = path
+        source_handle.get_staged_hashmap.return_value = \
+            utils.hash_file(path, block_size, "sha256")
+        return source_handle
+
+    def test_001_changed_blocks(self):
+        hashmap = utils.BlockHasher(4, "sha256")
+        hashmap.update(b"aaaabbbbccccbbbbdddd")
+        hashmap = hashmap.hashmap()
+        previous = utils.BlockHasher(4, "sha256")
+        previous.update(b"aaaabbbb")
+        previous = previous.hashmap()
+        get_cached = self.client.get_cached_hashmap
+        get_cached.return_value = previous
+        self.assertIsNone(self.handle.changed_blocks(hashmap, None))
+        self.assertEqual(self.handle.changed_blocks(hashmap, "etag"),
+                         [hashmap["hashes"][2], hashmap["hashes"][4]])
+        get_cached.assert_called_with("obj", "etag")
+
+        get_cached.return_value = dict(previous, block_size=8)
+        self.assertIsNone(self.handle.changed_blocks(hashmap, "etag"))
+        get_cached.return_value = dict(previous, block_hash="sha1")
+        self.assertIsNone(self.handle.changed_blocks(hashmap, "etag"))
+        get_cached.return_value = None
+        self.assertIsNone(self.handle.changed_blocks(hashmap, "etag"))
+
+    def test_002_upload_staged_missing_blocks(self):
+        source_handle = self.staged(b"aaaabbbbcc")
+        hashmap = source_handle.get_staged_hashmap()
+        missing = hashmap["hashes"][1:]
+        self.endpoint.object_put.side_effect = [
+            mock.Mock(status_code=409, json=missing),
+            mock.Mock(status_code=201, headers={
+                "etag": hashmap["hash"], "x-object-version": "3"})]
+        with mock.patch.object(self.handle, "upload_missing_blocks",
+                               return_value=6) as upload:
+            self.assertEqual(self.handle.upload_staged(source_handle, None),
+                             (hashmap["hash"], "3"))
+            self.assertEqual(upload.call_count, 1)
+            self.assertEqual(upload.call_args[0][1:], (hashmap, missing))
+        calls = self.endpoint.object_put.call_args_list
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(calls[0][1]["success"], (201, 409))
+        self.assertEqual(calls[1][1]["success"], 201)
+        for args, kwargs in calls:
+            self.assertEqual(args, ("obj",))
+            self.assertTrue(kwargs["hashmap"])
+            self.assertEqual(kwargs["json"], {"bytes": 10,
+                                              "hashes": hashmap["hashes"]})
+            self.assertEqual(kwargs["if_etag_not_match"], "*")
+        self.client.cache_hashmap.assert_called_once_with(
+            "obj", hashmap["hash"], hashmap)
+        metrics = self.settings.metrics
+        self.assertEqual(metrics.get("upload_bytes_sent"), 6)
+        self.assertEqual(metrics.get("upload_bytes_saved"), 4)
+
+    def test_003_upload_staged_changed_blocks(self):
+        source_handle = self.staged(b"aaaabbbbcc")
+        hashmap = source_handle.get_staged_hashmap()
+        previous = utils.BlockHasher(4, "sha256")
+        previous.update(b"aaaabbbb")
+        self.client.get_cached_hashmap.return_value = previous.hashmap()
+        self.endpoint.object_put.return_value = mock.Mock(
+            status_code=201, headers={"etag": hashmap["hash"]})
+        with mock.patch.object(self.handle, "upload_missing_blocks",
+                               return_value=2) as upload:
+            self.assertEqual(
+                self.handle.upload_staged(source_handle, "old"),
+                (hashmap["hash"], None))
+            self.assertEqual(upload.call_args[0][1:],
+                             (hashmap, hashmap["hashes"][2:]))
+        kwargs = self.endpoint.object_put.call_args[1]
+        self.assertEqual(kwargs["if_etag_match"], "old")
+        self.assertIsNone(kwargs["if_etag_not_match"])
+        self.assertEqual(self.settings.metrics.get("upload_bytes_saved"), 8)
+
+    def remote(self, data):
+        path = os.path.join(self.path, "remote")
+        with open(path, "wb") as f:
+            f.write(data)
+        return utils.hash_file(path, 4, "sha256")
+
+    def local(self, data):
+        path = os.path.join(self.path, "local")
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def source_handle(self):
+        state = common.FileState(archive="PithosFileClient", objname="obj",
+                                 serial=1, info={})
+        return pithos_client.PithosSourceHandle(self.client, state)
+
+    def test_004_reuse_local_blocks(self):
+        handle = self.source_handle()
+        hashmap = self.remote(b"aaaabbbbccccdd")
+        local_path = self.local(b"bbbbxxxxaaaa")
+        fil = StringIO.StringIO()
+        self.assertEqual(handle.reuse_local_blocks(
+            fil, hashmap, local_path, [0, 1, 2, 3]), [2, 3])
+        self.assertEqual(fil.getvalue(), b"aaaabbbb")
+        # only the missing blocks are looked up
+        fil = StringIO.StringIO()
+        self.assertEqual(handle.reuse_local_blocks(
+            fil, hashmap, local_path, [1, 3]), [3])
+        self.assertEqual(fil.getvalue(), b"\x00" * 4 + b"bbbb")
+
+        # a block that no longer matches its hash is not reused
+        stale = utils.hash_file(self.local(b"bbbbccccaaaa"), 4, "sha256")
+        local_path = self.local(b"bbbbccc!aaaa")
+        fil = StringIO.StringIO()
+        with mock.patch.object(utils, "hash_file", return_value=stale):
+            self.assertEqual(handle.reuse_local_blocks(
+                fil, hashmap, local_path, [0, 1, 2, 3]), [2, 3])
+        self.assertEqual(fil.getvalue(), b"aaaabbbb")
+
+        missing = os.path.join(self.path, "missing")
+        self.assertEqual(handle.reuse_local_blocks(
+            fil, hashmap, missing, [0, 1]), [0, 1])
+
+    def test_005_delta_download(self):
+        metrics = self.settings.metrics
+        self.settings.transfer = transfer.TransferEngine(2, 4, metrics)
+        handle = self.source_handle()
+        data = b"aaaabbbbccccdd"
+        hashmap = self.remote(data)
+        etag = hashmap["hash"]
+        local_path = self.local(b"aaaaXXXXccccdd")
+        object_get = self.settings.lane_endpoint.return_value.object_get
+        object_get.return_value = mock.Mock(content=b"bbbb")
+        journal = mock.Mock(etag=None)
+        fil = StringIO.StringIO()
+        handle.delta_download(fil, hashmap, etag, local_path, journal)
+        self.assertEqual(fil.getvalue(), data)
+        # only the changed block is fetched
+        object_get.assert_called_once_with(
+            "obj", data_range="bytes=4-7", if_etag_match=etag,
+            success=(200, 206))
+        self.assertEqual(metrics.get("download_bytes_received"), 4)
+        self.assertEqual(metrics.get("download_bytes_saved"), 10)
+        self.client.cache_hashmap.assert_called_once_with(
+            "obj", etag, hashmap)
+
+        # a fetched block must match its hash
+        object_get.return_value = mock.Mock(content=b"bbbB")
+        with self.assertRaises(common.SyncError):
+            handle.delta_download(StringIO.StringIO(), hashmap, etag,
+                                  local_path, journal)
+        # and so must the hashmap
+        with self.assertRaises(common.SyncError):
+            handle.delta_download(StringIO.StringIO(), hashmap, "other",
+                                  local_path, journal)
+
+
+class BlockStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(dir=TMP)
+        self.metrics = utils.Metrics()
+        self.store = BlockStore(self.path, 10, self.metrics)
+        self.tstamp = 1000.0
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def put(self, data):
+        block = utils.pithos_hash(data, "sha256")
+        self.tstamp += 1
+        with mock.patch("time.time", return_value=self.tstamp):
+            self.store.put("t", block, data)
+        return block
+
+    def get(self, block):
+        self.tstamp += 1
+        with mock.patch("time.time", return_value=self.tstamp):
+            return self.store.get("t", "sha256", block)
+
+    def total(self):
+        with database.TransactedConnection(self.store.dbtuple) as db:
+            return db.get_total_block_size()
+
+    def test_001_running_total(self):
+        a = self.put("aaaa")
+        self.put("bbb")
+        self.assertEqual(self.total(), 7)
+        self.put("aaaa")
+        self.assertEqual(self.total(), 7)
+        self.store.delete("t", a)
+        self.store.delete("t", a)
+        self.assertEqual(self.total(), 3)
+
+        # a store created before the running total is counted once
+        path = os.path.join(self.path, "old")
+        os.mkdir(path)
+        conn = sqlite3.connect(os.path.join(path, "blocks.db"))
+        conn.execute("create table blocks(hash_type text, hash text, "
+                     "size integer, last_used real, "
+                     "primary key (hash_type, hash))")
+        conn.execute("insert into blocks values ('t', 'x', 5, 1)")
+        conn.execute("insert into blocks values ('t', 'y', 6, 2)")
+        conn.commit()
+        conn.close()
+        store = BlockStore(path, 10, self.metrics)
+        with database.TransactedConnection(store.dbtuple) as db:
+            self.assertEqual(db.get_total_block_size(), 11)
+
+    def test_002_lru_eviction(self):
+        a = self.put("aaaa")
+        b = self.put("bbbb")
+        c = self.put("cccc")
+        self.assertEqual(self.get(a), "aaaa")
+        self.store.evict()
+        self.assertEqual(self.total(), 8)
+        self.assertEqual(self.metrics.get("block_store_evictions"), 1)
+        self.assertIsNone(self.get(b))
+        self.assertFalse(os.path.exists(self.store.block_path("t", b)))
+        self.assertEqual(self.get(c), "cccc")
+        self.assertEqual(self.get(a), "aaaa")
+
+        self.store.evict()
+        self.assertEqual(self.metrics.get("block_store_evictions"), 1)
+        with database.TransactedConnection(self.store.dbtuple) as db:
+            self.assertEqual(
+                [r[1] for r in db.list_lru_blocks(10)], [c, a])
+
+    def test_003_corrupt_block(self):
+        a = self.put("aaaa")
+        with open(self.store.block_path("t", a), "wb") as f:
+            f.write("aaab")
+        self.assertIsNone(self.get(a))
+        self.assertEqual(self.total(), 0)
+        self.assertEqual(self.metrics.get("block_store_misses"), 1)
+
+
+class SyncerDBTest(unittest.TestCase):
+    L = "LocalfsFileClient"
+    P = "PithosFileClient"
+    SYNC = "SYNC"
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(dir=TMP)
+        self.dbname = os.path.join(self.path, "syncer.db")
+        self.db = database.SyncerDB(self.dbname, initialize=True)
+
+    def tearDown(self):
+        self.db.db.close()
+        shutil.rmtree(self.path)
+
+    def put(self, archive, objname, info=None):
+        state = self.db.get_state(archive, objname)
+        state = state.set(serial=self.db.new_serial(objname),
+                          info=info if info is not None else {"x": 1})
+        self.db.put_state(state)
+        return state
+
+    def deciding(self, archives=None):
+        if archives is None:
+            archives = (self.L, self.P)
+        return list(self.db.list_deciding(archives, self.SYNC))
+
+    def test_001_pending(self):
+        for i, name in enumerate(["a", "b", "c"]):
+            self.put(self.SYNC, name)
+            self.put(self.L, name)
+            self.db.add_pending(self.L, name, 10 - i)
+        self.put(self.P, "a")
+        self.db.add_pending(self.P, "a", 20)
+        # an entry is kept once, with its first queue time
+        self.db.add_pending(self.L, "a", 30)
+        self.assertEqual(self.deciding(), ["c", "b", "a"])
+        self.assertEqual(self.deciding((self.P,)), ["a"])
+        self.assertEqual(self.deciding((self.L, self.P, "OTHER")),
+                         ["c", "b", "a"])
+        self.assertEqual(list(self.db.list_deciding(
+            (self.L, self.P), self.SYNC, limit=2)), ["c", "b"])
+
+        # only archives no longer ahead of the sync archive are cleared
+        sync_state = self.db.get_state(self.SYNC, "a")
+        self.db.put_state(sync_state.set(
+            serial=self.db.get_state(self.L, "a").serial))
+        self.db.clear_pending("a", self.SYNC)
+        self.assertEqual(self.deciding(), ["c", "b", "a"])
+        self.assertEqual(self.deciding((self.L,)), ["c", "b"])
+        self.db.clear_pending("missing", self.SYNC)
+
+        self.db.put_state(sync_state.set(
+            serial=self.db.get_state(self.P, "a").serial))
+        self.db.clear_pending("a", self.SYNC)
+        self.assertEqual(self.deciding(), ["c", "b"])
+        count = self.db.db.execute(
+            "select count(*) from pending").fetchone()[0]
+        self.assertEqual(count, 2)
+
+    def test_002_rebuild_pending(self):
+        for name in ["a", "b", "c"]:
+            self.put(self.SYNC, name)
+        self.put(self.L, "a")
+        self.put(self.P, "a")
+        self.put(self.P, "b")
+        # not pending: the sync archive is ahead
+        self.put(self.L, "c")
+        self.put(self.SYNC, "c")
+        self.db.add_pending(self.L, "c", 1)
+        self.assertEqual(self.deciding(), [])
+
+        count = self.db.rebuild_pending((self.L, self.P), self.SYNC, 5)
+        self.assertEqual(count, 3)
+        self.assertEqual(sorted(self.deciding()), ["a", "b"])
+        self.assertEqual(self.deciding((self.L,)), ["a"])
+        rows = self.db.db.execute(
+            "select queued from pending").fetchall()
+        self.assertEqual([r[0] for r in rows], [5, 5, 5])
+
+    def make_v0_db(self, dbname, states):
+        conn = sqlite3.connect(dbname)
+        conn.execute("create table archives(archive text, objname text, "
+                     "serial integer, info blob, "
+                     "primary key (archive, objname))")
+        conn.execute("create table serials(objname text, "
+                     "nextserial bigint, primary key (objname))")
+        conn.execute("create table config(key text, value text, "
+                     "primary key (key))")
+        nextserials = {}
+        for archive, objname, serial, info in states:
+            conn.execute("insert into archives values (?, ?, ?, ?)",
+                         (archive, objname, serial, json.dumps(info)))
+            nextserials[objname] = max(nextserials.get(objname, 0),
+                                       serial + 1)
+        conn.executemany("insert into serials values (?, ?)",
+                         nextserials.items())
+        conn.execute("insert into config values ('sync_enabled', 'true')")
+        conn.commit()
+        conn.close()
+
+    def v0_states(self):
+        linfo = {"localfs_type": "file", "localfs_mtime": 1444.5,
+                 "localfs_size": 3}
+        pinfo = {"pithos_type": "file", "pithos_etag": "e1"}
+        sinfo = dict(linfo)
+        sinfo.update(pinfo)
+        return [(self.L, "ά/β", 3, linfo),
+                (self.P, "ά/β", 2, pinfo),
+                (self.SYNC, "ά/β", 2, sinfo),
+                (self.SYNC, "gone", 1, {}),
+                # values not of the column type are kept as extra info
+                (self.SYNC, "odd", 4, {"localfs_mtime": 5, "x": [1]})]
+
+    def test_003_migrate_v0(self):
+        dbname = os.path.join(self.path, "v0.db")
+        states = self.v0_states()
+        self.make_v0_db(dbname, states)
+        db = database.SyncerDB(dbname, initialize=True)
+        try:
+            for archive, objname, serial, info in states:
+                self.assertEqual(db.get_state(archive, objname),
+                                 common.FileState(archive=archive,
+                                                  objname=objname,
+                                                  serial=serial,
+                                                  info=info))
+            self.assertEqual(db.new_serial("ά/β"), 4)
+            self.assertEqual(db.new_serial("new"), 0)
+            self.assertTrue(db.get_config("sync_enabled"))
+            self.assertFalse(db.has_table("archives"))
+            self.assertFalse(db.has_table("serials"))
+            self.assertEqual(
+                db.db.execute("pragma user_version").fetchone()[0],
+                database.SYNCER_SCHEMA_VERSION)
+        finally:
+            db.db.close()
+
+    def test_004_failed_migration_rolls_back(self):
+        dbname = os.path.join(self.path, "v0.db")
+        self.make_v0_db(dbname, self.v0_states())
+        with mock.patch.object(database, "encode_info",
+                               side_effect=ValueError("bad info")):
+            with self.assertRaises(ValueError):
+                database.SyncerDB(dbname, initialize=True)
+        conn = sqlite3.connect(dbname)
+        try:
+            tables = set(r[0] for r in conn.execute(
+                "select name from sqlite_master where type = 'table'"))
+            self.assertEqual(tables, set(["archives", "serials", "config"]))
+            self.assertEqual(
+                conn.execute("pragma user_version").fetchone()[0], 0)
+            self.assertEqual(
+                conn.execute("select count(*) from archives").fetchone()[0],
+                5)
+        finally:
+            conn.close()
+
+        # the next start migrates it
+        db = database.SyncerDB(dbname, initialize=True)
+        try:
+            self.assertEqual(db.get_state(self.P, "ά/β").info,
+                             {"pithos_type": "file", "pithos_etag": "e1"})
+        finally:
+            db.db.close()
+
+    def test_005_connection_options(self):
+        def pragma(conn, name):
+            return conn.execute("pragma %s" % name).fetchone()[0]
+
+        self.assertEqual(pragma(self.db.db, "journal_mode"), "wal")
+        saved = dict(database.connection_options)
+        self.addCleanup(database.connection_options.update, saved)
+        database.configure(synchronous="NORMAL", busy_timeout=1500,
+                           cache_size="-4000", mmap_size=None)
+        conn = database.connect(os.path.join(self.path, "options.db"))
+        try:
+            self.assertEqual(pragma(conn, "journal_mode"), "wal")
+            self.assertEqual(pragma(conn, "synchronous"), 1)
+            self.assertEqual(pragma(conn, "busy_timeout"), 1500)
+            self.assertEqual(pragma(conn, "cache_size"), -4000)
+        finally:
+            conn.close()
+        with self.assertRaises(ValueError):
+            database.configure(synchronous="sometimes")
+        with self.assertRaises(ValueError):
+            database.configure(page_size=4096)
+        self.assertEqual(database.connection_options["synchronous"],
+                         "normal")
+
+    def test_006_reader_does_not_block_writer(self):
+        self.put(self.SYNC, "a", {"x": 1})
+        self.db.commit()
+        reader = database.SyncerDB(self.dbname)
+        try:
+            reader.begin(readonly=True)
+            self.assertEqual(reader.get_state(self.SYNC, "a").info,
+                             {"x": 1})
+            self.db.begin()
+            self.put(self.SYNC, "a", {"x": 2})
+            self.db.commit()
+            # the reader keeps its snapshot until its transaction ends
+            self.assertEqual(reader.get_state(self.SYNC, "a").info,
+                             {"x": 1})
+            reader.commit()
+            self.assertEqual(reader.get_state(self.SYNC, "a").info,
+                             {"x": 2})
+        finally:
+            reader.db.close()
+
+    def test_007_prefix_range(self):
+        top = unichr(sys.maxunicode)
+        self.assertEqual(database.prefix_range("d1/"), ("d1/", "d10"))
+        self.assertEqual(database.prefix_range("ά/"), ("ά/", "ά0"))
+        self.assertEqual(database.prefix_range("ab" + top), ("ab" + top, "ac"))
+        self.assertEqual(database.prefix_range("a\uffff"),
+                         ("a\uffff", "a" + unichr(0xffff + 1))
+                         if sys.maxunicode > 0xffff else ("a\uffff", "b"))
+        self.assertEqual(database.prefix_range(""), ("", None))
+        self.assertEqual(database.prefix_range(top + top), (top + top, None))
+        self.assertEqual(database.name_range_clause(top, column="name"),
+                         ("name >= ?", (top,)))
+        self.assertEqual(database.name_range_clause("d1/"),
+                         ("o.name >= ? and o.name < ?", ("d1/", "d10")))
+
+    def test_008_subtree_lookups(self):
+        top = unichr(sys.maxunicode)
+        dirs = ["d1", "ά", "a\uffff", top, "D1", "d1_x"]
+        names = dirs + [
+            "d1/a", "d1/β", "d1/b/c", "d10", "d1.x", "D1/up",
+            "d1_x/y", "d1ax/y", "ά/γ", "ά/δ/ε", "άβ",
+            "a\uffff/a", "a\uffff/\U0001f600", "a\U00010000",
+            top + "/a", top + "/" + top, top + top]
+        for name in names:
+            self.put(self.SYNC, name)
+        self.put(self.SYNC, "d1/deleted", {})
+        like = ("select o.name from objects o, states s "
+                "where s.object_id = o.id and s.archive_id = ? "
+                "and o.name like ?")
+        archive_id = self.db.get_archive_id(self.SYNC)
+        for objname in dirs:
+            prefix = objname + "/"
+            expected = sorted(name for name in names
+                              if name.startswith(prefix))
+            self.assertTrue(expected)
+            self.assertEqual(
+                sorted(self.db.get_dir_contents(self.SYNC, objname)),
+                expected)
+            # deleted entries are listed too
+            listed = sorted(expected + ["d1/deleted"]) \
+                if objname == "d1" else expected
+            self.assertEqual(
+                sorted(self.db.list_files(self.SYNC, prefix)), listed)
+            self.assertEqual(
+                sorted(set(state.objname for state in
+                           self.db.list_states_under(objname))),
+                listed)
+            # the old LIKE lookup also matched other case and wildcards
+            like_names = [r[0] for r in self.db.db.execute(
+                like, (archive_id, prefix + "%"))]
+            self.assertEqual(
+                sorted(name for name in like_names
+                       if name.startswith(prefix) and name in names),
+                expected)
+        self.assertEqual(
+            sorted(r[0] for r in self.db.db.execute(
+                like, (archive_id, "d1/%"))),
+            ["D1/up", "d1/a", "d1/b/c", "d1/deleted", "d1/β"])
+
+
+class EchoRangeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = "%s %s" % (self.headers.get("Range"),
+                          self.headers.get("If-Match"))
+        self.send_response(206)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class EchoRangeServer(SocketServer.ThreadingMixIn,
+                      BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class TransferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = utils.Metrics()
+        self.server = None
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def start_server(self):
+        self.server = EchoRangeServer(("127.0.0.1", 0), EchoRangeHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return "127.0.0.1:%s" % self.server.server_address[1]
+
+    def test_001_lane_scheduling(self):
+        engine = transfer.TransferEngine(3, 4, self.metrics)
+        lock = threading.Lock()
+        active = [0]
+        peak = [0]
+        done = []
+
+        def func(item):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.02)
+            with lock:
+                active[0] -= 1
+                done.append(item)
+            if item == 7:
+                raise ValueError(item)
+
+        failures = engine.run(func, range(10))
+        self.assertEqual(sorted(done), range(10))
+        self.assertEqual([(item, type(e)) for item, e in failures],
+                         [(7, ValueError)])
+        self.assertEqual(peak[0], 3)
+        self.assertEqual(self.metrics.get("block_requests"), 10)
+        self.assertEqual(engine.lanes(1), 1)
+        self.assertEqual(engine.run(func, []), [])
+
+        # lanes of concurrent transfers share the in-flight cap
+        peak[0] = 0
+        runs = [threading.Thread(target=engine.run, args=(func, range(6)))
+                for i in range(2)]
+        for run in runs:
+            run.start()
+        for run in runs:
+            run.join()
+        self.assertEqual(peak[0], 4)
+
+    def test_002_lane_endpoints(self):
+        netloc = self.start_server()
+        settings = mock.Mock(
+            endpoint=PithosClient("http://%s/v1" % netloc, "tok",
+                                  "acc", "cont"),
+            lane_endpoints=threading.local(),
+            connection_retry_limit=1)
+        lane_endpoint = lambda: SyncerSettings.lane_endpoint.__func__(
+            settings)
+        endpoint = lane_endpoint()
+        self.assertIs(lane_endpoint(), endpoint)
+        self.assertIsNot(endpoint, settings.endpoint)
+        self.assertEqual(endpoint.container, "cont")
+
+        engine = transfer.TransferEngine(8, 8, self.metrics)
+        endpoints = set()
+        mismatches = []
+
+        def fetch(i):
+            endpoint = lane_endpoint()
+            endpoints.add(id(endpoint))
+            expected = "bytes=%s-%s etag%s" % (i, i + 1, i)
+            r = endpoint.object_get(
+                "obj", data_range="bytes=%s-%s" % (i, i + 1),
+                if_etag_match="etag%s" % i, success=(200, 206))
+            if r.content != expected:
+                mismatches.append((expected, r.content))
+
+        self.assertEqual(engine.run(fetch, range(200)), [])
+        self.assertEqual(mismatches, [])
+        self.assertGreater(len(endpoints), 1)
+
+    def test_003_tracked_connection_pool(self):
+        netloc = self.start_server()
+        with mock.patch.object(https, "PooledHTTPConnection"), \
+                mock.patch.dict(transfer._pools, clear=True), \
+                mock.patch.dict(transfer._pool_settings):
+            transfer.patch_connection_pool(2, self.metrics)
+            self.assertIs(https.PooledHTTPConnection,
+                          transfer.TrackedHTTPConnection)
+            endpoint = PithosClient("http://%s/v1" % netloc, "tok",
+                                    "acc", "cont")
+            for i in range(3):
+                endpoint.object_get("obj", data_range="bytes=0-1",
+                                    success=(200, 206))
+            stats = transfer.connection_stats()
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(stats[0]["netloc"], netloc)
+        self.assertEqual(stats[0]["size"], 2)
+        self.assertEqual(self.metrics.get("http_requests"), 3)
+        self.assertEqual(self.metrics.get("http_connections_opened"), 1)
+        self.assertEqual(self.metrics.get("http_connections_reused"), 2)
+        self.assertEqual(stats[0]["connections"],
+                         [{"requests": 3, "reuses": 2}])
+
+    def test_004_parse_rate(self):
+        K = 1024
+        for value, rate in [(None, 0), ("", 0), ("  ", 0), (0, 0),
+                            (512, 512), ("512", 512), ("512K", 512 * K),
+                            ("2m", 2 * K * K), ("1.5KB", 1536),
+                            (" 1 G ", K * K * K), (2.5, 2)]:
+            self.assertEqual(transfer.parse_rate(value), rate)
+        for value in ["fast", "-1", "1T", "5K/s", "K", -5]:
+            with self.assertRaises(ValueError):
+                transfer.parse_rate(value)
+
+    def test_005_parse_schedule(self):
+        K = 1024
+        self.assertEqual(transfer.parse_schedule(None), [])
+        self.assertEqual(transfer.parse_schedule(""), [])
+        schedule = transfer.parse_schedule(
+            "08:00-18:00 512K/2M, 18:00-20:00 1M/0,")
+        self.assertEqual(schedule, [(480, 1080, 512 * K, 2 * K * K),
+                                    (1080, 1200, K * K, 0)])
+        self.assertEqual(transfer.parse_schedule("23:00-24:00 1K/1K"),
+                         [(1380, 1440, K, K)])
+
+        schedule = transfer.parse_schedule("22:30-06:00 1K/2K")
+        default = (3, 4)
+        for hour, minute, limits in [(23, 0, (K, 2 * K)),
+                                     (5, 59, (K, 2 * K)),
+                                     (6, 0, default), (22, 29, default),
+                                     (22, 30, (K, 2 * K))]:
+            now = datetime.datetime(2015, 1, 1, hour, minute)
+            self.assertEqual(
+                transfer.scheduled_limits(schedule, now, default), limits)
+
+        for value in ["25:00-26:00 1K/1K", "08:00-18:00 1K",
+                      "08:60-09:00 1K/1K", "08:00-18:00 fast/1K",
+                      "23:00-24:30 1K/1K", "8-18 1K/1K"]:
+            with self.assertRaises(ValueError):
+                transfer.parse_schedule(value)
+
+    def test_006_invalid_limits_rejected(self):
+        from agkyra.protocol import WebSocketProtocol
+        protocol = WebSocketProtocol.__new__(WebSocketProtocol)
+        protocol.accepted = True
+        protocol.settings = {"upload_limit": "1M"}
+        protocol.get_status = mock.Mock(return_value=0)
+        protocol.send_json = mock.Mock()
+        protocol._dump_settings = mock.Mock()
+        for settings in [{"upload_limit": "fast"},
+                         {"download_limit": "-1"},
+                         {"bandwidth_schedule": "08:00-18:00 1K"}]:
+            settings.update(method="put", path="settings")
+            protocol.received_message(json.dumps(settings))
+            response = protocol.send_json.call_args[0][0]
+            self.assertEqual(response["BAD REQUEST"], 400)
+        self.assertEqual(protocol.settings, {"upload_limit": "1M"})
+        self.assertFalse(protocol._dump_settings.called)
+
+    def test_007_bucket_debt(self):
+        bucket = transfer.TokenBucket(100000)
+        tbefore = time.time()
+        self.assertLess(bucket.consume("a", 250000), 0.1)
+        # the excess over the burst is paid back by later requests
+        self.assertLess(bucket.tokens, -140000)
+        waited = bucket.consume("a", 1)
+        self.assertGreater(waited, 1.3)
+        self.assertLess(waited, 2)
+        self.assertLess(250001 / (time.time() - tbefore), 200000)
+
+        # a new rate keeps the time left to pay back the debt
+        bucket.consume("a", 100000)
+        bucket.set_rate(50000)
+        waited = bucket.consume("a", 1)
+        self.assertGreater(waited, 0.8)
+        self.assertLess(waited, 1.5)
+        bucket.set_rate(0)
+        self.assertEqual(bucket.consume("a", 10 ** 9), 0)
+
+    def test_008_bucket_fairness(self):
+        bucket = transfer.TokenBucket(10000)
+        bucket.tokens = -2000
+        lock = threading.Lock()
+        order = []
+
+        def consume(owner):
+            bucket.consume(owner, 1000)
+            with lock:
+                order.append(owner)
+
+        threads = []
+        for owner in ["a", "a", "a", "a", "b"]:
+            thread = threading.Thread(target=consume, args=(owner,))
+            thread.start()
+            threads.append(thread)
+            time.sleep(0.01)
+        for thread in threads:
+            thread.join()
+        # b is served before the requests queued ahead of it by a
+        self.assertEqual(order, ["a", "b", "a", "a", "a"])
+
+    def test_009_schedule_applies_while_idle(self):
+        now = [datetime.datetime(2015, 1, 1, 7, 59, 59, 900000)]
+        self.assertAlmostEqual(transfer.next_schedule_change(
+            transfer.parse_schedule("08:00-18:00 1K/2K"), now[0]), 0.1)
+        self.assertEqual(transfer.next_schedule_change(
+            transfer.parse_schedule("22:00-08:00 1K/2K"),
+            datetime.datetime(2015, 1, 1, 8, 0)), 14 * 3600)
+        self.assertEqual(transfer.next_schedule_change(
+            transfer.parse_schedule("00:00-24:00 1K/2K"),
+            datetime.datetime(2015, 1, 1, 23, 59)), 60)
+        self.assertIsNone(transfer.next_schedule_change(
+            [], datetime.datetime(2015, 1, 1)))
+
+        clock = mock.Mock()
+        clock.datetime.now.side_effect = lambda: now[0]
+        with mock.patch.object(transfer, "datetime", clock):
+            engine = transfer.TransferEngine(
+                1, 1, self.metrics, schedule="08:00-18:00 1K/2K")
+            self.assertEqual(engine.upload_bucket.rate, 0)
+            now[0] = datetime.datetime(2015, 1, 1, 8, 0, 0, 100)
+            self.assertTrue(wait_until(
+                lambda: engine.download_bucket.rate == 2048))
+            self.assertEqual(engine.upload_bucket.rate, 1024)
+            timer = engine.schedule_timer
+            self.assertTrue(timer.is_alive())
+            engine.set_limits()
+            timer.join(1)
+            self.assertFalse(timer.is_alive())
+            self.assertIsNone(engine.schedule_timer)
+
+
+def wait_until(predicate, timeout=2):
+    tstart = time.time()
+    while not predicate():
+        if time.time() - tstart > timeout:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@unittest.skipUnless(utils.islinux(), "inotify is only available on Linux")
+class OpenFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        from watchdog.observers.inotify_c import InotifyConstants, \
+            InotifyEvent
+        self.C = InotifyConstants
+        self.InotifyEvent = InotifyEvent
+        self.root = utils.from_unicode(tempfile.mkdtemp(dir=TMP))
+        self.index = None
+
+    def tearDown(self):
+        if self.index is not None:
+            self.index.stop()
+        shutil.rmtree(self.root)
+
+    def path(self, name):
+        return os.path.join(self.root, utils.from_unicode(name))
+
+    def event(self, mask, name, cookie=0):
+        return self.InotifyEvent(1, mask, cookie, name, self.path(name))
+
+    def handle(self, *events, **kwargs):
+        with self.index.lock:
+            for event in events:
+                self.index.handle_event(event, **kwargs)
+
+    def test_001_open_close_counting(self):
+        self.index = localfs_client.InotifyOpenFileIndex(self.root)
+        fil = self.path("f")
+        self.handle(self.event(self.C.IN_OPEN, "f"),
+                    self.event(self.C.IN_OPEN, "f"))
+        self.assertTrue(self.index.is_open(fil))
+        self.handle(self.event(self.C.IN_CLOSE_WRITE, "f"))
+        self.assertTrue(self.index.is_open(fil))
+        self.handle(self.event(self.C.IN_CLOSE_NOWRITE, "f"))
+        self.assertFalse(self.index.is_open(fil))
+        # a close whose open was missed does not go negative
+        self.handle(self.event(self.C.IN_CLOSE_WRITE, "f"),
+                    self.event(self.C.IN_OPEN, "f"))
+        self.assertTrue(self.index.is_open(fil))
+        self.handle(self.event(self.C.IN_DELETE, "f"))
+        self.assertFalse(self.index.is_open(fil))
+
+    def test_002_open_before_start(self):
+        fil = self.path("f")
+        f1 = open(fil, "w")
+        f2 = open(fil, "a")
+        self.index = localfs_client.InotifyOpenFileIndex(self.root)
+        self.assertEqual(self.index.counts[fil], 2)
+        f1.close()
+        time.sleep(0.2)
+        self.assertTrue(self.index.is_open(fil))
+        f2.close()
+        self.assertTrue(wait_until(lambda: not self.index.is_open(fil)))
+
+    def test_003_moves(self):
+        self.index = localfs_client.InotifyOpenFileIndex(self.root)
+        C = self.C
+        self.handle(self.event(C.IN_OPEN, "d/f"),
+                    self.event(C.IN_OPEN, "a"),
+                    self.event(C.IN_MOVED_FROM | C.IN_ISDIR, "d", cookie=1),
+                    self.event(C.IN_MOVED_TO | C.IN_ISDIR, "e", cookie=1),
+                    self.event(C.IN_MOVED_FROM, "a", cookie=2),
+                    self.event(C.IN_MOVED_TO, "b", cookie=2))
+        self.assertFalse(self.index.is_open(self.path("d/f")))
+        self.assertTrue(self.index.is_open(self.path("e/f")))
+        self.assertFalse(self.index.is_open(self.path("a")))
+        self.assertTrue(self.index.is_open(self.path("b")))
+        self.assertEqual(self.index.moves, {})
+
+        # moved out of the tree
+        self.handle(self.event(C.IN_MOVED_FROM, "b", cookie=3), tstamp=100)
+        self.assertFalse(self.index.is_open(self.path("b")))
+        with self.index.lock:
+            self.index.expire_moves(100.5)
+            self.assertIn(3, self.index.moves)
+            self.index.expire_moves(102)
+            self.assertEqual(self.index.moves, {})
+
+    def test_004_overflow(self):
+        from watchdog.observers.inotify_c import Inotify
+        self.index = localfs_client.InotifyOpenFileIndex(self.root)
+        C = self.C
+        self.handle(self.event(C.IN_OPEN, "lost"))
+        self.handle(self.InotifyEvent(-1, C.IN_Q_OVERFLOW, 0, b"", b""))
+        self.assertTrue(self.index.overflowed)
+        self.index.resync()
+        self.assertFalse(self.index.is_open(self.path("lost")))
+
+        # watchdog drops the event while parsing; the wrapper notes it
+        localfs_client.inotify_overflow.seen = False
+        buf = struct.pack("iIII", -1, C.IN_Q_OVERFLOW, 0, 0)
+        self.assertEqual(list(Inotify._parse_event_buffer(buf)),
+                         [(-1, C.IN_Q_OVERFLOW, 0, b"")])
+        self.assertTrue(localfs_client.inotify_overflow.seen)
+
+    def test_005_resync_and_stop(self):
+        self.index = localfs_client.InotifyOpenFileIndex(
+            self.root, resync_interval=0.1)
+        self.handle(self.event(self.C.IN_OPEN, "stale"))
+        self.assertTrue(wait_until(
+            lambda: not self.index.is_open(self.path("stale"))))
+        fd = self.index.inotify.fd
+        self.index.stop()
+        self.assertFalse(self.index.thread.is_alive())
+        self.assertRaises(OSError, os.fstat, fd)
+        self.index = None
 
 def set_debug(debug):
     level = logging.DEBUG if debug else logging.INFO
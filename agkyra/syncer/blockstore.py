@@ -0,0 +1,127 @@
+# Copyright (C) 2015 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import errno
+import logging
+
+from agkyra.syncer import utils, common, database
+from agkyra.syncer.database import TransactedConnection
+
+logger = logging.getLogger(__name__)
+
+BLOCK_STORE_DBNAME = "blocks.db"
+EVICT_BATCH = 100
+
+
+class BlockStore(object):
+    """Content-addressed store of Pithos blocks.
+
+    Blocks are kept as files named by their hash and indexed in a SQLite
+    DB, so that the store can be shared by all sync instances under the
+    same settings directory. The least recently used blocks are evicted
+    once the store exceeds its quota.
+    """
+
+    def __init__(self, path, quota, metrics):
+        self.path = path
+        self.quota = quota
+        self.metrics = metrics
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.dbtuple = common.DBTuple(
+            dbtype=database.BlockStoreDB,
+            dbname=utils.join_path(path, BLOCK_STORE_DBNAME))
+        database.initialize(self.dbtuple)
+
+    def block_path(self, hash_type, block):
+        return os.path.join(self.path, hash_type, block[:2], block)
+
+    def get(self, hash_type, block_hash, block):
+        with TransactedConnection(self.dbtuple) as db:
+            size = db.get_block_size(hash_type, block)
+            if size is not None:
+                db.touch_block(hash_type, block, time.time())
+        data = None
+        if size is not None:
+            try:
+                with open(self.block_path(hash_type, block), "rb") as f:
+                    data = f.read()
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            if data is not None and \
+                    utils.pithos_hash(data, block_hash) != block:
+                logger.warning("Dropping corrupt block '%s'" % block)
+                data = None
+            if data is None:
+                self.delete(hash_type, block)
+        if data is None:
+            self.metrics.incr("block_store_misses")
+        else:
+            self.metrics.incr("block_store_hits")
+            self.metrics.incr("block_store_hit_bytes", len(data))
+        return data
+
+    def put(self, hash_type, block, data):
+        path = self.block_path(hash_type, block)
+        dirpath = os.path.dirname(path)
+        if not os.path.isdir(dirpath):
+            try:
+                os.makedirs(dirpath)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        tmp_path = "%s.%s.%s" % (path, os.getpid(), utils.str_time_stamp())
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+        with TransactedConnection(self.dbtuple) as db:
+            db.put_block(hash_type, block, len(data), time.time())
+
+    def delete(self, hash_type, block):
+        with TransactedConnection(self.dbtuple) as db:
+            db.delete_block(hash_type, block)
+        self._unlink(hash_type, block)
+
+    def _unlink(self, hash_type, block):
+        try:
+            os.unlink(self.block_path(hash_type, block))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def evict(self):
+        with TransactedConnection(self.dbtuple, readonly=True) as db:
+            if db.get_total_block_size() <= self.quota:
+                return
+        while True:
+            with TransactedConnection(self.dbtuple) as db:
+                excess = db.get_total_block_size() - self.quota
+                if excess <= 0:
+                    return
+                evicted = []
+                for hash_type, block, size in db.list_lru_blocks(EVICT_BATCH):
+                    if excess <= 0:
+                        break
+                    db.delete_block(hash_type, block)
+                    evicted.append((hash_type, block))
+                    excess -= size
+            for hash_type, block in evicted:
+                self._unlink(hash_type, block)
+            self.metrics.incr("block_store_evictions", len(evicted))
+            if not evicted:
+                return
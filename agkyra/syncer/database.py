@@ -31,18 +31,72 @@ logger = logging.getLogger(__name__)
 
 thread_local_data = threading.local()
 
+SYNCHRONOUS_LEVELS = ["off", "normal", "full", "extra"]
+
+# pragmas applied to every new connection; None keeps the SQLite default
+connection_options = {
+    "journal_mode": "wal",
+    "synchronous": None,
+    "busy_timeout": None,
+    "cache_size": None,
+    "mmap_size": None,
+}
+
+
+def configure(**options):
+    """Set the pragmas for connections opened from now on."""
+    for key, value in options.iteritems():
+        if key not in connection_options:
+            raise ValueError("Unknown connection option '%s'" % key)
+        if value is None:
+            continue
+        if key == "synchronous":
+            value = str(value).lower()
+            if value not in SYNCHRONOUS_LEVELS:
+                raise ValueError("Bad synchronous level '%s'" % value)
+        elif key != "journal_mode":
+            value = int(value)
+        connection_options[key] = value
+
+
+def connect(dbname):
+    options = dict(connection_options)
+    busy_timeout = options["busy_timeout"]
+    if busy_timeout is not None:
+        db = sqlite3.connect(dbname, timeout=busy_timeout / 1000.0)
+    else:
+        db = sqlite3.connect(dbname)
+    journal_mode = options["journal_mode"]
+    if journal_mode is not None:
+        c = db.execute("pragma journal_mode = %s" % journal_mode)
+        actual = c.fetchone()[0]
+        if actual.lower() != journal_mode.lower():
+            logger.warning("Could not set journal mode '%s' for '%s'; "
+                           "using '%s'" % (journal_mode, dbname, actual))
+    for pragma in ["synchronous", "busy_timeout", "cache_size",
+                   "mmap_size"]:
+        value = options[pragma]
+        if value is not None:
+            db.execute("pragma %s = %s" % (pragma, value))
+    return db
+
 
 class DB(object):
     def __init__(self, dbname, initialize=False):
         logger.debug("sqlite3.version = %s" % sqlite3.version)
         logger.debug("sqlite3.sqlite_version = %s" % sqlite3.sqlite_version)
         self.dbname = dbname
-        self.db = sqlite3.connect(dbname)
+        self.db = connect(dbname)
         if initialize:
             self.init()
 
-    def begin(self):
-        self.db.execute("begin immediate")
+    def begin(self, readonly=False):
+        if readonly:
+            # a deferred transaction reads from a snapshot and, under WAL,
+            # neither waits for nor blocks the writer
+            self.db.execute("begin deferred")
+        else:
+            self.db.execute("begin immediate")
 
     def commit(self):
         self.db.commit()
@@ -61,6 +115,39 @@ class ClientDB(DB):
              "primary key (cachename))")
         db.execute(Q)
 
+        Q = ("create table if not exists "
+             "fingerprints(dev integer, ino integer, size integer, "
+             "mtime real, ctime real, hash_type text, hash text, "
+             "hashes text, primary key (dev, ino))")
+        db.execute(Q)
+
+        Q = ("create table if not exists "
+             "hashmaps(objname text, etag text, block_size integer, "
+             "block_hash text, bytes integer, hashes text, "
+             "primary key (objname))")
+        db.execute(Q)
+
+        Q = ("create table if not exists "
+             "transfers(objname text, direction text, etag text, "
+             "cachename text, blocks text, updated real, "
+             "primary key (objname, direction))")
+        db.execute(Q)
+
+        Q = ("create table if not exists "
+             "inodes(dev integer, ino integer, objname text, "
+             "primary key (dev, ino))")
+        db.execute(Q)
+
+        # upstream objects by content, for server-side copies
+        Q = ("create table if not exists "
+             "contents(objname text, etag text, version text, "
+             "listed real, primary key (objname))")
+        db.execute(Q)
+
+        Q = ("create index if not exists "
+             "contents_etag on contents(etag)")
+        db.execute(Q)
+
         self.commit()
 
     def get_cachename(self, cachename):
@@ -84,45 +171,502 @@ class ClientDB(DB):
         Q = "delete from cachenames where cachename = ?"
         db.execute(Q, (cachename,))
 
+    def get_fingerprint(self, key, hash_type):
+        dev, ino, size, mtime, ctime = key
+        db = self.db
+        Q = ("select hash, hashes from fingerprints where dev = ? "
+             "and ino = ? and size = ? and mtime = ? and ctime = ? "
+             "and hash_type = ?")
+        c = db.execute(Q, (dev, ino, size, mtime, ctime, hash_type))
+        r = c.fetchone()
+        if r:
+            hashes = json.loads(r[1]) if r[1] is not None else None
+            return r[0], hashes
+        else:
+            return None
+
+    def put_fingerprint(self, key, hash_type, hash_value, hashes=None):
+        dev, ino, size, mtime, ctime = key
+        db = self.db
+        Q = ("insert or replace into fingerprints(dev, ino, size, mtime, "
+             "ctime, hash_type, hash, hashes) "
+             "values (?, ?, ?, ?, ?, ?, ?, ?)")
+        if hashes is not None:
+            hashes = json.dumps(hashes)
+        db.execute(Q, (dev, ino, size, mtime, ctime, hash_type, hash_value,
+                       hashes))
+
+    def delete_fingerprint(self, dev, ino):
+        db = self.db
+        Q = "delete from fingerprints where dev = ? and ino = ?"
+        db.execute(Q, (dev, ino))
+
+    def prune_fingerprints(self, inodes):
+        """Drop the fingerprints of the (device, inode) pairs not in
+        inodes."""
+        db = self.db
+        c = db.execute("select dev, ino from fingerprints")
+        gone = [r for r in c.fetchall() if (r[0], r[1]) not in inodes]
+        Q = "delete from fingerprints where dev = ? and ino = ?"
+        db.executemany(Q, gone)
+
+    def get_hashmap(self, objname, etag):
+        db = self.db
+        Q = ("select block_size, block_hash, bytes, hashes from hashmaps "
+             "where objname = ? and etag = ?")
+        c = db.execute(Q, (objname, etag))
+        r = c.fetchone()
+        if not r:
+            return None
+        return {"block_size": r[0],
+                "block_hash": r[1],
+                "bytes": r[2],
+                "hashes": json.loads(r[3]),
+                "hash": etag}
+
+    def put_hashmap(self, objname, etag, hashmap):
+        db = self.db
+        Q = ("insert or replace into hashmaps(objname, etag, block_size, "
+             "block_hash, bytes, hashes) values (?, ?, ?, ?, ?, ?)")
+        db.execute(Q, (objname, etag, hashmap["block_size"],
+                       hashmap["block_hash"], hashmap["bytes"],
+                       json.dumps(hashmap["hashes"])))
+
+    def delete_hashmaps(self, objnames):
+        db = self.db
+        Q = "delete from hashmaps where objname = ?"
+        db.executemany(Q, [(objname,) for objname in objnames])
+
+    def delete_hashmaps_under(self, objname):
+        db = self.db
+        clause, bounds = name_range_clause(
+            utils.join_objname(objname, ""), column="objname")
+        Q = "delete from hashmaps where %s" % clause
+        db.execute(Q, bounds)
+
+    def get_transfer(self, objname, direction):
+        db = self.db
+        Q = ("select etag, cachename, blocks, updated from transfers "
+             "where objname = ? and direction = ?")
+        c = db.execute(Q, (objname, direction))
+        r = c.fetchone()
+        if not r:
+            return None
+        return r[0], r[1], json.loads(r[2]), r[3]
+
+    def put_transfer(self, objname, direction, etag, cachename, blocks,
+                     updated):
+        db = self.db
+        Q = ("insert or replace into transfers(objname, direction, etag, "
+             "cachename, blocks, updated) values (?, ?, ?, ?, ?, ?)")
+        db.execute(Q, (objname, direction, etag, cachename,
+                       json.dumps(blocks), updated))
+
+    def delete_transfer(self, objname, direction):
+        db = self.db
+        Q = "delete from transfers where objname = ? and direction = ?"
+        db.execute(Q, (objname, direction))
+
+    def list_transfers(self):
+        db = self.db
+        Q = "select objname, direction, cachename, updated from transfers"
+        c = db.execute(Q)
+        return c.fetchall()
+
+    def list_cachenames(self, client):
+        db = self.db
+        Q = "select cachename from cachenames where client = ?"
+        c = db.execute(Q, (client,))
+        return [r[0] for r in c.fetchall()]
+
+    def put_inode(self, dev, ino, objname):
+        db = self.db
+        Q = ("insert or replace into inodes(dev, ino, objname) "
+             "values (?, ?, ?)")
+        db.execute(Q, (dev, ino, objname))
+
+    def list_inodes(self):
+        db = self.db
+        Q = "select dev, ino, objname from inodes"
+        c = db.execute(Q)
+        return dict(((r[0], r[1]), r[2]) for r in c.fetchall())
+
+    def purge_inodes(self):
+        db = self.db
+        Q = "delete from inodes"
+        db.execute(Q)
+
+    def put_content(self, objname, etag, version, tstamp):
+        db = self.db
+        Q = ("insert or replace into contents(objname, etag, version, "
+             "listed) values (?, ?, ?, ?)")
+        db.execute(Q, (objname, etag, version, tstamp))
+
+    def put_contents(self, contents, tstamp):
+        db = self.db
+        Q = ("insert or replace into contents(objname, etag, version, "
+             "listed) values (?, ?, ?, ?)")
+        db.executemany(Q, [(objname, etag, version, tstamp)
+                           for objname, etag, version in contents])
+
+    def delete_content(self, objname):
+        db = self.db
+        Q = "delete from contents where objname = ?"
+        db.execute(Q, (objname,))
+
+    def delete_contents(self, objnames):
+        db = self.db
+        Q = "delete from contents where objname = ?"
+        db.executemany(Q, [(objname,) for objname in objnames])
+
+    def delete_contents_under(self, objname):
+        db = self.db
+        clause, bounds = name_range_clause(
+            utils.join_objname(objname, ""), column="objname")
+        Q = "delete from contents where %s" % clause
+        db.execute(Q, bounds)
+
+    def prune_contents(self, tstamp):
+        """Drop the contents neither listed nor updated since tstamp."""
+        db = self.db
+        Q = "delete from contents where listed < ?"
+        db.execute(Q, (tstamp,))
+
+    def find_content(self, etag, exclude=None):
+        db = self.db
+        Q = ("select objname, version from contents where etag = ? and "
+             "objname != ? and version is not null limit 1")
+        c = db.execute(Q, (etag, exclude or ""))
+        r = c.fetchone()
+        if r:
+            return r[0], r[1]
+        return None
+
+
+class BlockStoreDB(DB):
+    def init(self):
+        logger.info("Initializing DB '%s'" % self.dbname)
+        db = self.db
+
+        Q = ("create table if not exists "
+             "blocks(hash_type text, hash text, size integer, "
+             "last_used real, primary key (hash_type, hash))")
+        db.execute(Q)
+
+        Q = ("create index if not exists "
+             "blocks_last_used on blocks(last_used)")
+        db.execute(Q)
+
+        # running total of the block sizes, kept in step by put_block and
+        # delete_block so that eviction need not sum the whole table
+        Q = ("create table if not exists "
+             "block_totals(id integer primary key check (id = 0), "
+             "size integer)")
+        db.execute(Q)
+
+        Q = ("insert or ignore into block_totals(id, size) "
+             "select 0, coalesce(sum(size), 0) from blocks")
+        db.execute(Q)
+
+        self.commit()
+
+    def _add_total_size(self, delta):
+        if delta:
+            Q = "update block_totals set size = size + ? where id = 0"
+            self.db.execute(Q, (delta,))
+
+    def get_block_size(self, hash_type, hash_value):
+        Q = "select size from blocks where hash_type = ? and hash = ?"
+        c = self.db.execute(Q, (hash_type, hash_value))
+        r = c.fetchone()
+        if r:
+            return r[0]
+        else:
+            return None
+
+    def put_block(self, hash_type, hash_value, size, tstamp):
+        old_size = self.get_block_size(hash_type, hash_value) or 0
+        Q = ("insert or replace into blocks(hash_type, hash, size, "
+             "last_used) values (?, ?, ?, ?)")
+        self.db.execute(Q, (hash_type, hash_value, size, tstamp))
+        self._add_total_size(size - old_size)
+
+    def touch_block(self, hash_type, hash_value, tstamp):
+        Q = "update blocks set last_used = ? where hash_type = ? and hash = ?"
+        self.db.execute(Q, (tstamp, hash_type, hash_value))
+
+    def delete_block(self, hash_type, hash_value):
+        size = self.get_block_size(hash_type, hash_value)
+        if size is None:
+            return
+        Q = "delete from blocks where hash_type = ? and hash = ?"
+        self.db.execute(Q, (hash_type, hash_value))
+        self._add_total_size(-size)
+
+    def get_total_block_size(self):
+        Q = "select size from block_totals where id = 0"
+        c = self.db.execute(Q)
+        r = c.fetchone()
+        return r[0] if r else 0
+
+    def list_lru_blocks(self, limit):
+        Q = ("select hash_type, hash, size from blocks "
+             "order by last_used limit ?")
+        c = self.db.execute(Q, (limit,))
+        return c.fetchall()
+
+
+SYNCER_SCHEMA_VERSION = 2
+
+# Info attributes stored in typed columns of the 'states' table, named
+# after the attribute. Any other attribute, or one whose value does not
+# have the expected type, is kept in the JSON 'extra' column.
+STATE_INFO_COLUMNS = [
+    ("localfs_type", "text", basestring),
+    ("localfs_mtime", "real", float),
+    ("localfs_size", "integer", (int, long)),
+    ("pithos_type", "text", basestring),
+    ("pithos_etag", "text", basestring),
+]
+STATE_INFO_KEYS = set(key for key, _, _ in STATE_INFO_COLUMNS)
+STATE_COLUMNS = [key for key, _, _ in STATE_INFO_COLUMNS] + ["extra"]
+NON_EMPTY_INFO = "(%s)" % " or ".join(
+    "s.%s is not null" % column for column in STATE_COLUMNS)
+MIGRATE_BATCH = 10000
+# names per query, within SQLite's default limit of 999 variables
+STATE_BATCH = 500
+
+
+def prefix_range(prefix):
+    """Return the bounds (low, high) of the names starting with prefix,
+    so that they can be looked up as a range of the name index rather
+    than with a LIKE scan. high is None if there is no upper bound."""
+    prefix = utils.to_unicode(prefix)
+    for i in range(len(prefix) - 1, -1, -1):
+        try:
+            return prefix, prefix[:i] + unichr(ord(prefix[i]) + 1)
+        except ValueError:
+            continue
+    return prefix, None
+
+
+def name_range_clause(prefix, column="o.name"):
+    low, high = prefix_range(prefix)
+    if high is None:
+        return "%s >= ?" % column, (low,)
+    return "%s >= ? and %s < ?" % (column, column), (low, high)
+
+
+def encode_info(info):
+    values = []
+    extra = {}
+    for key, _, pytype in STATE_INFO_COLUMNS:
+        value = info.get(key)
+        if value is not None and isinstance(value, pytype):
+            values.append(value)
+        else:
+            values.append(None)
+            if key in info:
+                extra[key] = value
+    for key, value in info.iteritems():
+        if key not in STATE_INFO_KEYS:
+            extra[key] = value
+    values.append(json.dumps(extra) if extra else None)
+    return tuple(values)
+
+
+def decode_info(values):
+    info = {}
+    for (key, _, _), value in zip(STATE_INFO_COLUMNS, values):
+        if value is not None:
+            info[key] = value
+    extra = values[len(STATE_INFO_COLUMNS)]
+    if extra is not None:
+        info.update(json.loads(extra))
+    return info
+
 
 class SyncerDB(DB):
+    def __init__(self, dbname, initialize=False):
+        self.archive_ids = {}
+        DB.__init__(self, dbname, initialize=initialize)
+
     def init(self):
         logger.info("Initializing DB '%s'" % self.dbname)
         db = self.db
+        # in its default mode the sqlite3 module commits before each schema
+        # statement; take control so that a failed migration rolls back
+        isolation_level = db.isolation_level
+        db.isolation_level = None
+        try:
+            db.execute("begin immediate")
+            try:
+                migrated = self.create_schema()
+            except:
+                self.rollback()
+                raise
+            self.commit()
+        finally:
+            db.isolation_level = isolation_level
+        if migrated:
+            self.compact()
+
+    def create_schema(self):
+        """Create the tables and migrate the states of an older schema.
+
+        Return whether states were migrated.
+        """
+        db = self.db
+        version = db.execute("pragma user_version").fetchone()[0]
+
+        Q = ("create table if not exists "
+             "objects(id integer primary key, name text unique, "
+             "nextserial bigint)")
+        db.execute(Q)
+
+        Q = ("create table if not exists "
+             "archive_names(id integer primary key, name text unique)")
+        db.execute(Q)
 
+        columns = "".join("%s %s, " % (key, sqltype)
+                          for key, sqltype, _ in STATE_INFO_COLUMNS)
         Q = ("create table if not exists "
-             "archives(archive text, objname text, serial integer, "
-             "info blob, primary key (archive, objname))")
+             "states(object_id integer, archive_id integer, "
+             "serial integer, %sextra text, "
+             "primary key (object_id, archive_id)) without rowid" % columns)
         db.execute(Q)
 
         Q = ("create table if not exists "
-             "serials(objname text, nextserial bigint, primary key (objname))")
+             "pending(object_id integer, archive_id integer, queued real, "
+             "primary key (object_id, archive_id)) without rowid")
+        db.execute(Q)
+
+        Q = ("create index if not exists "
+             "pending_queued on pending(queued)")
         db.execute(Q)
 
         Q = ("create table if not exists "
              "config(key text, value text, primary key (key))")
         db.execute(Q)
 
-        self.commit()
+        migrated = version < 1 and self.has_table("archives")
+        if migrated:
+            self.migrate_archives()
+        db.execute("pragma user_version = %d" % SYNCER_SCHEMA_VERSION)
+        return migrated
 
-    def new_serial(self, objname):
+    def rollback(self):
+        # ids of archive names inserted in the transaction are gone
+        self.archive_ids = {}
+        DB.rollback(self)
+
+    def has_table(self, name):
+        Q = "select name from sqlite_master where type = 'table' and name = ?"
+        c = self.db.execute(Q, (name,))
+        return c.fetchone() is not None
+
+    def migrate_archives(self):
+        """Move the states of the one-row-per-name 'archives' table to the
+        'objects' and 'states' tables and drop the old tables."""
+        logger.info("Migrating DB '%s' to schema version %s" %
+                    (self.dbname, SYNCER_SCHEMA_VERSION))
         db = self.db
-        Q = ("select nextserial from serials where objname = ?")
-        c = db.execute(Q, (objname,))
-        r = c.fetchone()
+        if self.has_table("serials"):
+            db.execute("insert or ignore into objects(name, nextserial) "
+                       "select objname, nextserial from serials")
+        db.execute("insert or ignore into objects(name, nextserial) "
+                   "select distinct objname, 0 from archives")
+        c = db.execute("select distinct archive from archives")
+        for r in c.fetchall():
+            self.get_archive_id(r[0])
+
+        Q = ("insert or replace into states(object_id, archive_id, serial, "
+             "%s) values ((select id from objects where name = ?), ?, ?, %s)"
+             % (", ".join(STATE_COLUMNS),
+                ", ".join("?" for _ in STATE_COLUMNS)))
+        c = db.execute("select archive, objname, serial, info from archives")
+        count = 0
+        while True:
+            rows = c.fetchmany(MIGRATE_BATCH)
+            if not rows:
+                break
+            db.executemany(
+                Q, [(r[1], self.get_archive_id(r[0]), r[2]) +
+                    encode_info(json.loads(r[3])) for r in rows])
+            count += len(rows)
+        db.execute("drop table archives")
+        db.execute("drop table if exists serials")
+        logger.info("Migrated %s states" % count)
+
+    def compact(self):
+        """Reclaim the space left by a migration; the DB is usable as is
+        if this fails."""
+        logger.info("Compacting DB '%s'" % self.dbname)
+        try:
+            self.db.execute("vacuum")
+        except sqlite3.Error as e:
+            logger.warning("Could not compact DB '%s': %s" %
+                           (self.dbname, e))
+
+    def get_archive_id(self, archive):
+        archive_id = self.archive_ids.get(archive)
+        if archive_id is not None:
+            return archive_id
+        db = self.db
+        Q = "select id from archive_names where name = ?"
+        r = db.execute(Q, (archive,)).fetchone()
         if r:
-            serial = r[0]
-            Q = "update serials set nextserial = ? where objname = ?"
+            archive_id = r[0]
         else:
-            serial = 0
-            Q = "insert into serials(nextserial, objname) values (?, ?)"
-        db.execute(Q, (serial + 1, objname))
+            Q = "insert into archive_names(name) values (?)"
+            archive_id = db.execute(Q, (archive,)).lastrowid
+        self.archive_ids[archive] = archive_id
+        return archive_id
+
+    def get_object_id(self, objname, create=False):
+        db = self.db
+        Q = "select id from objects where name = ?"
+        r = db.execute(Q, (objname,)).fetchone()
+        if r:
+            return r[0]
+        if not create:
+            return None
+        Q = "insert into objects(name, nextserial) values (?, 0)"
+        return db.execute(Q, (objname,)).lastrowid
+
+    def get_object_ids(self, objnames, create=False):
+        """Return a dict of the ids of the named objects."""
+        db = self.db
+        ids = {}
+        objnames = list(set(objnames))
+        for i in range(0, len(objnames), STATE_BATCH):
+            chunk = objnames[i:i + STATE_BATCH]
+            Q = ("select name, id from objects where name in (%s)" %
+                 ", ".join("?" for _ in chunk))
+            ids.update(db.execute(Q, chunk).fetchall())
+        if create:
+            Q = "insert into objects(name, nextserial) values (?, 0)"
+            for objname in objnames:
+                if objname not in ids:
+                    ids[objname] = db.execute(Q, (objname,)).lastrowid
+        return ids
+
+    def new_serial(self, objname):
+        db = self.db
+        object_id = self.get_object_id(objname, create=True)
+        Q = "select nextserial from objects where id = ?"
+        serial = db.execute(Q, (object_id,)).fetchone()[0]
+        Q = "update objects set nextserial = ? where id = ?"
+        db.execute(Q, (serial + 1, object_id))
         return serial
 
     def list_files_with_info(self, archive, info):
-        Q = ("select objname from archives where archive = ? and info = ?"
-             " order by objname")
-        c = self.db.execute(Q, (archive, info))
+        Q = ("select o.name from objects o, states s "
+             "where s.object_id = o.id and s.archive_id = ? and %s "
+             "order by o.name" %
+             " and ".join("s.%s is ?" % column for column in STATE_COLUMNS))
+        c = self.db.execute(
+            Q, (self.get_archive_id(archive),) + encode_info(info))
         fetchone = c.fetchone
         while True:
             r = fetchone()
@@ -130,10 +674,19 @@ class SyncerDB(DB):
                 break
             yield r[0]
 
-    def list_non_deleted_files(self, archive):
-        Q = ("select objname from archives where archive = ? and info != '{}'"
-             " order by objname")
-        c = self.db.execute(Q, (archive,))
+    def list_non_deleted_files(self, archive, marker=None, limit=None):
+        Q = ("select o.name from objects o, states s "
+             "where s.object_id = o.id and s.archive_id = ? and %s" %
+             NON_EMPTY_INFO)
+        tpl = (self.get_archive_id(archive),)
+        if marker is not None:
+            Q += " and o.name > ?"
+            tpl += (marker,)
+        Q += " order by o.name"
+        if limit is not None:
+            Q += " limit ?"
+            tpl += (limit,)
+        c = self.db.execute(Q, tpl)
         fetchone = c.fetchone
         while True:
             r = fetchone()
@@ -142,14 +695,15 @@ class SyncerDB(DB):
             yield r[0]
 
     def list_files(self, archive, prefix=None):
-        Q = "select objname from archives where archive = ?"
+        Q = ("select o.name from objects o, states s "
+             "where s.object_id = o.id and s.archive_id = ?")
+        tpl = (self.get_archive_id(archive),)
         if prefix is not None:
-            Q += " and objname like ?"
-            tpl = (archive, prefix + '%')
-        else:
-            tpl = (archive,)
+            clause, bounds = name_range_clause(prefix)
+            Q += " and " + clause
+            tpl += bounds
 
-        Q += " order by objname"
+        Q += " order by o.name"
         c = self.db.execute(Q, tpl)
         fetchone = c.fetchone
         while True:
@@ -159,9 +713,11 @@ class SyncerDB(DB):
             yield r[0]
 
     def get_dir_contents(self, archive, objname):
-        Q = ("select objname from archives where archive = ? and info != '{}'"
-             " and objname like ?")
-        c = self.db.execute(Q, (archive, utils.join_objname(objname, '%')))
+        clause, bounds = name_range_clause(utils.join_objname(objname, ""))
+        Q = ("select o.name from objects o, states s "
+             "where s.object_id = o.id and s.archive_id = ? and %s "
+             "and %s" % (NON_EMPTY_INFO, clause))
+        c = self.db.execute(Q, (self.get_archive_id(archive),) + bounds)
         fetchone = c.fetchone
         while True:
             r = fetchone()
@@ -169,16 +725,39 @@ class SyncerDB(DB):
                 break
             yield r[0]
 
-    def list_deciding(self, archives, sync):
-        if len(archives) == 1:
-            archive = archives[0]
-            archives = (archive, archive)
-        archives = tuple(archives)
-        Q = ("select client.objname from archives client, archives sync "
-             "where client.archive in (?, ?) and sync.archive = ? "
-             "and client.objname = sync.objname "
-             "and client.serial > sync.serial")
-        c = self.db.execute(Q, archives + (sync,))
+    def list_states_under(self, objname):
+        clause, bounds = name_range_clause(utils.join_objname(objname, ""))
+        Q = ("select a.name, o.name, s.serial, %s "
+             "from objects o, states s, archive_names a "
+             "where s.object_id = o.id and a.id = s.archive_id "
+             "and %s order by o.name" %
+             (", ".join("s.%s" % column for column in STATE_COLUMNS),
+              clause))
+        c = self.db.execute(Q, bounds)
+        return [common.FileState(archive=r[0], objname=r[1], serial=r[2],
+                                 info=decode_info(r[3:]))
+                for r in c.fetchall()]
+
+    def list_deciding(self, archives, sync, limit=None):
+        """Yield the names pending in any of the archives, earliest queued
+        first."""
+        archive_ids = tuple(self.get_archive_id(archive)
+                            for archive in archives)
+        Q = ("select o.name, min(p.queued) as queued "
+             "from pending p, states client, states sync, objects o "
+             "where p.archive_id in (%s) "
+             "and client.object_id = p.object_id "
+             "and client.archive_id = p.archive_id "
+             "and sync.object_id = p.object_id and sync.archive_id = ? "
+             "and client.serial > sync.serial "
+             "and o.id = p.object_id "
+             "group by p.object_id order by queued" %
+             ", ".join("?" for _ in archive_ids))
+        tpl = archive_ids + (self.get_archive_id(sync),)
+        if limit is not None:
+            Q += " limit ?"
+            tpl += (limit,)
+        c = self.db.execute(Q, tpl)
         fetchone = c.fetchone
         while True:
             r = fetchone()
@@ -186,24 +765,101 @@ class SyncerDB(DB):
                 break
             yield r[0]
 
+    def add_pending(self, archive, objname, queued):
+        Q = ("insert or ignore into pending(object_id, archive_id, queued) "
+             "values (?, ?, ?)")
+        self.db.execute(Q, (self.get_object_id(objname, create=True),
+                            self.get_archive_id(archive), queued))
+
+    def clear_pending(self, objname, sync):
+        """Drop the pending entries of an object in the archives that are
+        no longer ahead of the sync archive."""
+        object_id = self.get_object_id(objname)
+        if object_id is None:
+            return
+        Q = ("delete from pending where object_id = ? and archive_id in "
+             "(select client.archive_id from states client, states sync "
+             "where client.object_id = ? and sync.object_id = ? "
+             "and sync.archive_id = ? and client.serial <= sync.serial)")
+        self.db.execute(Q, (object_id, object_id, object_id,
+                            self.get_archive_id(sync)))
+
+    def rebuild_pending(self, archives, sync, queued):
+        """Recompute the pending entries from the archive serials."""
+        archive_ids = tuple(self.get_archive_id(archive)
+                            for archive in archives)
+        self.db.execute("delete from pending")
+        Q = ("insert into pending(object_id, archive_id, queued) "
+             "select client.object_id, client.archive_id, ? "
+             "from states client, states sync "
+             "where client.archive_id in (%s) and sync.archive_id = ? "
+             "and client.object_id = sync.object_id "
+             "and client.serial > sync.serial" %
+             ", ".join("?" for _ in archive_ids))
+        c = self.db.execute(
+            Q, (queued,) + archive_ids + (self.get_archive_id(sync),))
+        return c.rowcount
+
     def put_state(self, state):
+        self.put_states([state])
+
+    def put_states(self, states):
+        if not states:
+            return
+        ids = self.get_object_ids([state.objname for state in states],
+                                  create=True)
         Q = ("insert or replace into "
-             "archives(archive, objname, serial, info) "
-             "values (?, ?, ?, ?)")
-        args = (state.archive, state.objname, state.serial,
-                json.dumps(state.info))
-        self.db.execute(Q, args)
+             "states(object_id, archive_id, serial, %s) "
+             "values (?, ?, ?, %s)" %
+             (", ".join(STATE_COLUMNS),
+              ", ".join("?" for _ in STATE_COLUMNS)))
+        self.db.executemany(Q, [
+            (ids[state.objname], self.get_archive_id(state.archive),
+             state.serial) + encode_info(state.info)
+            for state in states])
+
+    def get_states(self, archives, objnames):
+        """Return the states of the objects in the archives as a dict of
+        dicts, keyed by object name and then by archive."""
+        archive_names = dict((self.get_archive_id(archive), archive)
+                             for archive in archives)
+        archive_ids = list(archive_names)
+        states = dict((objname, {}) for objname in objnames)
+        objnames = list(states)
+        FileState = common.FileState
+        for i in range(0, len(objnames), STATE_BATCH):
+            chunk = objnames[i:i + STATE_BATCH]
+            Q = ("select o.name, s.archive_id, s.serial, %s "
+                 "from objects o, states s "
+                 "where o.name in (%s) and s.object_id = o.id "
+                 "and s.archive_id in (%s)" %
+                 (", ".join("s.%s" % column for column in STATE_COLUMNS),
+                  ", ".join("?" for _ in chunk),
+                  ", ".join("?" for _ in archive_ids)))
+            for r in self.db.execute(Q, chunk + archive_ids):
+                archive = archive_names[r[1]]
+                states[r[0]][archive] = FileState(
+                    archive, r[0], r[2], decode_info(r[3:]))
+        for objname, object_states in states.iteritems():
+            if len(object_states) < len(archives):
+                for archive in archives:
+                    if archive not in object_states:
+                        object_states[archive] = FileState(
+                            archive, objname, -1, {})
+        return states
 
     def _get_state(self, archive, objname):
-        Q = ("select archive, objname, serial, info from archives "
-             "where archive = ? and objname = ?")
-        c = self.db.execute(Q, (archive, objname))
+        Q = ("select s.serial, %s from objects o, states s "
+             "where o.name = ? and s.object_id = o.id "
+             "and s.archive_id = ?" %
+             ", ".join("s.%s" % column for column in STATE_COLUMNS))
+        c = self.db.execute(Q, (objname, self.get_archive_id(archive)))
         r = c.fetchone()
         if not r:
             return None
 
-        return common.FileState(archive=r[0], objname=r[1], serial=r[2],
-                                info=json.loads(r[3]))
+        return common.FileState(archive=archive, objname=objname,
+                                serial=r[0], info=decode_info(r[1:]))
 
     def get_state(self, archive, objname):
         state = self._get_state(archive, objname)
@@ -225,8 +881,9 @@ class SyncerDB(DB):
         self.db.execute(Q, (key, json.dumps(value)))
 
     def purge_archives(self):
-        self.db.execute("delete from archives")
-        self.db.execute("delete from serials")
+        self.db.execute("delete from pending")
+        self.db.execute("delete from states")
+        self.db.execute("delete from objects")
 
 
 def rand(lim):
@@ -257,8 +914,10 @@ def initialize(dbtuple):
 
 
 class TransactedConnection(object):
-    def __init__(self, dbtuple, max_wait=60, init_wait=0.4, exp_backoff=1.1):
+    def __init__(self, dbtuple, max_wait=60, init_wait=0.4, exp_backoff=1.1,
+                 readonly=False):
         self.db = get_db(dbtuple)
+        self.readonly = readonly
         self.max_wait = max_wait
         self.init_wait = init_wait
         self.exp_backoff = exp_backoff
@@ -273,7 +932,7 @@ class TransactedConnection(object):
                 calframe = inspect.getouterframes(curframe, 2)
                 caller_name = calframe[1][3]
                 tbefore = datetime.datetime.now()
-                self.db.begin()
+                self.db.begin(readonly=self.readonly)
                 tafter = datetime.datetime.now()
                 logger.debug("BEGIN %s %s" % (tafter-tbefore, caller_name))
                 return self.db
@@ -21,6 +21,47 @@ from agkyra.syncer import common, messaging
 
 class FileClient(object):
 
+    candidates_callback = None
+    rename_hints = None
+    info_prefix = None
+
+    def notify_candidates(self):
+        if self.candidates_callback is not None:
+            self.candidates_callback()
+
+    def add_candidates(self, objnames):
+        with self.probe_candidates.lock() as d:
+            for objname in objnames:
+                d[objname] = {"ident": None, "info": None}
+        self.notify_candidates()
+
+    def own_info(self, info):
+        """Return the part of a (merged) sync info owned by this client."""
+        return dict((key, value) for key, value in info.iteritems()
+                    if key.startswith(self.info_prefix))
+
+    def add_rename_hint(self, objname, old_objname):
+        logger.debug("Object '%s' may be renamed from '%s'" %
+                     (objname, old_objname))
+        with self.rename_hints.lock() as d:
+            d[objname] = old_objname
+
+    def pop_rename_hint(self, objname):
+        with self.rename_hints.lock() as d:
+            return d.pop(objname, None)
+
+    def rename_matches(self, live_info, sync_info):
+        return False
+
+    def content_fingerprint(self, state, cached_only=False):
+        """Return the content hash and size of the object in state, if
+        known, as (hash, size); either may be None.
+
+        With cached_only, content that would have to be hashed is returned
+        as (None, size).
+        """
+        return None, None
+
     def list_candidate_files(self, archive):
         raise NotImplementedError
 
@@ -48,3 +89,12 @@ class FileClient(object):
             return synced_source_state, synced_target_state
         finally:
             source_handle.unstage_file()
+
+    def start_renaming_file(self, old_target_state, target_state,
+                            old_sync_state, callback=None):
+        target_handle = self.prepare_target(target_state)
+        synced_target_state = target_handle.rename_from(
+            old_target_state, old_sync_state)
+        synced_old_target_state = old_target_state.set(info={})
+        if callback is not None:
+            callback(synced_target_state, synced_old_target_state)
@@ -19,12 +19,14 @@ import re
 import datetime
 import psutil
 import time
-import filecmp
 import shutil
 import errno
+import threading
+import select
 
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
+from watchdog.utils import UnsupportedLibc
 import logging
 
 from agkyra.syncer.file_client import FileClient
@@ -91,21 +93,255 @@ psutil_open_files = \
     (lambda proc: proc.open_files()) if psutil.version_info[0] >= 2 else \
     (lambda proc: proc.get_open_files())
 
+PROC_PATH = "/proc"
 
-def file_is_open(path):
+
+def proc_open_file_counts():
+    counts = {}
+    for pid in os.listdir(PROC_PATH):
+        if not pid.isdigit():
+            continue
+        fd_path = os.path.join(PROC_PATH, pid, "fd")
+        try:
+            fds = os.listdir(fd_path)
+        except OSError:
+            continue
+        for fd in fds:
+            try:
+                path = os.readlink(os.path.join(fd_path, fd))
+            except OSError:
+                continue
+            counts[path] = counts.get(path, 0) + 1
+    return counts
+
+
+def psutil_open_file_counts():
+    counts = {}
     for proc in psutil.process_iter():
         try:
-            flist = psutil_open_files(proc)
-            for nt in flist:
-                try:
-                    nt_path = utils.to_unicode(nt.path)
-                except UnicodeDecodeError as e:
-                    continue
-                if nt_path == path:
-                    return True
+            for nt in psutil_open_files(proc):
+                path = utils.from_unicode(nt.path)
+                counts[path] = counts.get(path, 0) + 1
         except psutil.Error:
             pass
-    return False
+    return counts
+
+
+def all_open_file_counts():
+    """Return the number of descriptors that any process holds open on
+    each (encoded) path."""
+    if utils.islinux() and os.path.isdir(PROC_PATH):
+        return proc_open_file_counts()
+    return psutil_open_file_counts()
+
+
+def all_open_files():
+    """Return the (encoded) paths of files open by any process."""
+    return set(all_open_file_counts())
+
+
+class OpenFileIndex(object):
+    """Paths open by any process, shared by all syncing threads.
+
+    The index is rebuilt from a single sweep over all processes at most
+    once every `window` seconds. A caller that needs to observe opens
+    after a given moment passes it as `fresh_after`, forcing a new sweep
+    unless one has started since. A path is never reported open based on
+    a sweep older than the call, since it may have been closed meanwhile.
+    """
+    def __init__(self, window):
+        self.window = window
+        self.lock = threading.Lock()
+        self.paths = frozenset()
+        self.swept_at = None
+
+    def _sweep(self):
+        self.swept_at = time.time()
+        self.paths = frozenset(all_open_files())
+
+    def stop(self):
+        pass
+
+    def is_open(self, path, fresh_after=None):
+        called_at = time.time()
+        path = utils.from_unicode(path)
+        with self.lock:
+            if self.swept_at is None or \
+                    called_at - self.swept_at > self.window or \
+                    (fresh_after is not None and self.swept_at < fresh_after):
+                self._sweep()
+            if path in self.paths and self.swept_at < called_at:
+                self._sweep()
+            return path in self.paths
+
+
+# A full sweep corrects the inotify counts for lost or misordered events.
+INOTIFY_RESYNC_INTERVAL = 60
+# A move out of the watched tree has no IN_MOVED_TO to pair with.
+INOTIFY_MOVE_PAIR_TIMEOUT = 1
+
+inotify_overflow = threading.local()
+
+
+def track_inotify_overflow(Inotify, overflow_mask):
+    """Record queue overflows seen by the reading thread.
+
+    Watchdog drops the IN_Q_OVERFLOW event while parsing the event
+    buffer, so the parser is wrapped to note it in a thread-local flag
+    before it is dropped.
+    """
+    parse = Inotify._parse_event_buffer
+    if getattr(parse, "tracks_overflow", False):
+        return
+
+    def parse_event_buffer(event_buffer):
+        for wd, mask, cookie, name in parse(event_buffer):
+            if wd == -1 and mask & overflow_mask:
+                inotify_overflow.seen = True
+            yield wd, mask, cookie, name
+    parse_event_buffer.tracks_overflow = True
+    Inotify._parse_event_buffer = staticmethod(parse_event_buffer)
+
+
+class InotifyOpenFileIndex(object):
+    """Paths open under a directory, as reported by inotify (Linux only).
+
+    Opens and closes are counted per path from IN_OPEN and IN_CLOSE_*
+    events, so no process scan is needed. The counts are reset from a
+    sweep of the open descriptors at start, after a queue overflow and
+    every INOTIFY_RESYNC_INTERVAL seconds, which bounds the effect of
+    lost events. Events queued during a sweep may be counted twice; this
+    errs on the side of reporting a file open until the next sweep.
+    Events are applied asynchronously, so `fresh_after` is accepted but
+    not enforced.
+    """
+    def __init__(self, root_path, resync_interval=INOTIFY_RESYNC_INTERVAL):
+        from watchdog.observers.inotify_c import Inotify, InotifyConstants
+        track_inotify_overflow(Inotify, InotifyConstants.IN_Q_OVERFLOW)
+        self.IN_OPEN = InotifyConstants.IN_OPEN
+        self.IN_CLOSE = InotifyConstants.IN_CLOSE
+        self.IN_Q_OVERFLOW = InotifyConstants.IN_Q_OVERFLOW
+        event_mask = (InotifyConstants.IN_OPEN |
+                      InotifyConstants.IN_CLOSE |
+                      InotifyConstants.IN_MOVED_FROM |
+                      InotifyConstants.IN_MOVED_TO |
+                      InotifyConstants.IN_CREATE |
+                      InotifyConstants.IN_DELETE)
+        root_path = utils.from_unicode(root_path)
+        self.prefix = utils.normalize_local_suffix(root_path)
+        self.resync_interval = resync_interval
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.moves = {}
+        self.overflowed = False
+        self.stopper = utils.Waker()
+        self.inotify = Inotify(root_path, recursive=True,
+                               event_mask=event_mask)
+        self.resync()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def resync(self):
+        counts = dict((path, count)
+                      for path, count in all_open_file_counts().iteritems()
+                      if path.startswith(self.prefix))
+        with self.lock:
+            self.counts = counts
+            self.synced_at = time.time()
+
+    def run(self):
+        try:
+            while True:
+                timeout = max(
+                    0, self.synced_at + self.resync_interval - time.time())
+                try:
+                    ready, _, _ = select.select(
+                        [self.inotify.fd, self.stopper], [], [], timeout)
+                except select.error as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if self.stopper in ready:
+                    return
+                if ready:
+                    self.read_events()
+                if self.overflowed:
+                    logger.warning("Inotify queue overflowed; "
+                                   "rescanning open files")
+                    self.overflowed = False
+                    self.resync()
+                elif time.time() - self.synced_at >= self.resync_interval:
+                    self.resync()
+        finally:
+            self.inotify.close()
+            self.stopper.close()
+
+    def read_events(self):
+        inotify_overflow.seen = False
+        events = self.inotify.read_events()
+        with self.lock:
+            if inotify_overflow.seen:
+                self.overflowed = True
+            for event in events:
+                self.handle_event(event)
+            self.expire_moves(time.time())
+
+    def handle_event(self, event, tstamp=None):
+        if event.mask & self.IN_Q_OVERFLOW:
+            self.overflowed = True
+            return
+        path = event.src_path
+        if event.is_moved_from:
+            sub = path + os.path.sep
+            moved = dict((p, n) for p, n in self.counts.iteritems()
+                         if p == path or p.startswith(sub))
+            for p in moved:
+                self.counts.pop(p)
+            if tstamp is None:
+                tstamp = time.time()
+            self.moves[event.cookie] = (path, moved, tstamp)
+        elif event.is_moved_to:
+            src_path, moved, _ = self.moves.pop(event.cookie, (None, {}, 0))
+            for p, n in moved.iteritems():
+                self.counts[path + p[len(src_path):]] = n
+        elif event.is_directory:
+            return
+        elif event.mask & self.IN_OPEN:
+            self.counts[path] = self.counts.get(path, 0) + 1
+        elif event.mask & self.IN_CLOSE:
+            count = self.counts.pop(path, 0) - 1
+            if count > 0:
+                self.counts[path] = count
+        elif event.is_delete:
+            self.counts.pop(path, None)
+
+    def expire_moves(self, tstamp):
+        for cookie, (_, _, moved_at) in self.moves.items():
+            if tstamp - moved_at > INOTIFY_MOVE_PAIR_TIMEOUT:
+                self.moves.pop(cookie)
+
+    def is_open(self, path, fresh_after=None):
+        with self.lock:
+            return utils.from_unicode(path) in self.counts
+
+    def stop(self):
+        self.stopper.set()
+        self.thread.join()
+
+
+def get_open_file_index(settings):
+    if settings.open_files_inotify:
+        if not utils.islinux():
+            logger.warning("Inotify is only available on Linux; "
+                           "scanning processes for open files")
+        else:
+            try:
+                return InotifyOpenFileIndex(settings.local_root_path)
+            except (ImportError, UnsupportedLibc, OSError) as e:
+                logger.warning("Failed to track open files with inotify: "
+                               "%s; scanning processes instead" % e)
+    return OpenFileIndex(settings.open_files_window)
 
 
 def is_iso_date(tstamp):
@@ -136,14 +372,38 @@ def eq_float(f1, f2):
     return abs(f1 - f2) < DEFAULT_MTIME_PRECISION
 
 
-def files_equal(f1, f2):
-    logger.debug("Comparing files: '%s', '%s'" % (f1, f2))
-    try:
-        return filecmp.cmp(f1, f2, shallow=False)
-    except OSError as e:
-        if e.errno in [errno.ENOENT, errno.ENOTDIR]:
-            return False
-        raise
+# Files changed this recently could change again within the timestamp
+# granularity of the filesystem; their fingerprints are not cached.
+FINGERPRINT_RACY_WINDOW = 2
+
+
+def fingerprint_key(stats):
+    return (stats.st_dev, stats.st_ino, stats.st_size,
+            stats.st_mtime, stats.st_ctime)
+
+
+def fingerprint_is_racy(stats, tstamp):
+    return tstamp - max(stats.st_mtime, stats.st_ctime) < \
+        FINGERPRINT_RACY_WINDOW
+
+
+def fingerprint_type(settings):
+    # fingerprints are Pithos object hashes for the container's blocks
+    return utils.pithos_hash_type(settings.block_size, settings.block_hash)
+
+
+def copy_and_hash(src, dest, block_size, block_hash):
+    hasher = utils.BlockHasher(block_size, block_hash)
+    with open(src, "rb") as fsrc:
+        with open(dest, "wb") as fdest:
+            while True:
+                buf = fsrc.read(utils.HASH_READ_SIZE)
+                if not buf:
+                    break
+                hasher.update(buf)
+                fdest.write(buf)
+    shutil.copystat(src, dest)
+    return hasher.hashmap()
 
 
 def info_is_unhandled(info):
@@ -272,6 +532,7 @@ class LocalfsTargetHandle(object):
         self.cache_path = settings.cache_path
         self.syncer_dbtuple = settings.syncer_dbtuple
         self.client_dbtuple = client.client_dbtuple
+        self.open_files = client.open_files
         self.mtime_lag = settings.mtime_lag
         self.target_state = target_state
         self.objname = target_state.objname
@@ -304,7 +565,7 @@ class LocalfsTargetHandle(object):
 
     def move_file(self):
         fspath = self.fspath
-        if file_is_open(fspath):
+        if self.open_files.is_open(fspath):
             raise common.BusyError("File '%s' is open. Aborting."
                                    % fspath)
 
@@ -336,9 +597,11 @@ class LocalfsTargetHandle(object):
                 raise e
 
     def hide_file(self):
+        hide_started = time.time()
         self.move_file()
         if self.hidden_filename is not None:
-            if file_is_open(self.hidden_path):
+            if self.open_files.is_open(self.hidden_path,
+                                       fresh_after=hide_started):
                 os.rename(self.hidden_path, self.fspath)
                 self.unregister_hidden_name(self.hidden_filename)
                 raise common.BusyError("File '%s' is open. Undoing." %
@@ -370,7 +633,7 @@ class LocalfsTargetHandle(object):
         info_changed = local_path_changes(self.settings,
             self.hidden_path, sync_state, unhandled_equal=False)
         if info_changed is not None and info_changed != {}:
-            if not files_equal(self.hidden_path, fetched_path):
+            if not self.client.contents_equal(self.hidden_path, fetched_path):
                 self.stash_file()
 
     def stash_file(self):
@@ -379,6 +642,7 @@ class LocalfsTargetHandle(object):
         msg = messaging.ConflictStashMessage(
             objname=self.objname, stash_name=stash_name, logger=logger)
         self.settings.messager.put(msg)
+        self.client.forget_fingerprint(self.hidden_path)
         os.rename(self.hidden_path, stash_path)
 
     def finalize(self, filepath, live_info):
@@ -405,6 +669,7 @@ class LocalfsTargetHandle(object):
         if status == LOCAL_FILE:
             try:
                 logger.debug("Cleaning up file '%s'" % filepath)
+                self.client.forget_fingerprint(filepath)
                 os.unlink(filepath)
             except:
                 pass
@@ -418,6 +683,32 @@ class LocalfsTargetHandle(object):
         self.cleanup(fetched_path)
         return self.target_state.set(info=fetched_live_info)
 
+    def rename_from(self, old_target_state, sync_state):
+        old_objname = old_target_state.objname
+        old_path = utils.join_path(self.rootpath, old_objname)
+        live_info = get_live_info(self.settings, old_path)
+        if not info_of_regular_file(live_info) or \
+                not is_info_eq(live_info, sync_state.info):
+            raise common.ChangedBusyError(
+                "File '%s' has changed; not renaming" % old_path)
+        if self.open_files.is_open(old_path):
+            raise common.OpenBusyError(
+                "File '%s' is open; not renaming" % old_path)
+        if os.path.lexists(self.fspath):
+            raise common.ConflictError("Cannot rename, '%s' exists."
+                                       % self.fspath)
+        make_dirs(os.path.dirname(self.fspath))
+        try:
+            os.rename(old_path, self.fspath)
+        except OSError as e:
+            raise common.SyncError("Cannot rename '%s' to '%s': %s" %
+                                   (old_path, self.fspath, e))
+        logger.info("Renamed '%s' to '%s'" % (old_objname, self.objname))
+        self.client.index_inode(self.objname)
+        self.settings.metrics.incr("local_renames")
+        live_info = get_live_info(self.settings, self.fspath)
+        return self.target_state.set(info=live_info)
+
 
 class LocalfsSourceHandle(object):
     def register_stage_name(self, filename):
@@ -440,13 +731,15 @@ class LocalfsSourceHandle(object):
             db.delete_cachename(stage_filename)
         self.stage_filename = None
         self.staged_path = None
+        self.staged_hashmap = None
+        self.staged_key = None
 
     def get_path_in_cache(self, name):
         return utils.join_path(self.cache_path, name)
 
     def copy_file(self):
         fspath = self.fspath
-        if file_is_open(fspath):
+        if self.open_files.is_open(fspath):
             raise common.OpenBusyError("File '%s' is open. Aborting"
                                        % fspath)
         new_registered = self.register_stage_name(fspath)
@@ -462,8 +755,15 @@ class LocalfsSourceHandle(object):
                 return
 
         logger.debug("Staging file '%s' to '%s'" % (self.objname, stage_path))
+        stats = stat_file(fspath)
+        tstamp = time.time()
+        known_hashmap = None
+        if stats is not None and not fingerprint_is_racy(stats, tstamp):
+            known_hashmap = self.client.get_known_hashmap(
+                fingerprint_key(stats))
         try:
-            shutil.copy2(fspath, stage_path)
+            method = self.copy_data(fspath, stage_path,
+                                    hashing=known_hashmap is None)
         except IOError as e:
             if e.errno in [errno.ENOENT, errno.EISDIR]:
                 logger.debug("Source is not a regular file: '%s'" % fspath)
@@ -471,14 +771,74 @@ class LocalfsSourceHandle(object):
                 return
             else:
                 raise e
+        metrics = self.settings.metrics
+        metrics.incr("staged_files.%s" % method)
+        if stats is not None:
+            metrics.incr("staged_bytes.%s" % method, stats.st_size)
+        if stats is not None and not fingerprint_is_racy(stats, tstamp):
+            key = fingerprint_key(stats)
+            new_stats = stat_file(fspath)
+            staged_stats = stat_file(stage_path)
+            # a kernel copy is not hashed on the way; only trust the stat
+            # key if the copy is complete, else compare contents later
+            if new_stats is not None and fingerprint_key(new_stats) == key \
+                    and staged_stats is not None \
+                    and staged_stats.st_size == stats.st_size:
+                self.staged_key = key
+                if known_hashmap is not None:
+                    self.staged_hashmap = known_hashmap
+                    self.settings.metrics.incr("staged_hashing_skipped")
+                elif self.staged_hashmap is not None:
+                    self.client.put_fingerprint(key, self.staged_hashmap)
+
+    def copy_data(self, fspath, stage_path, hashing=True):
+        method = self.settings.stage_method
+        try:
+            utils.copy_file_data(fspath, stage_path, method)
+            shutil.copystat(fspath, stage_path)
+        except utils.CopyMethodUnsupported:
+            method = utils.COPY_USERSPACE
+            if hashing:
+                self.staged_hashmap = copy_and_hash(
+                    fspath, stage_path,
+                    self.settings.block_size, self.settings.block_hash)
+            else:
+                shutil.copy2(fspath, stage_path)
+        logger.debug("Staged '%s' with method '%s'" % (fspath, method))
+        return method
+
+    def staged_matches_source(self):
+        if self.staged_key is not None:
+            stats = stat_file(self.fspath)
+            staged_stats = stat_file(self.staged_path)
+            if stats is not None and staged_stats is not None and \
+                    fingerprint_key(stats) == self.staged_key and \
+                    staged_stats.st_size == stats.st_size:
+                return True
+        staged_fingerprint = self.get_staged_hashmap()["hash"]
+        return staged_fingerprint == self.client.get_fingerprint(self.fspath)
+
+    def get_staged_hashmap(self):
+        settings = self.settings
+        hashmap = self.staged_hashmap
+        if hashmap is None or \
+                hashmap["block_size"] != settings.block_size or \
+                hashmap["block_hash"] != settings.block_hash:
+            hashmap = utils.hash_file(
+                self.staged_path, settings.block_size, settings.block_hash)
+            self.staged_hashmap = hashmap
+            if self.staged_key is not None:
+                self.client.put_fingerprint(self.staged_key, hashmap)
+        return hashmap
 
     def stage_file(self):
+        stage_started = time.time()
         self.copy_file()
         live_info = get_live_info(self.settings, self.fspath)
-        self.check_staged(live_info)
+        self.check_staged(live_info, stage_started)
         self.check_update_source_state(live_info)
 
-    def check_staged(self, live_info):
+    def check_staged(self, live_info, stage_started=None):
         is_reg = info_of_regular_file(live_info)
 
         if self.staged_path is None:
@@ -490,21 +850,18 @@ class LocalfsSourceHandle(object):
             return
 
         if not is_reg:
-            os.unlink(self.staged_path)
-            self.unregister_stage_name(self.stage_filename)
+            self.unstage_file()
             logger.warning("Path '%s' is not a regular file; unstaged")
             return
 
-        if file_is_open(self.fspath):
-            os.unlink(self.staged_path)
-            self.unregister_stage_name(self.stage_filename)
+        if self.open_files.is_open(self.fspath, fresh_after=stage_started):
+            self.unstage_file()
             m = "File '%s' is open; unstaged" % self.objname
             logger.warning(m)
             raise common.OpenBusyError(m)
 
-        if not files_equal(self.staged_path, self.fspath):
-            os.unlink(self.staged_path)
-            self.unregister_stage_name(self.stage_filename)
+        if not self.staged_matches_source():
+            self.unstage_file()
             m = "File '%s' contents have changed; unstaged" % self.objname
             logger.warning(m)
             raise common.ChangedBusyError(m)
@@ -520,11 +877,14 @@ class LocalfsSourceHandle(object):
         self.cache_path = settings.cache_path
         self.syncer_dbtuple = settings.syncer_dbtuple
         self.client_dbtuple = client.client_dbtuple
+        self.open_files = client.open_files
         self.source_state = source_state
         self.objname = source_state.objname
         self.fspath = utils.join_path(self.rootpath, self.objname)
         self.stage_filename = None
         self.staged_path = None
+        self.staged_hashmap = None
+        self.staged_key = None
         self.heartbeat = settings.heartbeat
         if info_of_regular_file(self.source_state.info):
             self.stage_file()
@@ -563,17 +923,21 @@ class LocalfsSourceHandle(object):
         stash_filename = mk_stash_name(self.fspath)
         logger.warning("Stashing file '%s' to '%s'" %
                        (self.fspath, stash_filename))
+        self.client.forget_fingerprint(self.staged_path)
         os.rename(self.staged_path, stash_filename)
 
     def unstage_file(self):
         if self.stage_filename is None:
             return
         staged_path = self.staged_path
+        self.client.forget_fingerprint(staged_path)
         os.unlink(staged_path)
         self.unregister_stage_name(self.stage_filename)
 
 
 class LocalfsFileClient(FileClient):
+    info_prefix = "localfs_"
+
     def __init__(self, settings):
         self.settings = settings
         self.SIGNATURE = "LocalfsFileClient"
@@ -586,6 +950,9 @@ class LocalfsFileClient(FileClient):
             dbname=utils.join_path(settings.instance_path, client_dbname))
         database.initialize(self.client_dbtuple)
         self.probe_candidates = utils.ThreadSafeDict()
+        self.rename_hints = utils.ThreadSafeDict()
+        self.pending_inodes = utils.ThreadSafeDict()
+        self.open_files = get_open_file_index(settings)
         self.check_enabled()
 
     def check_enabled(self):
@@ -614,6 +981,7 @@ class LocalfsFileClient(FileClient):
             self.settings.messager.put(msg)
             return {}
 
+        self.flush_inode_index()
         with self.probe_candidates.lock() as d:
             if forced:
                 candidates = self.walk_filesystem()
@@ -625,6 +993,7 @@ class LocalfsFileClient(FileClient):
 
     def walk_filesystem(self):
         candidates = {}
+        inodes = {}
         rootpath = utils.from_unicode(self.ROOTPATH)
         for dirpath, dirnames, files in os.walk(rootpath):
             try:
@@ -636,6 +1005,9 @@ class LocalfsFileClient(FileClient):
             if rel_dirpath != '.':
                 objname = utils.to_standard_sep(rel_dirpath)
                 candidates[objname] = self.none_info()
+                stats = stat_file(dirpath)
+                if stats is not None and not self.exclude_file(objname):
+                    inodes[(stats.st_dev, stats.st_ino)] = objname
             for filename in files:
                 try:
                     filename = utils.to_unicode(filename)
@@ -647,7 +1019,13 @@ class LocalfsFileClient(FileClient):
                     prefix = utils.to_standard_sep(rel_dirpath)
                 objname = utils.join_objname(prefix, filename)
                 candidates[objname] = self.none_info()
+                if self.exclude_file(objname):
+                    continue
+                stats = stat_file(os.path.join(dirpath, filename))
+                if stats is not None and stat.S_ISREG(stats.st_mode):
+                    inodes[(stats.st_dev, stats.st_ino)] = objname
 
+        self.rebuild_inode_index(inodes)
         db_cands = dict((name, self.none_info())
                         for name in self.list_files())
         candidates.update(db_cands)
@@ -655,8 +1033,135 @@ class LocalfsFileClient(FileClient):
         return candidates
 
     def list_files(self):
-        with TransactedConnection(self.syncer_dbtuple) as db:
-            return db.list_files(self.SIGNATURE)
+        with TransactedConnection(self.syncer_dbtuple, readonly=True) as db:
+            return list(db.list_files(self.SIGNATURE))
+
+    def rebuild_inode_index(self, inodes):
+        """Replace the (device, inode) index with the one found by a walk.
+
+        A file found under a new name while its indexed name is gone is
+        hinted as renamed. Fingerprints of inodes no longer found are
+        dropped.
+        """
+        present = set(inodes.itervalues())
+        with TransactedConnection(self.client_dbtuple) as db:
+            known = db.list_inodes()
+            db.purge_inodes()
+            for (dev, ino), objname in inodes.iteritems():
+                db.put_inode(dev, ino, objname)
+            db.prune_fingerprints(inodes)
+        for key, objname in inodes.iteritems():
+            old_objname = known.get(key)
+            if old_objname is not None and old_objname != objname and \
+                    old_objname not in present:
+                self.add_rename_hint(objname, old_objname)
+
+    def index_inode(self, objname):
+        """Queue the (device, inode) of objname for the inode index.
+
+        The queue is written out in one transaction by flush_inode_index
+        on the next probe, not on the notifier thread.
+        """
+        stats = stat_file(utils.join_path(self.ROOTPATH, objname))
+        if stats is None or not (stat.S_ISREG(stats.st_mode) or
+                                 stat.S_ISDIR(stats.st_mode)):
+            return
+        with self.pending_inodes.lock() as d:
+            d[(stats.st_dev, stats.st_ino)] = objname
+
+    def flush_inode_index(self):
+        with self.pending_inodes.lock() as d:
+            inodes = dict(d)
+            d.clear()
+        if not inodes:
+            return
+        try:
+            with TransactedConnection(self.client_dbtuple) as db:
+                for (dev, ino), objname in inodes.iteritems():
+                    db.put_inode(dev, ino, objname)
+        except common.DatabaseError:
+            logger.warning("Could not index %s inodes" % len(inodes))
+
+    def record_move(self, old_objname, objname):
+        self.index_inode(objname)
+        if self.exclude_file(objname) or self.exclude_file(old_objname):
+            return
+        self.add_rename_hint(objname, old_objname)
+
+    def content_fingerprint(self, state, cached_only=False):
+        info = state.info
+        if not info_of_regular_file(info):
+            return None, None
+        path = utils.join_path(self.ROOTPATH, state.objname)
+        if not is_info_eq(get_live_info(self.settings, path), info):
+            return None, None
+        return (self.get_fingerprint(path, cached_only=cached_only),
+                info[LOCALFS_SIZE])
+
+    def rename_matches(self, live_info, sync_info):
+        if not live_info or live_info[LOCALFS_TYPE] == common.T_UNHANDLED:
+            return False
+        return LOCALFS_TYPE in sync_info and is_info_eq(live_info, sync_info)
+
+    def put_fingerprint(self, key, hashmap):
+        with TransactedConnection(self.client_dbtuple) as db:
+            db.put_fingerprint(key, fingerprint_type(self.settings),
+                               hashmap["hash"], hashmap["hashes"])
+
+    def forget_fingerprint(self, path):
+        """Drop the fingerprint of a file about to be removed or moved
+        out of the cache."""
+        stats = stat_file(path)
+        if stats is None:
+            return
+        with TransactedConnection(self.client_dbtuple) as db:
+            db.delete_fingerprint(stats.st_dev, stats.st_ino)
+
+    def get_known_hashmap(self, key):
+        with TransactedConnection(self.client_dbtuple, readonly=True) as db:
+            r = db.get_fingerprint(key, fingerprint_type(self.settings))
+        if r is None or r[1] is None:
+            return None
+        fingerprint, hashes = r
+        return {"block_size": self.settings.block_size,
+                "block_hash": self.settings.block_hash,
+                "bytes": key[2],
+                "hashes": hashes,
+                "hash": fingerprint}
+
+    def get_fingerprint(self, path, cached_only=False):
+        stats = stat_file(path)
+        if stats is None or not stat.S_ISREG(stats.st_mode):
+            return None
+        key = fingerprint_key(stats)
+        with TransactedConnection(self.client_dbtuple, readonly=True) as db:
+            r = db.get_fingerprint(key, fingerprint_type(self.settings))
+        if r is not None:
+            return r[0]
+        if cached_only:
+            return None
+        tstamp = time.time()
+        try:
+            hashmap = utils.hash_file(
+                path, self.settings.block_size, self.settings.block_hash)
+        except IOError as e:
+            if e.errno in [errno.ENOENT, errno.EISDIR]:
+                return None
+            raise
+        if not fingerprint_is_racy(stats, tstamp):
+            self.put_fingerprint(key, hashmap)
+        return hashmap["hash"]
+
+    def contents_equal(self, path1, path2):
+        logger.debug("Comparing files: '%s', '%s'" % (path1, path2))
+        stats1 = stat_file(path1)
+        stats2 = stat_file(path2)
+        if stats1 is None or stats2 is None or \
+                stats1.st_size != stats2.st_size:
+            return False
+        fingerprint = self.get_fingerprint(path1)
+        return fingerprint is not None and \
+            fingerprint == self.get_fingerprint(path2)
 
     def _local_path_changes(self, name, state):
         local_path = utils.join_path(self.ROOTPATH, name)
@@ -700,27 +1205,33 @@ class LocalfsFileClient(FileClient):
 
     def get_dir_contents(self, objname):
         logger.debug("Getting contents for object '%s'" % objname)
-        with TransactedConnection(self.syncer_dbtuple) as db:
-            return db.get_dir_contents(self.SIGNATURE, objname)
+        with TransactedConnection(self.syncer_dbtuple, readonly=True) as db:
+            return list(db.get_dir_contents(self.SIGNATURE, objname))
 
     def notifier(self):
-        def handle_path(path, rec=False):
+        def get_objname(path):
             try:
                 path = utils.to_unicode(path)
             except UnicodeDecodeError as e:
-                return
+                return None
             if path.startswith(self.CACHEPATH):
-                return
+                return None
             rel_path = os.path.relpath(path, start=self.ROOTPATH)
             if rel_path == '.':
+                return None
+            return utils.to_standard_sep(rel_path)
+
+        def handle_path(path, rec=False):
+            objname = get_objname(path)
+            if objname is None:
                 return
-            objname = utils.to_standard_sep(rel_path)
             leaves = self.get_dir_contents(objname) if rec else None
             with self.probe_candidates.lock() as d:
                 d[objname] = self.none_info()
                 if rec:
                     for leaf in leaves:
                         d[leaf] = self.none_info()
+            self.notify_candidates()
 
         root_path = utils.from_unicode(self.ROOTPATH)
         class EventHandler(FileSystemEventHandler):
@@ -729,6 +1240,10 @@ class LocalfsFileClient(FileClient):
                 #     return
                 path = event.src_path
                 logger.debug("Handling %s" % event)
+                if not event.is_directory:
+                    objname = get_objname(path)
+                    if objname is not None:
+                        self.index_inode(objname)
                 handle_path(path)
 
             def on_deleted(this, event):
@@ -752,6 +1267,10 @@ class LocalfsFileClient(FileClient):
                 src_path = event.src_path
                 dest_path = event.dest_path
                 logger.debug("Handling %s" % event)
+                src_objname = get_objname(src_path)
+                dest_objname = get_objname(dest_path)
+                if src_objname is not None and dest_objname is not None:
+                    self.record_move(src_objname, dest_objname)
                 handle_path(src_path)
                 handle_path(dest_path)
 
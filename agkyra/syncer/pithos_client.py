@@ -16,10 +16,13 @@
 from functools import wraps
 import time
 import os
+import threading
+import errno
 import logging
 import re
 
 from agkyra.syncer import utils, common, messaging, database
+from agkyra.syncer.transfer import TransferJournal, DOWNLOAD
 from agkyra.syncer.file_client import FileClient
 from agkyra.syncer.setup import ClientError
 from agkyra.syncer.database import TransactedConnection
@@ -68,18 +71,36 @@ class PithosSourceHandle(object):
         db.insert_cachename(fetch_name, self.SIGNATURE, filename)
         return utils.join_path(self.cache_path, fetch_name)
 
+    def resume_download(self):
+        """Return the journal and path of an interrupted download of the
+        object, if its partial file is still around."""
+        journal = TransferJournal.load(
+            self.client_dbtuple, self.objname, DOWNLOAD)
+        if journal is None:
+            return None, None
+        fetched_fspath = utils.join_path(self.cache_path, journal.cachename)
+        if os.path.isfile(fetched_fspath):
+            self.fetch_name = journal.cachename
+            return journal, fetched_fspath
+        journal.discard()
+        return None, None
+
     @handle_client_errors
     def send_file(self, sync_state):
-        fetched_fspath = self.register_fetch_name(self.objname)
+        journal, fetched_fspath = self.resume_download()
+        if journal is not None:
+            logger.info("Resuming download of '%s' from '%s'" %
+                        (self.objname, fetched_fspath))
+            mode = 'rb+'
+        else:
+            fetched_fspath = self.register_fetch_name(self.objname)
+            mode = 'wb+'
         headers = dict()
-        with open(fetched_fspath, mode='wb+') as fil:
+        with open(fetched_fspath, mode=mode) as fil:
             try:
                 logger.debug("Downloading object: '%s', to: '%s'" %
                              (self.objname, fetched_fspath))
-                self.endpoint.download_object(
-                    self.objname,
-                    fil,
-                    headers=headers)
+                self.download(fil, headers, journal)
             except ClientError as e:
                 if e.status == 404:
                     actual_info = {}
@@ -92,6 +113,8 @@ class PithosSourceHandle(object):
                 actual_info = {"pithos_etag": actual_etag,
                                "pithos_type": actual_type}
             self.check_update_source_state(actual_info)
+        if journal is not None or actual_info == {}:
+            self.discard_download_journal()
         if actual_info == {}:
             logger.debug("Downloading object: '%s', object is gone."
                          % self.objname)
@@ -103,6 +126,205 @@ class PithosSourceHandle(object):
             os.mkdir(fetched_fspath)
         return fetched_fspath
 
+    def discard_download_journal(self):
+        with TransactedConnection(self.client_dbtuple) as db:
+            db.delete_transfer(self.objname, DOWNLOAD)
+
+    def download(self, fil, headers, journal=None):
+        local_path = utils.join_path(
+            self.settings.local_root_path, self.objname)
+        if not self.settings.delta_download or \
+                not os.path.isfile(local_path) or \
+                os.path.getsize(local_path) <= self.settings.block_size:
+            local_path = None
+        hashmap = self.endpoint.get_object_hashmap(
+            self.objname, headers=headers)
+        if hashmap and not object_isdir(headers):
+            self.delta_download(fil, hashmap, headers["x-object-hash"],
+                                local_path, journal)
+            return
+        headers.clear()
+        fil.seek(0)
+        fil.truncate()
+        self.endpoint.download_object(self.objname, fil, headers=headers)
+
+    def reuse_partial_blocks(self, fil, hashmap, missing, done):
+        """Keep the blocks of an interrupted download found intact in fil.
+
+        Return the indices of the blocks that still need to be fetched.
+        """
+        block_size = hashmap["block_size"]
+        block_hash = hashmap["block_hash"]
+        size = hashmap["bytes"]
+        hashes = hashmap["hashes"]
+        still_missing = []
+        for i in missing:
+            if i in done:
+                length = min(block_size, size - i * block_size)
+                fil.seek(i * block_size)
+                data = fil.read(length)
+                if len(data) == length and \
+                        utils.pithos_hash(data, block_hash) == hashes[i]:
+                    continue
+            still_missing.append(i)
+        return still_missing
+
+    def reuse_local_blocks(self, fil, hashmap, local_path, missing):
+        """Copy the missing blocks of hashmap found in the local file to fil.
+
+        Return the indices of the blocks that still need to be fetched.
+        """
+        block_size = hashmap["block_size"]
+        block_hash = hashmap["block_hash"]
+        size = hashmap["bytes"]
+        hashes = hashmap["hashes"]
+        try:
+            local_hashes = utils.hash_file(
+                local_path, block_size, block_hash)["hashes"]
+        except IOError as e:
+            logger.debug("Cannot reuse blocks of '%s': %s" % (local_path, e))
+            return missing
+        local_offsets = {}
+        for i, block in enumerate(local_hashes):
+            local_offsets.setdefault(block, i * block_size)
+        still_missing = []
+        with open(local_path, "rb") as local:
+            for i in missing:
+                block = hashes[i]
+                offset = local_offsets.get(block)
+                if offset is not None:
+                    length = min(block_size, size - i * block_size)
+                    local.seek(offset)
+                    data = local.read(length)
+                    # the local file may have changed since hashed
+                    if len(data) == length and \
+                            utils.pithos_hash(data, block_hash) == block:
+                        fil.seek(i * block_size)
+                        fil.write(data)
+                        continue
+                still_missing.append(i)
+        return still_missing
+
+    def reuse_stored_blocks(self, fil, hashmap, missing):
+        block_size = hashmap["block_size"]
+        block_hash = hashmap["block_hash"]
+        size = hashmap["bytes"]
+        hashes = hashmap["hashes"]
+        hash_type = utils.pithos_hash_type(block_size, block_hash)
+        still_missing = []
+        for i in missing:
+            length = min(block_size, size - i * block_size)
+            data = self.settings.block_store.get(
+                hash_type, block_hash, hashes[i])
+            if data is not None and len(data) == length:
+                fil.seek(i * block_size)
+                fil.write(data)
+            else:
+                still_missing.append(i)
+        return still_missing
+
+    def fetch_blocks(self, fil, hashmap, etag, missing, journal):
+        block_size = hashmap["block_size"]
+        block_hash = hashmap["block_hash"]
+        size = hashmap["bytes"]
+        hashes = hashmap["hashes"]
+        block_store = self.settings.block_store
+        hash_type = utils.pithos_hash_type(block_size, block_hash)
+        engine = self.settings.transfer
+        # keep ranges short enough to spread over all lanes
+        run_blocks = min(DOWNLOAD_RANGE_BLOCKS, max(
+            1, -(-len(missing) // engine.lanes(len(missing)))))
+        runs = []
+        for i in missing:
+            if runs and runs[-1][-1] == i - 1 and \
+                    len(runs[-1]) < run_blocks:
+                runs[-1].append(i)
+            else:
+                runs.append([i])
+        lock = threading.Lock()
+        received = [0]
+
+        def fetch_run(run):
+            start = run[0] * block_size
+            end = min((run[-1] + 1) * block_size, size)
+            engine.throttle_download(self, end - start)
+            r = self.settings.lane_endpoint().object_get(
+                self.objname,
+                data_range="bytes=%s-%s" % (start, end - 1),
+                if_etag_match=etag,
+                success=(200, 206))
+            data = r.content
+            if len(data) != end - start:
+                raise common.SyncError(
+                    "Got %s bytes of '%s' instead of %s" %
+                    (len(data), self.objname, end - start))
+            for i in run:
+                offset = (i - run[0]) * block_size
+                block = data[offset:offset + block_size]
+                if utils.pithos_hash(block, block_hash) != hashes[i]:
+                    raise common.SyncError(
+                        "Block %s of '%s' does not match its hash" %
+                        (i, self.objname))
+                if block_store is not None:
+                    block_store.put(hash_type, hashes[i], block)
+            with lock:
+                fil.seek(start)
+                fil.write(data)
+                fil.flush()
+                received[0] += len(data)
+            if len(runs) > 1:
+                journal.add(run)
+
+        failures = engine.run(fetch_run, runs)
+        if failures:
+            run, e = failures[0]
+            raise e
+        return received[0]
+
+    def delta_download(self, fil, hashmap, etag, local_path, journal=None):
+        if utils.pithos_top_hash(
+                hashmap["hashes"], hashmap["block_hash"]) != etag:
+            raise common.SyncError(
+                "Hashmap of '%s' does not match its hash '%s'" %
+                (self.objname, etag))
+        missing = range(len(hashmap["hashes"]))
+        resumed = 0
+        if journal is not None and journal.etag == etag:
+            missing = self.reuse_partial_blocks(
+                fil, hashmap, missing, journal.blocks)
+            resumed = len(hashmap["hashes"]) - len(missing)
+            logger.info("Resuming download of '%s' with %s blocks done" %
+                        (self.objname, resumed))
+        elif journal is not None:
+            # the object has changed since the interrupted download
+            fil.seek(0)
+            fil.truncate()
+            journal.reset(etag)
+        else:
+            journal = TransferJournal(
+                self.client_dbtuple, self.objname, DOWNLOAD, etag,
+                self.fetch_name)
+        if local_path is not None:
+            missing = self.reuse_local_blocks(
+                fil, hashmap, local_path, missing)
+        block_store = self.settings.block_store
+        if block_store is not None:
+            missing = self.reuse_stored_blocks(fil, hashmap, missing)
+        received = self.fetch_blocks(fil, hashmap, etag, missing, journal)
+        fil.truncate(hashmap["bytes"])
+        journal.discard()
+        if block_store is not None:
+            block_store.evict()
+        self.client.cache_hashmap(self.objname, etag, hashmap)
+        saved = max(0, hashmap["bytes"] - received)
+        metrics = self.settings.metrics
+        metrics.incr("download_bytes_received", received)
+        metrics.incr("download_bytes_saved", saved)
+        if resumed:
+            metrics.incr("download_blocks_resumed", resumed)
+        logger.info("Downloaded '%s': %s bytes received, %s bytes reused" %
+                    (self.objname, received, saved))
+
     def update_state(self, state):
         with TransactedConnection(self.syncer_dbtuple) as db:
             db.put_state(state)
@@ -127,6 +349,11 @@ STAGED_FOR_DELETION_SUFFIX = ".pithos_staged_for_deletion"
 exclude_staged_regex = ".*" + STAGED_FOR_DELETION_SUFFIX + "$"
 exclude_pattern = re.compile(exclude_staged_regex)
 
+UPLOAD_BLOCK_RETRIES = 7
+DOWNLOAD_RANGE_BLOCKS = 8
+# listed objects written to the content index per transaction
+CONTENT_INDEX_BATCH = 1000
+
 
 class PithosTargetHandle(object):
     def __init__(self, client, target_state):
@@ -134,6 +361,7 @@ class PithosTargetHandle(object):
         settings = client.settings
         self.settings = settings
         self.endpoint = settings.endpoint
+        self.client_dbtuple = client.client_dbtuple
         self.target_state = target_state
         self.target_objname = target_state.objname
         self.objname = target_state.objname
@@ -184,6 +412,170 @@ class PithosTargetHandle(object):
             if_etag_match=etag)
         return r
 
+    def upload_missing_blocks(self, fil, hashmap, missing):
+        block_size = hashmap["block_size"]
+        size = hashmap["bytes"]
+        offsets = {}
+        for i, block in enumerate(hashmap["hashes"]):
+            offsets.setdefault(block, i * block_size)
+        hmap = dict((block, (offsets[block],
+                             min(block_size, size - offsets[block])))
+                    for block in missing)
+        block_store = self.settings.block_store
+        hash_type = utils.pithos_hash_type(
+            block_size, hashmap["block_hash"])
+        engine = self.settings.transfer
+        lock = threading.Lock()
+
+        def put_block(block):
+            offset, nbytes = hmap[block]
+            with lock:
+                fil.seek(offset)
+                data = fil.read(nbytes)
+            engine.throttle_upload(self, nbytes)
+            r = self.settings.lane_endpoint().container_post(
+                update=True,
+                content_type="application/octet-stream",
+                content_length=len(data),
+                data=data,
+                format="json")
+            if r.json[0] != block:
+                raise common.SyncError(
+                    "Server hashed block of '%s' as '%s' instead of '%s'" %
+                    (self.target_objname, r.json[0], block))
+            # the block was hashed locally; keep it for later downloads
+            if block_store is not None:
+                block_store.put(hash_type, block, data)
+
+        retries = UPLOAD_BLOCK_RETRIES
+        while missing:
+            logger.debug("Uploading %s blocks of '%s'" %
+                         (len(missing), self.target_objname))
+            failures = engine.run(put_block, missing)
+            failed = [block for block, e in failures]
+            if len(failed) == len(missing):
+                retries -= 1
+                if not retries:
+                    raise ClientError(
+                        "%s blocks failed to upload" % len(failed))
+            missing = failed
+        if block_store is not None:
+            block_store.evict()
+        return sum(nbytes for offset, nbytes in hmap.itervalues())
+
+    def changed_blocks(self, hashmap, etag):
+        if etag is None:
+            return None
+        previous = self.client.get_cached_hashmap(self.target_objname, etag)
+        if previous is None or \
+                previous["block_size"] != hashmap["block_size"] or \
+                previous["block_hash"] != hashmap["block_hash"]:
+            return None
+        known = set(previous["hashes"])
+        changed = []
+        for block in hashmap["hashes"]:
+            if block not in known:
+                known.add(block)
+                changed.append(block)
+        return changed
+
+    def upload_staged(self, source_handle, etag):
+        hashmap = source_handle.get_staged_hashmap()
+        put_kwargs = dict(
+            format="json",
+            hashmap=True,
+            content_type="application/octet-stream",
+            json={"bytes": hashmap["bytes"], "hashes": hashmap["hashes"]},
+            if_etag_match=etag,
+            if_etag_not_match=None if etag else "*")
+        sent = 0
+        with open(source_handle.staged_path, mode="rb") as fil:
+            changed = self.changed_blocks(hashmap, etag)
+            if changed is not None:
+                # blocks of the previous version are already upstream
+                sent += self.upload_missing_blocks(fil, hashmap, changed)
+            # the server only reports blocks it is still missing, so an
+            # interrupted upload resumes without a journal of its own
+            r = self.endpoint.object_put(
+                self.target_objname, success=(201, 409), **put_kwargs)
+            if r.status_code == 409:
+                sent += self.upload_missing_blocks(fil, hashmap, r.json)
+                r = self.endpoint.object_put(
+                    self.target_objname, success=201, **put_kwargs)
+        synced_etag = r.headers["etag"]
+        if synced_etag != hashmap["hash"]:
+            logger.warning("Upstream etag '%s' of '%s' differs from the "
+                           "computed hash '%s'" %
+                           (synced_etag, self.target_objname,
+                            hashmap["hash"]))
+        self.client.cache_hashmap(self.target_objname, synced_etag, hashmap)
+        saved = max(0, hashmap["bytes"] - sent)
+        metrics = self.settings.metrics
+        metrics.incr("upload_bytes_sent", sent)
+        metrics.incr("upload_bytes_saved", saved)
+        logger.info("Uploaded '%s': %s bytes sent, %s bytes saved" %
+                    (self.target_objname, sent, saved))
+        return synced_etag, r.headers.get("x-object-version")
+
+    def copy_existing(self, source_handle, etag):
+        """Create the target with a server-side copy of an upstream object
+        with the same content as the staged file.
+
+        Return the synced etag and version, or None if no such object
+        version is known.
+        """
+        hashmap = source_handle.get_staged_hashmap()
+        content_hash = hashmap["hash"]
+        if not hashmap["bytes"]:
+            return None
+        source = self.client.find_content(
+            content_hash, exclude=self.target_objname)
+        if source is None:
+            return None
+        source_name, source_version = source
+        container = self.endpoint.container
+        copy_from = common.OBJECT_DIRSEP + \
+            utils.join_objname(container, source_name)
+        logger.debug("Copying upstream '%s' to '%s'" %
+                     (source_name, self.target_objname))
+        try:
+            r = self.endpoint.object_put(
+                self.target_objname,
+                copy_from=copy_from,
+                source_version=source_version,
+                content_length=0,
+                content_type="application/octet-stream",
+                if_etag_match=etag,
+                if_etag_not_match=None if etag else "*",
+                success=201)
+        except ClientError as e:
+            if e.status != 404:
+                raise
+            logger.debug("Copy source '%s' is gone" % source_name)
+            self.client.unindex_content(source_name)
+            return None
+        synced_etag = r.headers.get("etag")
+        synced_version = r.headers.get("x-object-version")
+        if synced_etag is None or synced_version is None:
+            meta = self.endpoint.get_object_info(self.target_objname)
+            synced_etag = meta["x-object-hash"]
+            synced_version = meta.get("x-object-version")
+        if synced_etag != content_hash:
+            # the source changed after it was listed
+            logger.warning("Copy of '%s' to '%s' yielded '%s' instead of "
+                           "'%s'; uploading" %
+                           (source_name, self.target_objname, synced_etag,
+                            content_hash))
+            self.client.unindex_content(source_name)
+            return self.upload_staged(source_handle, synced_etag)
+        self.client.cache_hashmap(self.target_objname, synced_etag, hashmap)
+        metrics = self.settings.metrics
+        metrics.incr("server_side_copies")
+        metrics.incr("upload_bytes_saved", hashmap["bytes"])
+        logger.info("Copied '%s' upstream from '%s'" %
+                    (self.target_objname, source_name))
+        return synced_etag, synced_version
+
     @handle_client_errors
     def pull(self, source_handle, sync_state):
         # assert isinstance(source_handle, LocalfsSourceHandle)
@@ -194,21 +586,23 @@ class PithosTargetHandle(object):
                 if etag is not None:
                     logger.debug("Deleting object '%s'" % self.target_objname)
                     self.safe_object_del(self.target_objname, etag)
+                    self.client.unindex_content(self.target_objname)
                 live_info = {}
             elif source_handle.info_is_dir():
                 logger.debug("Creating dir '%s'" % self.target_objname)
                 r = self.directory_put(self.target_objname, etag)
+                self.client.unindex_content(self.target_objname)
                 synced_etag = r.headers["etag"]
                 live_info = {"pithos_etag": synced_etag,
                              "pithos_type": common.T_DIR}
             else:
-                with open(source_handle.staged_path, mode="rb") as fil:
-                    r = self.endpoint.upload_object(
-                        self.target_objname,
-                        fil,
-                        if_not_exist=not(etag),
-                        if_etag_match=etag)
-                    synced_etag = r["etag"]
+                synced = self.copy_existing(source_handle, etag)
+                if synced is None:
+                    synced = self.upload_staged(source_handle, etag)
+                synced_etag, synced_version = synced
+                # replaces the entry of any overwritten version
+                self.client.index_content(
+                    self.target_objname, synced_etag, synced_version)
                 live_info = {"pithos_etag": synced_etag,
                              "pithos_type": common.T_FILE}
             return self.target_state.set(info=live_info)
@@ -221,6 +615,65 @@ class PithosTargetHandle(object):
             else:
                 raise
 
+    @handle_client_errors
+    def rename_from(self, old_target_state, sync_state):
+        old_objname = old_target_state.objname
+        etag = sync_state.info.get(PITHOS_ETAG)
+        if etag is None:
+            raise common.SyncError("No upstream etag for '%s'" % old_objname)
+        if sync_state.info.get(PITHOS_TYPE) == common.T_DIR:
+            return self.rename_dir_from(old_objname, etag)
+        container = self.endpoint.container
+        move_from = common.OBJECT_DIRSEP + \
+            utils.join_objname(container, old_objname)
+        # the preconditions of a move apply to the destination
+        r = self.endpoint.object_put(
+            self.target_objname,
+            move_from=move_from,
+            content_length=0,
+            if_etag_not_match="*",
+            success=201)
+        logger.info("Moved upstream '%s' to '%s'" %
+                    (old_objname, self.target_objname))
+        hashmap = self.client.get_cached_hashmap(old_objname, etag)
+        self.client.unindex_content(old_objname)
+        moved_etag = r.headers.get("etag", etag)
+        if moved_etag != etag:
+            # the next probe finds the new name with the changed content
+            raise common.SyncError(
+                "Upstream '%s' changed while moving it to '%s'" %
+                (old_objname, self.target_objname))
+        self.client.index_content(self.target_objname, etag,
+                                  r.headers.get("x-object-version"))
+        if hashmap is not None:
+            self.client.cache_hashmap(self.target_objname, etag, hashmap)
+        self.settings.metrics.incr("server_side_moves")
+        live_info = {PITHOS_ETAG: etag,
+                     PITHOS_TYPE: common.T_FILE}
+        return self.target_state.set(info=live_info)
+
+    def rename_dir_from(self, old_objname, etag):
+        """Move a directory and everything under it with a single
+        recursive move upstream."""
+        container = self.endpoint.container
+        move_from = common.OBJECT_DIRSEP + \
+            utils.join_objname(container, old_objname)
+        r = self.endpoint.object_put(
+            self.target_objname,
+            move_from=move_from,
+            delimiter=common.OBJECT_DIRSEP,
+            content_length=0,
+            if_etag_not_match="*",
+            success=201)
+        logger.info("Moved upstream directory '%s' to '%s'" %
+                    (old_objname, self.target_objname))
+        # the moved objects are indexed again on the next listing
+        self.client.unindex_contents_under(old_objname)
+        self.settings.metrics.incr("server_side_dir_moves")
+        live_info = {PITHOS_ETAG: r.headers.get("etag", etag),
+                     PITHOS_TYPE: common.T_DIR}
+        return self.target_state.set(info=live_info)
+
 
 def object_isdir(obj):
     try:
@@ -236,6 +689,8 @@ PITHOS_ETAG = "pithos_etag"
 
 
 class PithosFileClient(FileClient):
+    info_prefix = "pithos_"
+
     def __init__(self, settings):
         self.settings = settings
         self.SIGNATURE = "PithosFileClient"
@@ -250,9 +705,61 @@ class PithosFileClient(FileClient):
         database.initialize(self.client_dbtuple)
         self.endpoint = settings.endpoint
         self.last_modification = "0000-00-00"
+        self.container_state = None
         self.probe_candidates = utils.ThreadSafeDict()
+        self.rename_hints = utils.ThreadSafeDict()
+        self.collect_stale_transfers()
         self.check_enabled()
 
+    def collect_stale_transfers(self):
+        """Drop expired download journal entries and remove the partial
+        fetch files that no live journal entry refers to and that have not
+        been written to within the journal TTL."""
+        expired = time.time() - self.settings.transfer_journal_ttl
+        live = set()
+
+        def is_stale(cachename):
+            if cachename in live:
+                return False
+            path = utils.join_path(self.settings.cache_path, cachename)
+            try:
+                return os.lstat(path).st_mtime < expired
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                return True
+
+        with TransactedConnection(self.client_dbtuple) as db:
+            for objname, direction, cachename, updated in \
+                    db.list_transfers():
+                if updated < expired or direction != DOWNLOAD:
+                    logger.info("Dropping stale %s journal of '%s'" %
+                                (direction, objname))
+                    db.delete_transfer(objname, direction)
+                elif cachename is not None:
+                    live.add(cachename)
+            orphans = [cachename for cachename in
+                       db.list_cachenames("PithosSourceHandle")
+                       if is_stale(cachename)]
+            for cachename in orphans:
+                db.delete_cachename(cachename)
+        fetch_path = self.settings.cache_fetch_path
+        if not os.path.isdir(fetch_path):
+            return
+        for name in os.listdir(fetch_path):
+            cachename = utils.join_path(self.settings.cache_fetch_name, name)
+            if not is_stale(cachename):
+                continue
+            path = utils.join_path(fetch_path, name)
+            logger.info("Removing orphaned partial file '%s'" % path)
+            try:
+                if os.path.isdir(path):
+                    os.rmdir(path)
+                else:
+                    os.unlink(path)
+            except OSError as e:
+                logger.warning("Cannot remove '%s': %s" % (path, e))
+
     def check_enabled(self):
         if not self.settings.pithos_is_enabled():
             msg = messaging.PithosSyncDisabled(logger=logger)
@@ -277,68 +784,170 @@ class PithosFileClient(FileClient):
                 d.update(candidates)
             return d.keys()
 
+    def handle_listing_error(self, e):
+        if e.status == 404:
+            self.settings.set_pithos_enabled(False)
+            msg = messaging.PithosSyncDisabled(logger=logger)
+            self.settings.messager.put(msg)
+        elif e.status == 401:
+            msg = messaging.PithosAuthTokenError(logger=logger, exc=e)
+            self.settings.messager.put(msg)
+        else:
+            msg = messaging.PithosGenericError(logger=logger, exc=e)
+            self.settings.messager.put(msg)
+
+    def get_container_state(self):
+        try:
+            meta = self.endpoint.get_container_info()
+        except ClientError as e:
+            self.handle_listing_error(e)
+            return None
+        return (meta.get("last-modified"),
+                meta.get("x-container-object-count"))
+
+    def iter_objects(self):
+        page_size = self.settings.pithos_list_page_size
+        marker = None
+        while True:
+            objects = self.endpoint.list_objects(
+                limit=page_size, marker=marker) or []
+            for obj in objects:
+                yield obj
+            if len(objects) < page_size:
+                return
+            marker = objects[-1]["name"]
+
     def get_pithos_candidates(self, last_modified=None):
         if not self.settings.pithos_is_enabled():
             return {}
-        try:
-            objects = self.endpoint.list_objects()
-        except ClientError as e:
-            if e.status == 404:
-                self.settings.set_pithos_enabled(False)
-                msg = messaging.PithosSyncDisabled(logger=logger)
-                self.settings.messager.put(msg)
-            elif e.status == 401:
-                msg = messaging.PithosAuthTokenError(logger=logger, exc=e)
-                self.settings.messager.put(msg)
-            else:
-                msg = messaging.PithosGenericError(logger=logger, exc=e)
-                self.settings.messager.put(msg)
+        container_state = self.get_container_state()
+        if container_state is None:
             return {}
-        self.objects = objects
-        upstream_all = {}
-        for obj in objects:
-            name = obj["name"]
-            upstream_all[name] = {
-                "ident": None,
-                "info": self.get_object_live_info(obj)
-            }
-            obj_last_modified = obj["last_modified"]
-            if obj_last_modified > self.last_modification:
-                self.last_modification = obj_last_modified
-        upstream_all_names = set(upstream_all.keys())
-        if last_modified is not None:
-            upstream_modified = {}
-            for obj in objects:
+        if last_modified is not None and \
+                container_state == self.container_state:
+            logger.debug("Container unchanged since %s; skipping listing" %
+                         last_modified)
+            return {}
+        candidates = {}
+        checkpoint = [self.last_modification]
+        listing_started = time.time()
+        contents = []
+
+        def upstream_names():
+            for obj in self.iter_objects():
                 name = obj["name"]
-                if obj["last_modified"] > last_modified:
-                    upstream_modified[name] = upstream_all[name]
-            candidates = upstream_modified
-        else:
-            candidates = upstream_all
+                obj_last_modified = obj["last_modified"]
+                if obj_last_modified > checkpoint[0]:
+                    checkpoint[0] = obj_last_modified
+                if last_modified is None or obj_last_modified > last_modified:
+                    candidates[name] = {
+                        "ident": None,
+                        "info": self.get_object_live_info(obj)
+                    }
+                    self.add_listed_content(contents, obj)
+                yield name
 
-        newly_deleted = self.get_newly_deleted(upstream_all_names)
-        candidates.update(newly_deleted)
+        try:
+            newly_deleted = self.get_newly_deleted(upstream_names())
+        except ClientError as e:
+            self.handle_listing_error(e)
+            return {}
+        self.index_listed_contents(contents)
+        if last_modified is None:
+            # a complete listing indexed every object
+            self.prune_content_index(listing_started)
+        self.last_modification = checkpoint[0]
+        if newly_deleted is not None:
+            self.unindex_contents(newly_deleted)
+            self.detect_renames(candidates, newly_deleted)
+            candidates.update(newly_deleted)
+            self.container_state = container_state
         logger.debug("Candidates since %s: %s" %
                      (last_modified, candidates))
         return candidates
 
-    def get_newly_deleted(self, upstream_all_names):
+    def iter_non_deleted_files(self):
+        page_size = self.settings.pithos_list_page_size
+        marker = None
+        while True:
+            with TransactedConnection(self.syncer_dbtuple,
+                                      readonly=True) as db:
+                names = list(db.list_non_deleted_files(
+                    self.SIGNATURE, marker=marker, limit=page_size))
+            for name in names:
+                yield name
+            if len(names) < page_size:
+                return
+            marker = names[-1]
+
+    def get_newly_deleted(self, upstream_names):
         try:
-            with TransactedConnection(self.syncer_dbtuple) as db:
-                non_deleted_in_db = set(
-                    db.list_non_deleted_files(self.SIGNATURE))
+            newly_deleted_names = list(utils.sorted_difference(
+                self.iter_non_deleted_files(), upstream_names))
         except common.DatabaseError:
-            return {}
-        newly_deleted_names = non_deleted_in_db.difference(upstream_all_names)
+            for name in upstream_names:
+                pass
+            return None
+        except utils.UnsortedError as e:
+            logger.warning("Listings are not consistently ordered (%s); "
+                           "falling back to a full comparison" % e)
+            for name in upstream_names:
+                pass
+            try:
+                upstream_all_names = set(
+                    obj["name"] for obj in self.iter_objects())
+                non_deleted_in_db = set(self.iter_non_deleted_files())
+            except common.DatabaseError:
+                return None
+            newly_deleted_names = non_deleted_in_db.difference(
+                upstream_all_names)
         logger.debug("newly_deleted %s" % newly_deleted_names)
         return dict((name, {"ident": None, "info": {}})
                     for name in newly_deleted_names)
 
+    def detect_renames(self, candidates, deleted_names):
+        """Hint objects that appeared in a listing with the same etag as an
+        object that disappeared from it as renamed."""
+        if not deleted_names:
+            return
+        try:
+            with TransactedConnection(self.syncer_dbtuple,
+                                      readonly=True) as db:
+                deleted = {}
+                for name in deleted_names:
+                    info = db.get_state(self.SIGNATURE, name).info
+                    if info.get(PITHOS_TYPE) == common.T_FILE:
+                        deleted.setdefault(info[PITHOS_ETAG], []).append(name)
+                appeared = [
+                    name for name, cand in candidates.iteritems()
+                    if cand["info"] and not exclude_pattern.match(name) and
+                    cand["info"][PITHOS_TYPE] == common.T_FILE and
+                    cand["info"][PITHOS_ETAG] in deleted and
+                    db.get_state(self.SIGNATURE, name).info == {}]
+        except common.DatabaseError:
+            return
+        for name in sorted(appeared):
+            old_names = deleted[candidates[name]["info"][PITHOS_ETAG]]
+            if old_names:
+                self.add_rename_hint(name, old_names.pop())
+
+    def rename_matches(self, live_info, sync_info):
+        return live_info.get(PITHOS_TYPE) == common.T_FILE and \
+            live_info.get(PITHOS_ETAG) == sync_info.get(PITHOS_ETAG)
+
+    def content_fingerprint(self, state, cached_only=False):
+        if state.info.get(PITHOS_TYPE) != common.T_FILE:
+            return None, None
+        return state.info.get(PITHOS_ETAG), None
+
     def run_notifier(self):
         candidates = self.get_pithos_candidates(
             last_modified=self.last_modification)
+        if not candidates:
+            return
         with self.probe_candidates.lock() as d:
             d.update(candidates)
+        self.notify_candidates()
 
     def notifier(self):
         interval = self.settings.pithos_list_interval
@@ -346,6 +955,67 @@ class PithosFileClient(FileClient):
         thread.start()
         return thread
 
+    def add_listed_content(self, contents, obj):
+        """Queue a listed object for the content index, writing the queue
+        out once it is CONTENT_INDEX_BATCH long."""
+        name = obj["name"]
+        if object_isdir(obj) or name.endswith(STAGED_FOR_DELETION_SUFFIX):
+            return
+        etag = self.get_object_live_info(obj)[PITHOS_ETAG]
+        if etag is not None:
+            contents.append((name, etag, obj.get("x_object_version")))
+        if len(contents) >= CONTENT_INDEX_BATCH:
+            self.index_listed_contents(contents)
+
+    def index_listed_contents(self, contents):
+        if not contents:
+            return
+        with TransactedConnection(self.client_dbtuple) as db:
+            db.put_contents(contents, time.time())
+        del contents[:]
+
+    def prune_content_index(self, listing_started):
+        """Drop the objects that a complete listing started at
+        listing_started did not find, unless indexed since."""
+        with TransactedConnection(self.client_dbtuple) as db:
+            db.prune_contents(listing_started)
+
+    def index_content(self, objname, etag, version=None):
+        with TransactedConnection(self.client_dbtuple) as db:
+            db.put_content(objname, etag, version, time.time())
+
+    # unindexing an object also drops its cached hashmaps
+
+    def unindex_content(self, objname):
+        with TransactedConnection(self.client_dbtuple) as db:
+            db.delete_content(objname)
+            db.delete_hashmaps([objname])
+
+    def unindex_contents(self, objnames):
+        with TransactedConnection(self.client_dbtuple) as db:
+            db.delete_contents(objnames)
+            db.delete_hashmaps(objnames)
+
+    def unindex_contents_under(self, objname):
+        with TransactedConnection(self.client_dbtuple) as db:
+            db.delete_contents_under(objname)
+            db.delete_hashmaps_under(objname)
+
+    def find_content(self, etag, exclude=None):
+        """Return the name and version of an upstream object with the given
+        etag, other than exclude, or None. Objects of unknown version are
+        not returned, so that a copy never picks up later content."""
+        with TransactedConnection(self.client_dbtuple, readonly=True) as db:
+            return db.find_content(etag, exclude)
+
+    def get_cached_hashmap(self, objname, etag):
+        with TransactedConnection(self.client_dbtuple, readonly=True) as db:
+            return db.get_hashmap(objname, etag)
+
+    def cache_hashmap(self, objname, etag, hashmap):
+        with TransactedConnection(self.client_dbtuple) as db:
+            db.put_hashmap(objname, etag, hashmap)
+
     def get_object(self, objname):
         try:
             return self.endpoint.get_object_info(objname)
@@ -25,6 +25,8 @@ from functools import wraps
 from agkyra.syncer.utils import join_path, ThreadSafeDict, patch_user_agent
 from agkyra.syncer.database import TransactedConnection
 from agkyra.syncer.messaging import Messager
+from agkyra.syncer.blockstore import BlockStore
+from agkyra.syncer import transfer
 from agkyra.syncer import utils, common, database
 
 from kamaki.clients import ClientError, KamakiSSLError
@@ -44,11 +46,27 @@ DEFAULT_CACHE_STAGE_NAME = 'staged'
 DEFAULT_CACHE_FETCH_NAME = 'fetched'
 GLOBAL_SETTINGS_NAME = '.agkyra'
 DEFAULT_DBNAME = "syncer.db"
+DEFAULT_DB_SYNCHRONOUS = "normal"
+DEFAULT_DB_BUSY_TIMEOUT = 5000
+DEFAULT_DB_CACHE_SIZE = -8192
+DEFAULT_DB_MMAP_SIZE = 64 * 1024 * 1024
 DEFAULT_ACTION_MAX_WAIT = 30
 DEFAULT_PITHOS_LIST_INTERVAL = 5
+DEFAULT_PITHOS_LIST_PAGE_SIZE = 10000
 DEFAULT_CONNECTION_RETRY_LIMIT = 3
 INSTANCES_NAME = 'instances'
 DEFAULT_MAX_ALIVE_SYNC_THREADS = 25
+DEFAULT_DECIDE_SWEEP_INTERVAL = 30
+DEFAULT_DECIDE_COALESCE_WINDOW = 0.5
+DEFAULT_METRICS_LOG_INTERVAL = 300
+DEFAULT_OPEN_FILES_WINDOW = 0.5
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+DEFAULT_BLOCK_HASH = 'sha256'
+DEFAULT_BLOCK_STORE_NAME = 'blocks'
+DEFAULT_BLOCK_STORE_QUOTA = 1024 * 1024 * 1024
+DEFAULT_TRANSFER_BLOCK_CONCURRENCY = 4
+DEFAULT_MAX_INFLIGHT_BLOCK_REQUESTS = 16
+DEFAULT_TRANSFER_JOURNAL_TTL = 7 * 24 * 3600
 
 thread_local_data = threading.local()
 
@@ -118,8 +136,14 @@ class SyncerSettings():
 
         self.endpoint = self._get_pithos_client(
             auth_url, auth_token, container)
+        self.lane_endpoints = threading.local()
 
-        container_exists = self.check_container_exists(container)
+        self.block_size = DEFAULT_BLOCK_SIZE
+        self.block_hash = DEFAULT_BLOCK_HASH
+        container_meta = self.get_container_meta(container)
+        container_exists = container_meta is not None
+        if container_exists:
+            self.set_block_info(container_meta)
 
         home_dir = utils.to_unicode(os.path.expanduser('~'))
         default_settings_path = join_path(home_dir, GLOBAL_SETTINGS_NAME)
@@ -164,12 +188,20 @@ class SyncerSettings():
             dbtype=database.SyncerDB,
             dbname=self.full_dbname)
 
+        database.configure(
+            synchronous=kwargs.get("db_synchronous", DEFAULT_DB_SYNCHRONOUS),
+            busy_timeout=kwargs.get("db_busy_timeout",
+                                    DEFAULT_DB_BUSY_TIMEOUT),
+            cache_size=kwargs.get("db_cache_size", DEFAULT_DB_CACHE_SIZE),
+            mmap_size=kwargs.get("db_mmap_size", DEFAULT_DB_MMAP_SIZE))
+
         db_existed = os.path.isfile(self.full_dbname)
-        if not db_existed:
-            database.initialize(self.syncer_dbtuple)
+        # also brings an existing DB up to the current schema
+        database.initialize(self.syncer_dbtuple)
 
         self.mtime_lag = 0
         self.case_insensitive = False
+        self.stage_method = utils.COPY_USERSPACE
 
         if not db_existed:
             self.set_localfs_enabled(True)
@@ -186,16 +218,53 @@ class SyncerSettings():
                 self.set_pithos_enabled(False)
 
         self.heartbeat = ThreadSafeDict()
+        self.metrics = utils.Metrics()
         self.action_max_wait = kwargs.get("action_max_wait",
                                           DEFAULT_ACTION_MAX_WAIT)
         self.pithos_list_interval = kwargs.get("pithos_list_interval",
                                                DEFAULT_PITHOS_LIST_INTERVAL)
+        self.pithos_list_page_size = kwargs.get(
+            "pithos_list_page_size", DEFAULT_PITHOS_LIST_PAGE_SIZE)
 
         self.connection_retry_limit = kwargs.get(
             "connection_retry_limit", DEFAULT_CONNECTION_RETRY_LIMIT)
         self.endpoint.CONNECTION_RETRY_LIMIT = self.connection_retry_limit
         self.max_alive_sync_threads = kwargs.get(
             "max_alive_sync_threads", DEFAULT_MAX_ALIVE_SYNC_THREADS)
+        self.decide_sweep_interval = kwargs.get(
+            "decide_sweep_interval", DEFAULT_DECIDE_SWEEP_INTERVAL)
+        self.decide_coalesce_window = kwargs.get(
+            "decide_coalesce_window", DEFAULT_DECIDE_COALESCE_WINDOW)
+        self.metrics_log_interval = kwargs.get(
+            "metrics_log_interval", DEFAULT_METRICS_LOG_INTERVAL)
+        self.open_files_window = kwargs.get(
+            "open_files_window", DEFAULT_OPEN_FILES_WINDOW)
+        self.open_files_inotify = kwargs.get("open_files_inotify", False)
+        self.delta_download = kwargs.get("delta_download", True)
+        self.block_store = None
+        if kwargs.get("block_store", False):
+            self.block_store = BlockStore(
+                join_path(self.settings_path, DEFAULT_BLOCK_STORE_NAME),
+                kwargs.get("block_store_quota", DEFAULT_BLOCK_STORE_QUOTA),
+                self.metrics)
+        self.transfer_block_concurrency = kwargs.get(
+            "transfer_block_concurrency", DEFAULT_TRANSFER_BLOCK_CONCURRENCY)
+        self.max_inflight_block_requests = kwargs.get(
+            "max_inflight_block_requests",
+            DEFAULT_MAX_INFLIGHT_BLOCK_REQUESTS)
+        self.transfer_journal_ttl = kwargs.get(
+            "transfer_journal_ttl", DEFAULT_TRANSFER_JOURNAL_TTL)
+        self.transfer = transfer.TransferEngine(
+            self.transfer_block_concurrency,
+            self.max_inflight_block_requests,
+            self.metrics,
+            upload_limit=kwargs.get("upload_limit"),
+            download_limit=kwargs.get("download_limit"),
+            schedule=kwargs.get("bandwidth_schedule"))
+        transfer.patch_connection_pool(
+            self.max_inflight_block_requests + self.max_alive_sync_threads +
+            transfer.CONTROL_CONNECTIONS,
+            self.metrics)
         self.messager = Messager()
 
     def create_local_dirs(self):
@@ -208,6 +277,7 @@ class SyncerSettings():
         self.create_dir(self.cache_fetch_path)
         self.set_mtime_lag()
         self.set_case_insensitive()
+        self.set_stage_method()
 
     def determine_mtime_lag(self):
         st = os.stat(self.cache_path)
@@ -236,6 +306,11 @@ class SyncerSettings():
         logger.info("Filesystem is case-%ssensitive" % case)
         self.case_insensitive = case_insensitive
 
+    def set_stage_method(self):
+        method = utils.probe_copy_method(self.cache_stage_path)
+        logger.info("Staging files with method '%s'" % method)
+        self.stage_method = method
+
     def create_dir(self, path, mode=0777):
         if os.path.exists(path):
             if os.path.isdir(path):
@@ -265,16 +340,42 @@ class SyncerSettings():
             logger.error("Failed to initialize Pithos client")
             raise
 
-    def check_container_exists(self, container):
+    def lane_endpoint(self):
+        """Return a Pithos client of the calling thread's own.
+
+        A kamaki client keeps the headers and params of the request being
+        built in the client object, so concurrent block requests must not
+        share one. The clients only share the tracked connection pools.
+        """
+        endpoint = getattr(self.lane_endpoints, "endpoint", None)
+        if endpoint is None:
+            base = self.endpoint
+            endpoint = base.__class__(base.endpoint_url, base.token,
+                                      base.account, base.container)
+            endpoint.CONNECTION_RETRY_LIMIT = self.connection_retry_limit
+            self.lane_endpoints.endpoint = endpoint
+        return endpoint
+
+    def get_container_meta(self, container):
         try:
-            self.endpoint.get_container_info(container)
-            return True
+            return self.endpoint.get_container_info(container)
         except ClientError as e:
             if e.status == 404:
-                return False
+                return None
             else:
                 raise
 
+    def check_container_exists(self, container):
+        return self.get_container_meta(container) is not None
+
+    def set_block_info(self, container_meta):
+        self.block_size = int(container_meta.get(
+            'x-container-block-size', DEFAULT_BLOCK_SIZE))
+        self.block_hash = container_meta.get(
+            'x-container-block-hash', DEFAULT_BLOCK_HASH)
+        logger.info("Container blocks: size %s, hash '%s'" %
+                    (self.block_size, self.block_hash))
+
     def mk_container(self, container):
         try:
             self.endpoint.create_container(container)
@@ -282,6 +383,9 @@ class SyncerSettings():
         except ClientError:
             logger.error("Failed to create container '%s'" % container)
             raise
+        container_meta = self.get_container_meta(container)
+        if container_meta is not None:
+            self.set_block_info(container_meta)
 
     def set_localfs_enabled(self, enabled):
         with TransactedConnection(self.syncer_dbtuple) as db:
@@ -298,14 +402,14 @@ class SyncerSettings():
         db.set_config("pithos_enabled", enabled)
 
     def localfs_is_enabled(self):
-        with TransactedConnection(self.syncer_dbtuple) as db:
+        with TransactedConnection(self.syncer_dbtuple, readonly=True) as db:
             return self._localfs_is_enabled(db)
 
     def _localfs_is_enabled(self, db):
         return db.get_config("localfs_enabled")
 
     def pithos_is_enabled(self):
-        with TransactedConnection(self.syncer_dbtuple) as db:
+        with TransactedConnection(self.syncer_dbtuple, readonly=True) as db:
             return self._pithos_is_enabled(db)
 
     def _pithos_is_enabled(self, db):
@@ -13,6 +13,9 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import time
+import json
+import datetime
 import threading
 import logging
 from collections import defaultdict
@@ -23,7 +26,7 @@ from agkyra.syncer.setup import SyncerSettings
 from agkyra.syncer.database import TransactedConnection
 from agkyra.syncer.localfs_client import LocalfsFileClient
 from agkyra.syncer.pithos_client import PithosFileClient
-from agkyra.syncer import messaging, utils
+from agkyra.syncer import messaging, utils, transfer
 
 logger = logging.getLogger(__name__)
 
@@ -70,11 +73,18 @@ class FileSyncer(object):
         self.clients = {self.MASTER: master, self.SLAVE: slave}
         self.notifiers = {}
         self.decide_thread = None
-        self.sync_threads = []
+        self.sync_pool = utils.WorkerPool(settings.max_alive_sync_threads)
         self.failed_serials = utils.ThreadSafeDict()
+        self.fingerprints = utils.ThreadSafeDict()
         self.sync_queue = Queue.Queue()
         self.messager = settings.messager
         self.heartbeat = self.settings.heartbeat
+        self.metrics_logged = time.time()
+        self.retry_lock = threading.Lock()
+        self.retry_timer = None
+        self.retry_due = None
+        for client in self.clients.values():
+            client.candidates_callback = self.wake_decide
 
     def thread_is_active(self, t):
         return t and t.is_alive()
@@ -117,13 +127,50 @@ class FileSyncer(object):
 
     def start_decide(self):
         if not self.decide_active:
+            self.rebuild_pending()
             self.decide_thread = self._poll_decide()
             logger.info("Started syncing")
 
+    def wake_decide(self):
+        decide_thread = self.decide_thread
+        if self.thread_is_active(decide_thread):
+            decide_thread.wake()
+
+    def wake_decide_at(self, due):
+        """Wake the decide thread at due, unless an earlier wakeup is
+        already scheduled.
+
+        Objects held back by a recent failed run are then retried as
+        soon as they are released, not at the next sweep.
+        """
+        with self.retry_lock:
+            if self.retry_due is not None and self.retry_due <= due:
+                return
+            if self.retry_timer is not None:
+                self.retry_timer.cancel()
+            delay = (due - utils.time_stamp()).total_seconds()
+            self.retry_due = due
+            self.retry_timer = threading.Timer(
+                max(0, delay), self.on_retry_due)
+            self.retry_timer.daemon = True
+            self.retry_timer.start()
+
+    def on_retry_due(self):
+        with self.retry_lock:
+            self.retry_timer = None
+            self.retry_due = None
+        self.wake_decide()
+
     def stop_decide(self, timeout=None):
         if self.decide_active:
             self.decide_thread.stop()
             logger.info("Stopped syncing")
+            self.log_metrics(forced=True)
+            with self.retry_lock:
+                if self.retry_timer is not None:
+                    self.retry_timer.cancel()
+                self.retry_timer = None
+                self.retry_due = None
             return utils.wait_joins([self.decide_thread], timeout)
         return timeout
 
@@ -132,7 +179,7 @@ class FileSyncer(object):
         return self.stop_notifiers(timeout=remaining)
 
     def wait_sync_threads(self, timeout=None):
-        return utils.wait_joins(self.sync_threads, timeout=timeout)
+        return self.sync_pool.wait(timeout=timeout)
 
     def get_next_message(self, block=False):
         return self.messager.get(block=block)
@@ -150,34 +197,64 @@ class FileSyncer(object):
         return utils.reg_name(self.settings, objname)
 
     def _probe_files(self, archive, objnames, ident):
+        with TransactedConnection(self.syncer_dbtuple, readonly=True) as db:
+            all_states = db.get_states([archive, self.SYNC], objnames)
+        states = [(all_states[objname][archive],
+                   all_states[objname][self.SYNC])
+                  for objname in objnames]
+        live_states = []
+        for db_state, ref_state in states:
+            live_state = self._do_probe_file(db_state, ref_state, ident)
+            if live_state is not None:
+                live_states.append((live_state, ref_state))
+        if not live_states:
+            return
+        changed = []
         with TransactedConnection(self.syncer_dbtuple) as db:
-            for objname in objnames:
-                self._do_probe_file(db, archive, objname, ident)
+            ref_states = db.get_states(
+                [self.SYNC], [state.objname for state, _ in live_states])
+            for live_state, ref_state in live_states:
+                objname = live_state.objname
+                if self._is_being_synced(archive, objname):
+                    continue
+                # the probe compared against a sync state that has moved on
+                if ref_states[objname][self.SYNC].serial != ref_state.serial:
+                    changed.append(objname)
+                    continue
+                self.update_file_state(db, live_state)
+        if changed:
+            logger.debug("Sync state changed while probing %s; requeuing" %
+                         changed)
+            self.clients[archive].add_candidates(changed)
 
-    def _do_probe_file(self, db, archive, objname, ident):
-        logger.debug("Probing archive: %s, object: '%s'" % (archive, objname))
-        client = self.clients[archive]
-        db_state = db.get_state(archive, objname)
-        ref_state = db.get_state(self.SYNC, objname)
+    def _is_being_synced(self, archive, objname):
         with self.heartbeat.lock() as hb:
             beat = hb.get(self.reg_name(objname))
-            if beat is not None:
-                beat_thread = beat["thread"]
-                if beat_thread is None or beat_thread.is_alive():
-                    msg = messaging.HeartbeatNoProbeMessage(
-                        archive=archive, objname=objname, heartbeat=beat,
-                        logger=logger)
-                    self.messager.put(msg)
-                    return
+            if beat is None:
+                return False
+            beat_thread = beat["thread"]
+            if beat_thread is None or beat_thread.is_alive():
+                msg = messaging.HeartbeatNoProbeMessage(
+                    archive=archive, objname=objname, heartbeat=beat,
+                    logger=logger)
+                self.messager.put(msg)
+                return True
+        return False
+
+    def _do_probe_file(self, db_state, ref_state, ident):
+        archive = db_state.archive
+        objname = db_state.objname
+        logger.debug("Probing archive: %s, object: '%s'" % (archive, objname))
+        client = self.clients[archive]
+        if self._is_being_synced(archive, objname):
+            return None
         if db_state.serial != ref_state.serial:
             msg = messaging.AlreadyProbedMessage(
                 archive=archive, objname=objname, serial=db_state.serial,
                 logger=logger)
             self.messager.put(msg)
-            return
-        live_state = client.probe_file(objname, db_state, ref_state, ident)
-        if live_state is not None:
-            self.update_file_state(db, live_state)
+            return None
+        return client.probe_file(objname, db_state, ref_state, ident)
 
     def update_file_state(self, db, live_state):
         archive = live_state.archive
@@ -194,6 +271,7 @@ class FileSyncer(object):
         new_serial = db.new_serial(objname)
         new_state = live_state.set(serial=new_serial)
         db.put_state(new_state)
+        db.add_pending(archive, objname, time.time())
         msg = messaging.UpdateMessage(
             archive=archive, objname=objname,
             serial=new_serial, old_serial=serial, logger=logger)
@@ -210,39 +288,198 @@ class FileSyncer(object):
         if slave is None:
             slave = self.SLAVE
         decisions = []
-        with TransactedConnection(self.syncer_dbtuple) as db:
+        with TransactedConnection(self.syncer_dbtuple, readonly=True) as db:
+            all_states = self._get_decision_states(
+                db, objnames, master, slave)
             for objname in objnames:
-                decision = self._dry_run_decision(db, objname, master, slave)
+                decision = self._dry_run_decision(
+                    db, objname, master, slave, states=all_states[objname])
                 decisions.append(decision)
         return decisions
 
-    def _dry_run_decision(self, db, objname, master=None, slave=None):
+    def _dry_run_decision(self, db, objname, master=None, slave=None,
+                          states=None):
         if master is None:
             master = self.MASTER
         if slave is None:
             slave = self.SLAVE
         ident = utils.time_stamp()
-        return self._do_decide_file_sync(db, objname, master, slave, ident, True)
+        return self._do_decide_file_sync(db, objname, master, slave, ident,
+                                         True, states=states)
+
+    def _get_decision_states(self, db, objnames, master, slave):
+        return db.get_states([master, slave, self.SYNC, self.DECISION],
+                             objnames)
 
     def decide_file_syncs(self, objnames, master=None, slave=None):
         if master is None:
             master = self.MASTER
         if slave is None:
             slave = self.SLAVE
+        try:
+            objnames = self.reconcile_equal_files(objnames, master, slave)
+        except common.DatabaseError:
+            return
         ident = utils.time_stamp()
         syncs = []
+        renamed = set()
         try:
             with TransactedConnection(self.syncer_dbtuple) as db:
+                for states in self._decide_renames(
+                        db, objnames, master, slave, ident):
+                    syncs.append(states)
+                    renamed.update(states[3][3])
+                objnames = [objname for objname in objnames
+                            if objname not in renamed]
+                all_states = self._get_decision_states(
+                    db, objnames, master, slave)
+                decision_states = []
                 for objname in objnames:
                     states = self._decide_file_sync(
-                        db, objname, master, slave, ident)
+                        db, objname, master, slave, ident,
+                        states=all_states[objname],
+                        decision_states=decision_states)
                     if states is not None:
                         syncs.append(states)
+                db.put_states(decision_states)
         except common.DatabaseError:
-            self.clean_heartbeat(objnames, ident)
+            self.clean_heartbeat(renamed.union(objnames), ident)
             return
         self.enqueue_syncs(syncs)
 
+    def reconcile_equal_files(self, objnames, master, slave):
+        """Mark objects that were changed on both sides to the same content
+        as synced, without staging or transferring them.
+
+        Return the objects that are left to be decided now; objects whose
+        content is still being hashed are left for the next pass. Raise
+        DatabaseError if the archives cannot be read.
+        """
+        with TransactedConnection(self.syncer_dbtuple, readonly=True) as db:
+            if not self.settings._sync_is_enabled(db):
+                return objnames
+            all_states = db.get_states(
+                [master, slave, self.SYNC, self.DECISION], objnames)
+        candidates = []
+        for objname in objnames:
+            states = all_states[objname]
+            master_state = states[master]
+            slave_state = states[slave]
+            sync_state = states[self.SYNC]
+            if states[self.DECISION].serial == sync_state.serial and \
+                    master_state.serial > sync_state.serial and \
+                    slave_state.serial > sync_state.serial and \
+                    master_state.info and slave_state.info:
+                candidates.append((master_state, slave_state))
+        if not candidates:
+            return objnames
+        with self.heartbeat.lock() as hb:
+            candidates = [(mstate, sstate) for mstate, sstate in candidates
+                          if not self._is_busy(hb, mstate.objname)]
+
+        equal = []
+        deferred = set()
+        for master_state, slave_state in candidates:
+            master_hash, master_size, hashing = \
+                self._content_fingerprint(master_state)
+            if hashing:
+                deferred.add(master_state.objname)
+                continue
+            if master_hash is None:
+                continue
+            slave_hash, slave_size, hashing = \
+                self._content_fingerprint(slave_state)
+            if hashing:
+                deferred.add(master_state.objname)
+                continue
+            if master_hash == slave_hash:
+                size = master_size if master_size is not None else slave_size
+                equal.append((master_state, slave_state, size or 0))
+
+        reconciled = set()
+        nbytes = 0
+        try:
+            with TransactedConnection(self.syncer_dbtuple) as db:
+                for master_state, slave_state, size in equal:
+                    if self._reconcile_equal_file(
+                            db, master_state, slave_state):
+                        reconciled.add(master_state.objname)
+                        nbytes += size
+        except common.DatabaseError:
+            reconciled = set()
+        if reconciled:
+            metrics = self.settings.metrics
+            metrics.incr("reconciled_files", len(reconciled))
+            metrics.incr("reconciled_bytes", nbytes)
+            logger.info("Found %s files already in sync; %s bytes not "
+                        "transferred" % (len(reconciled), nbytes))
+        if deferred:
+            logger.debug("Deferring %s files until they are hashed" %
+                         len(deferred))
+        return [objname for objname in objnames
+                if objname not in reconciled and objname not in deferred]
+
+    def _content_fingerprint(self, state):
+        """Return the content hash and size of state, and whether its
+        content is still being hashed.
+
+        Only cached fingerprints are looked up on the decide thread; on a
+        miss the content is hashed on the sync pool, which wakes the decide
+        thread when done.
+        """
+        key = (state.archive, state.objname)
+        with self.fingerprints.lock() as d:
+            entry = d.get(key)
+            if entry is not None and entry[0] == state.serial:
+                serial, done, fingerprint, size = entry
+                if not done:
+                    return None, None, True
+                d.pop(key)
+                return fingerprint, size, False
+        client = self.clients[state.archive]
+        fingerprint, size = client.content_fingerprint(state, cached_only=True)
+        if fingerprint is not None or size is None:
+            return fingerprint, size, False
+        with self.fingerprints.lock() as d:
+            d[key] = (state.serial, False, None, None)
+        self.sync_pool.submit(
+            utils.WorkerJob(self._hash_content, args=(state,)))
+        return None, None, True
+
+    def _hash_content(self, state):
+        client = self.clients[state.archive]
+        try:
+            fingerprint, size = client.content_fingerprint(state)
+        except Exception as e:
+            logger.warning("Could not hash '%s': %s" % (state.objname, e))
+            fingerprint, size = None, None
+        with self.fingerprints.lock() as d:
+            d[(state.archive, state.objname)] = \
+                (state.serial, True, fingerprint, size)
+        self.wake_decide()
+
+    def _reconcile_equal_file(self, db, master_state, slave_state):
+        objname = master_state.objname
+        master = master_state.archive
+        slave = slave_state.archive
+        states = db.get_states(
+            [master, slave, self.SYNC, self.DECISION], [objname])[objname]
+        sync_state = states[self.SYNC]
+        decision_state = states[self.DECISION]
+        if states[master] != master_state or states[slave] != slave_state or \
+                decision_state.serial != sync_state.serial:
+            return False
+        serial = max(master_state.serial, slave_state.serial)
+        sync_info = dict(master_state.info)
+        sync_info.update(slave_state.info)
+        new_sync_state = sync_state.set(serial=serial, info=sync_info)
+        db.put_states([master_state.set(serial=serial),
+                       slave_state.set(serial=serial),
+                       new_sync_state,
+                       new_sync_state.set(archive=self.DECISION)])
+        db.clear_pending(objname, self.SYNC)
+        return True
+
     def decide_file_sync(self, objname, master=None, slave=None):
         if master is None:
             master = self.MASTER
@@ -255,31 +492,162 @@ class FileSyncer(object):
             for objname in objnames:
                 beat = hb.pop(self.reg_name(objname), None)
                 if beat is None:
-                    return
+                    continue
                 if ident and ident != beat["ident"]:
                     hb[self.reg_name(objname)] = beat
                 else:
                     logger.debug("cleaning heartbeat %s, object '%s'"
                                  % (beat, objname))
 
-    def _decide_file_sync(self, db, objname, master, slave, ident):
+    def _decide_file_sync(self, db, objname, master, slave, ident,
+                          states=None, decision_states=None):
         if not self.settings._sync_is_enabled(db):
             logger.warning("Cannot decide '%s'; sync disabled." % objname)
             return
-        states = self._do_decide_file_sync(db, objname, master, slave, ident)
+        states = self._do_decide_file_sync(
+            db, objname, master, slave, ident, states=states,
+            decision_states=decision_states)
         if states is not None:
             with self.heartbeat.lock() as hb:
                 beat = {"ident": ident, "thread": None}
                 hb[self.reg_name(objname)] = beat
         return states
 
+    def _decide_renames(self, db, objnames, master, slave, ident):
+        if not self.settings._sync_is_enabled(db):
+            return []
+        renames = []
+        claimed = set()
+        # parent directories go first, to claim their contents
+        for objname in sorted(objnames, key=len):
+            for source, target in [(master, slave), (slave, master)]:
+                old_objname = self.clients[source].pop_rename_hint(objname)
+                if old_objname is None or \
+                        claimed.intersection([objname, old_objname]):
+                    continue
+                states = self._decide_rename(
+                    db, old_objname, objname, source, target, ident)
+                if states is not None:
+                    claimed.update(states[3][3])
+                    renames.append(states)
+        return renames
+
+    def _group_states_under(self, db, objname):
+        grouped = defaultdict(dict)
+        for state in db.list_states_under(objname):
+            grouped[state.objname][state.archive] = state
+        return grouped
+
+    def _renamed_contents_ok(self, old_contents, new_contents, target):
+        """Check that the contents of a renamed directory can be moved
+        along with it: nothing is pending a decision, nothing changed in
+        the target and the target has nothing under the new name."""
+        for contents in [old_contents, new_contents]:
+            for states in contents.itervalues():
+                sync_serial = states[self.SYNC].serial \
+                    if self.SYNC in states else -1
+                decision_serial = states[self.DECISION].serial \
+                    if self.DECISION in states else -1
+                if decision_serial != sync_serial:
+                    return False
+        for states in old_contents.itervalues():
+            sync_serial = states[self.SYNC].serial \
+                if self.SYNC in states else -1
+            if target in states and states[target].serial != sync_serial:
+                return False
+        for states in new_contents.itervalues():
+            if target in states and states[target].info:
+                return False
+        return True
+
+    def _is_busy(self, hb, objname):
+        beat = hb.get(self.reg_name(objname))
+        if beat is None:
+            return False
+        beat_thread = beat["thread"]
+        return beat_thread is None or beat_thread.is_alive() or \
+            utils.younger_than(beat["ident"], self.settings.action_max_wait)
+
+    def _decide_rename(self, db, old_objname, objname, source, target,
+                       ident):
+        if self.reg_name(old_objname) == self.reg_name(objname):
+            return None
+        with self.heartbeat.lock() as hb:
+            if self._is_busy(hb, objname) or self._is_busy(hb, old_objname):
+                return None
+        all_states = db.get_states([source, target, self.SYNC, self.DECISION],
+                                   [objname, old_objname])
+        states = all_states[objname]
+        source_state = states[source]
+        target_state = states[target]
+        sync_state = states[self.SYNC]
+        decision_state = states[self.DECISION]
+        old_states = all_states[old_objname]
+        old_source_state = old_states[source]
+        old_target_state = old_states[target]
+        old_sync_state = old_states[self.SYNC]
+        old_decision_state = old_states[self.DECISION]
+        if decision_state.serial != sync_state.serial or \
+                old_decision_state.serial != old_sync_state.serial:
+            return None
+        # the new name is known only to the source
+        if sync_state.info or target_state.info or \
+                source_state.serial <= sync_state.serial:
+            return None
+        # the old name is synced, unchanged in the target and deleted
+        # (or not probed yet) in the source
+        if not old_sync_state.info or \
+                old_target_state.serial != old_sync_state.serial:
+            return None
+        if old_source_state.serial != old_sync_state.serial and \
+                old_source_state.info:
+            return None
+        if not self.clients[source].rename_matches(
+                source_state.info, old_sync_state.info):
+            return None
+        old_contents = self._group_states_under(db, old_objname)
+        new_contents = self._group_states_under(db, objname)
+        if not self._renamed_contents_ok(old_contents, new_contents, target):
+            return None
+        objnames = set([objname, old_objname])
+        objnames.update(old_contents)
+        objnames.update(new_contents)
+        objnames.update(objname + name[len(old_objname):]
+                        for name in old_contents)
+        with self.heartbeat.lock() as hb:
+            if any(self._is_busy(hb, name) for name in objnames):
+                return None
+
+        if old_source_state.serial == old_sync_state.serial:
+            self.update_file_state(db, old_source_state.set(info={}))
+            old_source_state = db.get_state(source, old_objname)
+        self._make_decision_state(db, decision_state, source_state)
+        self._make_decision_state(db, old_decision_state, old_source_state)
+        with self.heartbeat.lock() as hb:
+            for name in objnames:
+                hb[self.reg_name(name)] = {"ident": ident, "thread": None}
+        logger.info("Decided to rename '%s' to '%s' in archive %s" %
+                    (old_objname, objname, target))
+        return (source_state, target_state, sync_state,
+                (old_source_state, old_target_state, old_sync_state,
+                 sorted(objnames)))
+
     def _do_decide_file_sync(self, db, objname, master, slave, ident,
-                             dry_run=False):
+                             dry_run=False, states=None,
+                             decision_states=None):
+        """Decide the sync of an object, given its states if prefetched.
+
+        New decision states are appended to decision_states, if given,
+        for the caller to store; otherwise they are stored right away.
+        """
         logger.debug("Deciding object: '%s'" % objname)
-        master_state = db.get_state(master, objname)
-        slave_state = db.get_state(slave, objname)
-        sync_state = db.get_state(self.SYNC, objname)
-        decision_state = db.get_state(self.DECISION, objname)
+        if states is None:
+            states = self._get_decision_states(
+                db, [objname], master, slave)[objname]
+        master_state = states[master]
+        slave_state = states[slave]
+        sync_state = states[self.SYNC]
+        decision_state = states[self.DECISION]
         master_serial = master_state.serial
         slave_serial = slave_state.serial
         sync_serial = sync_state.serial
@@ -307,6 +675,9 @@ class FileSyncer(object):
                         msg = messaging.HeartbeatSkipDecideMessage(
                             objname=objname, heartbeat=beat, logger=logger)
                         self.messager.put(msg)
+                        self.wake_decide_at(
+                            beat["ident"] + datetime.timedelta(
+                                seconds=self.settings.action_max_wait))
                     return None
                 logger.debug("Ignoring previous run: %s %s" %
                              (objname, beat))
@@ -337,14 +708,16 @@ class FileSyncer(object):
             if master_serial == decision_serial:  # this is a failed serial
                 return None
             if not dry_run:
-                self._make_decision_state(db, decision_state, master_state)
+                self._make_decision_state(db, decision_state, master_state,
+                                          decision_states)
             return master_state, slave_state, sync_state
         elif master_serial == sync_serial:
             if slave_serial > sync_serial:
                 if slave_serial == decision_serial:  # this is a failed serial
                     return None
                 if not dry_run:
-                    self._make_decision_state(db, decision_state, slave_state)
+                    self._make_decision_state(db, decision_state,
+                                              slave_state, decision_states)
                 return slave_state, master_state, sync_state
             elif slave_serial == sync_serial:
                 return None
@@ -356,22 +729,22 @@ class FileSyncer(object):
             raise AssertionError("Master serial %s, sync serial %s"
                                  % (master_serial, sync_serial))
 
-    def _make_decision_state(self, db, decision_state, source_state):
+    def _make_decision_state(self, db, decision_state, source_state,
+                             decision_states=None):
         new_decision_state = decision_state.set(
             serial=source_state.serial, info=source_state.info)
-        db.put_state(new_decision_state)
+        if decision_states is not None:
+            decision_states.append(new_decision_state)
+        else:
+            db.put_state(new_decision_state)
 
     def enqueue_syncs(self, syncs):
         for sync in syncs:
             self.sync_queue.put(sync)
 
     def launch_syncs(self):
-        with self.heartbeat.lock() as hb:
-            alive_threads = len([v for v in hb.values()
-                                 if v["thread"] is not None
-                                 and v["thread"].is_alive()])
         max_alive_threads = self.settings.max_alive_sync_threads
-        new_threads = max_alive_threads - alive_threads
+        new_threads = max_alive_threads - self.sync_pool.in_flight
         if new_threads > 0:
             logger.debug("Can start max %s syncs" % new_threads)
             for i in range(new_threads):
@@ -381,7 +754,8 @@ class FileSyncer(object):
                 except Queue.Empty:
                     break
 
-    def sync_file(self, source_state, target_state, sync_state):
+    def sync_file(self, source_state, target_state, sync_state,
+                  renamed=None):
         msg = messaging.SyncMessage(
             objname=source_state.objname,
             archive=source_state.archive,
@@ -389,30 +763,63 @@ class FileSyncer(object):
             info=source_state.info,
             logger=logger)
         self.messager.put(msg)
-        thread = threading.Thread(
-            target=self._sync_file,
-            args=(source_state, target_state, sync_state))
+        objnames = [source_state.objname]
+        if renamed is None:
+            job = utils.WorkerJob(
+                target=self._sync_file,
+                args=(source_state, target_state, sync_state))
+        else:
+            objnames = renamed[3]
+            job = utils.WorkerJob(
+                target=self._rename_file,
+                args=(source_state, target_state, renamed))
         with self.heartbeat.lock() as hb:
-            beat = hb.get(self.reg_name(source_state.objname))
-            if beat is None:
-                raise AssertionError("heartbeat for %s is None" %
-                                     source_state.objname)
-            assert beat["thread"] is None
-            beat["thread"] = thread
-        thread.daemon = True
-        thread.start()
-        self.sync_threads.append(thread)
+            for objname in objnames:
+                beat = hb.get(self.reg_name(objname))
+                if beat is None:
+                    raise AssertionError("heartbeat for %s is None" %
+                                         objname)
+                assert beat["thread"] is None
+                beat["thread"] = job
+        self.sync_pool.submit(job)
 
     def _sync_file(self, source_state, target_state, sync_state):
         clients = self.clients
         source_client = clients[source_state.archive]
         target_client = clients[target_state.archive]
-        with HandleSyncErrors(
-                source_state, self.messager, self.mark_as_failed):
-            source_handle = source_client.stage_file(source_state)
-            target_client.start_pulling_file(
-                source_handle, target_state, sync_state,
-                callback=self.ack_file_sync)
+        try:
+            with HandleSyncErrors(
+                    source_state, self.messager, self.mark_as_failed):
+                source_handle = source_client.stage_file(source_state)
+                target_client.start_pulling_file(
+                    source_handle, target_state, sync_state,
+                    callback=self.ack_file_sync)
+        finally:
+            # queued syncs and dependent objects can proceed now
+            self.wake_decide()
+
+    def _rename_file(self, source_state, target_state, renamed):
+        old_source_state, old_target_state, old_sync_state, objnames = \
+            renamed
+        target_client = self.clients[target_state.archive]
+
+        def fall_back(state, hard=False):
+            # the decisions stand; both objects will be synced one by one
+            self.settings.metrics.incr("renames_failed")
+            self.clean_heartbeat(objnames)
+
+        def ack(synced_target_state, synced_old_target_state):
+            self.ack_file_rename(source_state, synced_target_state,
+                                 old_source_state, synced_old_target_state,
+                                 objnames)
+
+        try:
+            with HandleSyncErrors(source_state, self.messager, fall_back):
+                target_client.start_renaming_file(
+                    old_target_state, target_state, old_sync_state,
+                    callback=ack)
+        finally:
+            self.wake_decide()
 
     def mark_as_failed(self, state, hard=False):
         serial = state.serial
@@ -424,11 +831,6 @@ class FileSyncer(object):
             with self.failed_serials.lock() as d:
                 d[(serial, objname)] = state
 
-    def update_state(self, db, old_state, new_state):
-        db.put_state(new_state)
-        # here we could do any checks needed on the old state,
-        # perhaps triggering a probe
-
     def ack_file_sync(self, synced_source_state, synced_target_state):
         with TransactedConnection(self.syncer_dbtuple) as db:
             self._ack_file_sync(db, synced_source_state, synced_target_state)
@@ -441,17 +843,80 @@ class FileSyncer(object):
             logger=logger)
         self.messager.put(msg)
 
+    def ack_file_rename(self, synced_source_state, synced_target_state,
+                        old_source_state, old_target_state, objnames):
+        source = synced_source_state.archive
+        target = synced_target_state.archive
+        objname = synced_source_state.objname
+        old_objname = old_source_state.objname
+        with TransactedConnection(self.syncer_dbtuple) as db:
+            self._ack_file_sync(db, synced_source_state, synced_target_state)
+            self._ack_file_sync(db, old_source_state, old_target_state)
+            to_probe = self._move_contents(
+                db, old_objname, objname, source, target)
+        serial = synced_source_state.serial
+        self.clean_heartbeat(objnames)
+        self.settings.metrics.incr("renames_synced")
+        if to_probe:
+            self.clients[source].add_candidates(to_probe)
+        msg = messaging.AckSyncMessage(
+            archive=target, objname=objname, serial=serial,
+            logger=logger)
+        self.messager.put(msg)
+
+    def _move_contents(self, db, old_objname, objname, source, target):
+        """Remap the archive entries under a renamed directory to the new
+        name, as synced with the content they had at their last sync.
+
+        Return the names to be probed in the source, so that any content
+        that diverged since then gets synced on its own.
+        """
+        to_probe = []
+        moved = []
+        new_states = []
+        for name, states in \
+                self._group_states_under(db, old_objname).iteritems():
+            new_name = objname + name[len(old_objname):]
+            to_probe.append(new_name)
+            sync_state = states.get(self.SYNC)
+            if sync_state is None or not sync_state.info:
+                to_probe.append(name)
+                continue
+            sync_info = sync_state.info
+            serial = db.new_serial(new_name)
+            for archive, info in [
+                    (source, self.clients[source].own_info(sync_info)),
+                    (target, self.clients[target].own_info(sync_info)),
+                    (self.SYNC, sync_info),
+                    (self.DECISION, sync_info)]:
+                new_states.append(common.FileState(
+                    archive=archive, objname=new_name, serial=serial,
+                    info=info))
+            serial = db.new_serial(name)
+            for archive in [source, target, self.SYNC, self.DECISION]:
+                new_states.append(common.FileState(
+                    archive=archive, objname=name, serial=serial, info={}))
+            moved.extend([new_name, name])
+        db.put_states(new_states)
+        for name in moved:
+            db.clear_pending(name, self.SYNC)
+        if to_probe:
+            logger.info("Moved %s entries from '%s' to '%s'" %
+                        (len(to_probe), old_objname, objname))
+            self.settings.metrics.incr("renamed_entries", len(to_probe))
+        return to_probe
+
     def _ack_file_sync(self, db, synced_source_state, synced_target_state):
         serial = synced_source_state.serial
         objname = synced_source_state.objname
-        source = synced_source_state.archive
         target = synced_target_state.archive
         tinfo = synced_target_state.info
         logger.debug("Acking archive: %s, object: '%s', serial: %s "
                      "info: %s" %
                      (target, objname, serial, tinfo))
-        decision_state = db.get_state(self.DECISION, objname)
-        sync_state = db.get_state(self.SYNC, objname)
+        states = db.get_states([self.DECISION, self.SYNC], [objname])
+        decision_state = states[objname][self.DECISION]
+        sync_state = states[objname][self.SYNC]
 
         if serial != decision_state.serial:
             raise AssertionError(
@@ -462,13 +927,8 @@ class FileSyncer(object):
                 "cannot ack: serial %s < sync serial %s" %
                 (serial, sync_state.serial))
 
-        db_source_state = db.get_state(source, objname)
-        self.update_state(db, db_source_state, synced_source_state)
-
         final_target_state = synced_target_state.set(
             serial=serial)
-        db_target_state = db.get_state(target, objname)
-        self.update_state(db, db_target_state, final_target_state)
 
         sync_info = dict(synced_source_state.info)
         sync_info.update(synced_target_state.info)
@@ -479,13 +939,25 @@ class FileSyncer(object):
         # attributes creating their own namespace, for example
         # 'localfs_mtime', 'object_store_etag'
         new_sync_state = sync_state.set(serial=serial, info=sync_info)
-        db.put_state(new_sync_state)
         new_decision_state = new_sync_state.set(archive=self.DECISION)
-        db.put_state(new_decision_state)
+        db.put_states([synced_source_state, final_target_state,
+                       new_sync_state, new_decision_state])
+        db.clear_pending(objname, self.SYNC)
 
-    def list_deciding(self, archives=None):
+    def rebuild_pending(self):
         try:
             with TransactedConnection(self.syncer_dbtuple) as db:
+                count = db.rebuild_pending((self.MASTER, self.SLAVE),
+                                           self.SYNC, time.time())
+        except common.DatabaseError:
+            logger.warning("Could not rebuild the pending objects")
+            return
+        logger.info("Found %s pending objects" % count)
+
+    def list_deciding(self, archives=None):
+        try:
+            with TransactedConnection(self.syncer_dbtuple,
+                                      readonly=True) as db:
                 return self._list_deciding(db, archives=archives)
         except common.DatabaseError:
             return set()
@@ -519,13 +991,31 @@ class FileSyncer(object):
         logger.debug("Checking candidates to sync")
         self.probe_all()
         self.decide_archive()
+        self.log_metrics()
+
+    def get_metrics(self):
+        """Return the work counters and the pooled HTTP connections."""
+        return {"counters": self.settings.metrics.snapshot(),
+                "connections": transfer.connection_stats()}
+
+    def log_metrics(self, forced=False):
+        interval = self.settings.metrics_log_interval
+        now = time.time()
+        if not forced and (not interval or
+                           now - self.metrics_logged < interval):
+            return
+        self.metrics_logged = now
+        logger.info("Metrics: %s" %
+                    json.dumps(self.get_metrics(), sort_keys=True))
 
     def probe_all(self, forced=False):
         self.probe_archive(self.MASTER, forced=forced)
         self.probe_archive(self.SLAVE, forced=forced)
 
-    def _poll_decide(self, interval=3):
-        thread = utils.StoppableThread(interval, self.decide_all_archives)
+    def _poll_decide(self):
+        thread = utils.StoppableThread(
+            self.settings.decide_sweep_interval, self.decide_all_archives,
+            coalesce=self.settings.decide_coalesce_window)
         thread.start()
         return thread
 
@@ -0,0 +1,476 @@
+# Copyright (C) 2015 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import time
+import heapq
+import datetime
+import threading
+import logging
+from collections import deque
+
+from objpool import http as objpool_http
+from kamaki.clients.utils import https
+
+from agkyra.syncer import utils
+from agkyra.syncer.database import TransactedConnection
+
+logger = logging.getLogger(__name__)
+
+# connections needed besides block requests: listing, probing, heartbeat
+CONTROL_CONNECTIONS = 4
+
+DOWNLOAD = "download"
+# seconds between journal writes while a transfer is running
+JOURNAL_FLUSH_INTERVAL = 2
+
+_pools = {}
+_pools_lock = threading.Lock()
+_pool_settings = {"size": None, "metrics": None}
+
+
+class TrackedHTTPConnectionPool(objpool_http.HTTPConnectionPool):
+    """Keep-alive HTTP connection pool that records connection reuse.
+
+    A connection counts as reused when it is handed out with its socket
+    still open from a previous request.
+    """
+
+    def __init__(self, scheme, netloc, size, metrics):
+        objpool_http.HTTPConnectionPool.__init__(
+            self, scheme, netloc, size=size)
+        self.metrics = metrics
+        self.stats_lock = threading.Lock()
+        self.live = {}
+        self.retired = {"connections": 0, "requests": 0, "reuses": 0}
+
+    def pool_get(self, *args, **kwargs):
+        conn = objpool_http.HTTPConnectionPool.pool_get(self, *args, **kwargs)
+        if conn is not None:
+            self.record_use(conn)
+        return conn
+
+    def record_use(self, conn):
+        reused = conn.sock is not None
+        with self.stats_lock:
+            stats = self.live.get(id(conn))
+            if stats is None:
+                stats = {"requests": 0, "reuses": 0}
+                self.live[id(conn)] = stats
+            stats["requests"] += 1
+            if reused:
+                stats["reuses"] += 1
+        if self.metrics is not None:
+            self.metrics.incr("http_requests")
+            if reused:
+                self.metrics.incr("http_connections_reused")
+            else:
+                self.metrics.incr("http_connections_opened")
+
+    def retire(self, conn):
+        with self.stats_lock:
+            stats = self.live.pop(id(conn), None)
+            if stats is not None:
+                self.retired["connections"] += 1
+                self.retired["requests"] += stats["requests"]
+                self.retired["reuses"] += stats["reuses"]
+
+    def _pool_verify(self, conn):
+        verified = objpool_http.HTTPConnectionPool._pool_verify(self, conn)
+        if not verified and conn is not None:
+            self.retire(conn)
+        return verified
+
+    def _pool_cleanup(self, conn):
+        closed = objpool_http.HTTPConnectionPool._pool_cleanup(self, conn)
+        if closed:
+            self.retire(conn)
+        return closed
+
+    def connection_stats(self):
+        with self.stats_lock:
+            return {
+                "scheme": self.scheme,
+                "netloc": self.netloc,
+                "size": self.size,
+                "connections": [dict(stats) for stats in
+                                self.live.itervalues()],
+                "retired": dict(self.retired),
+            }
+
+
+class TrackedHTTPConnection(objpool_http.PooledHTTPConnection):
+    """Pooled connection drawing from the shared TrackedHTTPConnectionPool
+    of its scheme and location."""
+
+    def get_pool(self):
+        kwargs = self._pool_kwargs
+        pool = kwargs.pop("pool", None)
+        if pool is not None:
+            return pool
+        key = (kwargs["scheme"], kwargs["netloc"])
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                size = _pool_settings["size"] or kwargs.get(
+                    "size", objpool_http.default_pool_size)
+                pool = TrackedHTTPConnectionPool(
+                    key[0], key[1], size, _pool_settings["metrics"])
+                _pools[key] = pool
+        return pool
+
+
+RATE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+RATE_PATTERN = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([KMG]?)B?\s*$", re.I)
+SCHEDULE_ENTRY_PATTERN = re.compile(
+    r"^\s*(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s+(\S+)\s*/\s*(\S+)\s*$")
+MINUTES_PER_DAY = 24 * 60
+
+
+def parse_rate(value):
+    """Parse a rate in bytes per second, e.g. 512K or 2M.
+
+    Zero, None and the empty string mean unlimited.
+    """
+    if value is None:
+        return 0
+    if isinstance(value, (int, long, float)):
+        rate = value
+    else:
+        m = RATE_PATTERN.match(value)
+        if m is None:
+            if not value.strip():
+                return 0
+            raise ValueError("Invalid rate '%s'" % value)
+        rate = float(m.group(1)) * RATE_UNITS[m.group(2).upper()]
+    if rate < 0:
+        raise ValueError("Invalid rate '%s'" % value)
+    return int(rate)
+
+
+def parse_schedule(value):
+    """Parse a bandwidth schedule.
+
+    The schedule is a comma-separated list of "HH:MM-HH:MM UP/DOWN"
+    entries, e.g. "08:00-18:00 512K/2M, 18:00-20:00 1M/0". A window may
+    wrap around midnight. Return a list of
+    (start_minute, end_minute, upload_rate, download_rate).
+    """
+    entries = []
+    if not value:
+        return entries
+    for entry in value.split(","):
+        if not entry.strip():
+            continue
+        m = SCHEDULE_ENTRY_PATTERN.match(entry)
+        if m is None:
+            raise ValueError("Invalid schedule entry '%s'" % entry)
+        h1, m1, h2, m2 = [int(x) for x in m.groups()[:4]]
+        if h1 > 23 or h2 > 24 or m1 > 59 or m2 > 59 or (h2 == 24 and m2):
+            raise ValueError("Invalid schedule entry '%s'" % entry)
+        entries.append((h1 * 60 + m1, h2 * 60 + m2,
+                        parse_rate(m.group(5)), parse_rate(m.group(6))))
+    return entries
+
+
+def scheduled_limits(schedule, now, default):
+    """Return the (upload, download) rates of the first schedule entry
+    whose window contains datetime now, else default."""
+    minute = now.hour * 60 + now.minute
+    for start, end, upload, download in schedule:
+        if start <= end:
+            within = start <= minute < end
+        else:
+            within = minute >= start or minute < end
+        if within:
+            return upload, download
+    return default
+
+
+def next_schedule_change(schedule, now):
+    """Return the seconds from datetime now to the next start or end of a
+    schedule window, or None if there is no schedule."""
+    if not schedule:
+        return None
+    minute = now.hour * 60 + now.minute
+    bounds = set()
+    for start, end, upload, download in schedule:
+        bounds.update([start % MINUTES_PER_DAY, end % MINUTES_PER_DAY])
+    ahead = min((bound - minute - 1) % MINUTES_PER_DAY + 1
+                for bound in bounds)
+    return ahead * 60 - now.second - now.microsecond / 1000000.0
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket shaping a byte rate.
+
+    Requests are served in start-time fair queuing order per owner, so
+    that concurrent transfers get equal shares of the budget regardless
+    of how many requests each one has queued. A request larger than the
+    burst is let through once the bucket is out of debt, leaving the
+    bucket in debt for its excess, which later requests wait to pay back.
+    A rate of zero means unlimited.
+    """
+
+    def __init__(self, rate=0):
+        self.cond = threading.Condition()
+        self.rate = rate
+        self.tokens = rate
+        self.stamp = time.time()
+        self.vtime = 0
+        self.finish_tags = {}
+        self.waiting = []
+        self.seq = 0
+
+    def set_rate(self, rate):
+        with self.cond:
+            if rate == self.rate:
+                return
+            self._refill()
+            if self.tokens < 0 and self.rate and rate:
+                # keep the time left to pay back the debt
+                self.tokens = self.tokens * rate / float(self.rate)
+            else:
+                self.tokens = min(self.tokens, rate)
+            self.rate = rate
+            self.cond.notify_all()
+
+    def _refill(self):
+        now = time.time()
+        if self.rate:
+            self.tokens = min(self.rate,
+                              self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def consume(self, owner, nbytes):
+        """Block until nbytes may be transferred on behalf of owner.
+
+        Return the seconds spent waiting.
+        """
+        with self.cond:
+            if not self.rate:
+                return 0
+            start = max(self.vtime, self.finish_tags.get(owner, 0))
+            self.finish_tags[owner] = start + nbytes
+            self.seq += 1
+            ticket = (start, self.seq)
+            heapq.heappush(self.waiting, ticket)
+            tbefore = time.time()
+            while True:
+                self._refill()
+                if not self.rate:
+                    break
+                if self.waiting[0] == ticket and self.tokens >= 0:
+                    self.tokens -= nbytes
+                    break
+                timeout = None
+                if self.tokens < 0:
+                    timeout = -self.tokens / float(self.rate)
+                self.cond.wait(timeout)
+            self.waiting.remove(ticket)
+            heapq.heapify(self.waiting)
+            self.vtime = start
+            for key, tag in self.finish_tags.items():
+                if tag <= self.vtime:
+                    del self.finish_tags[key]
+            self.cond.notify_all()
+            return time.time() - tbefore
+
+
+def patch_connection_pool(size, metrics):
+    """Route all kamaki requests through shared, tracked keep-alive pools
+    of the given size."""
+    with _pools_lock:
+        _pool_settings["size"] = size
+        _pool_settings["metrics"] = metrics
+    https.PooledHTTPConnection = TrackedHTTPConnection
+
+
+def connection_stats():
+    with _pools_lock:
+        pools = _pools.values()
+    return [pool.connection_stats() for pool in pools]
+
+
+class TransferEngine(object):
+    """Runs the block requests of file transfers in parallel.
+
+    Each transfer spreads its blocks over up to block_concurrency lanes.
+    Lanes of all transfers share a pool of max_inflight workers, which
+    caps the block requests in flight.
+    """
+
+    def __init__(self, block_concurrency, max_inflight, metrics,
+                 upload_limit=0, download_limit=0, schedule=None):
+        self.block_concurrency = max(1, block_concurrency)
+        self.max_inflight = max(1, max_inflight)
+        self.metrics = metrics
+        self.pool = utils.WorkerPool(self.max_inflight)
+        self.upload_bucket = TokenBucket()
+        self.download_bucket = TokenBucket()
+        self.limits_lock = threading.Lock()
+        self.schedule_timer = None
+        self.set_limits(upload_limit, download_limit, schedule)
+
+    def set_limits(self, upload_limit=0, download_limit=0, schedule=None):
+        """Set the upload and download rates and their schedule.
+
+        Rates and schedule are parsed with parse_rate and parse_schedule;
+        this may be called while transfers are running.
+        """
+        limits = (parse_rate(upload_limit), parse_rate(download_limit))
+        schedule = parse_schedule(schedule)
+        with self.limits_lock:
+            self.default_limits = limits
+            self.schedule = schedule
+            if self.schedule_timer is not None:
+                self.schedule_timer.cancel()
+                self.schedule_timer = None
+        logger.info("Bandwidth limits set to %s/%s bytes/s, schedule %s" %
+                    (limits[0], limits[1], schedule))
+        self.apply_limits()
+
+    def apply_limits(self, now=None):
+        now = now or datetime.datetime.now()
+        with self.limits_lock:
+            upload, download = scheduled_limits(
+                self.schedule, now, self.default_limits)
+            # apply the next window on time even if no transfer is running
+            delay = next_schedule_change(self.schedule, now)
+            if delay is not None and self.schedule_timer is None:
+                self.schedule_timer = threading.Timer(
+                    delay, self.on_schedule_change)
+                self.schedule_timer.daemon = True
+                self.schedule_timer.start()
+        self.upload_bucket.set_rate(upload)
+        self.download_bucket.set_rate(download)
+
+    def on_schedule_change(self):
+        with self.limits_lock:
+            self.schedule_timer = None
+        self.apply_limits()
+
+    def download_limited(self):
+        self.apply_limits()
+        return bool(self.download_bucket.rate)
+
+    def throttle_upload(self, owner, nbytes):
+        self._throttle(self.upload_bucket, "upload", owner, nbytes)
+
+    def throttle_download(self, owner, nbytes):
+        self._throttle(self.download_bucket, "download", owner, nbytes)
+
+    def _throttle(self, bucket, direction, owner, nbytes):
+        self.apply_limits()
+        waited = bucket.consume(owner, nbytes)
+        if waited:
+            self.metrics.incr("%s_throttled_seconds" % direction, waited)
+
+    def lanes(self, count):
+        return max(1, min(self.block_concurrency, count))
+
+    def run(self, func, items):
+        """Call func on every item and wait for all calls to finish.
+
+        Return a list of (item, exception) pairs for the failed calls.
+        """
+        pending = deque(items)
+        if not pending:
+            return []
+        failures = []
+
+        def lane():
+            while True:
+                try:
+                    item = pending.popleft()
+                except IndexError:
+                    return
+                try:
+                    func(item)
+                except Exception as e:
+                    failures.append((item, e))
+                    logger.debug("Block request for %s failed: %r" %
+                                 (item, e))
+                self.metrics.incr("block_requests")
+
+        jobs = [self.pool.submit(utils.WorkerJob(lane))
+                for i in range(self.lanes(len(pending)))]
+        for job in jobs:
+            job.join()
+        return failures
+
+
+class TransferJournal(object):
+    """Records the completed blocks of an in-flight download in the
+    client DB, so that a download interrupted by a crash or network loss
+    can be resumed.
+
+    Blocks are block indices into the partial file registered under
+    cachename. Completed blocks are written out at most every
+    JOURNAL_FLUSH_INTERVAL seconds. Uploads need no journal, since the
+    server reports the blocks it is still missing.
+    """
+
+    def __init__(self, dbtuple, objname, direction, etag,
+                 cachename=None, blocks=()):
+        self.dbtuple = dbtuple
+        self.objname = objname
+        self.direction = direction
+        self.etag = etag
+        self.cachename = cachename
+        self.blocks = set(blocks)
+        self.lock = threading.Lock()
+        self.flushed = 0
+        self.stored = False
+
+    @classmethod
+    def load(cls, dbtuple, objname, direction):
+        with TransactedConnection(dbtuple, readonly=True) as db:
+            r = db.get_transfer(objname, direction)
+        if r is None:
+            return None
+        etag, cachename, blocks, updated = r
+        journal = cls(dbtuple, objname, direction, etag, cachename, blocks)
+        journal.stored = True
+        return journal
+
+    def reset(self, etag):
+        with self.lock:
+            self.etag = etag
+            self.blocks = set()
+        self.flush()
+
+    def add(self, blocks):
+        with self.lock:
+            self.blocks.update(blocks)
+            due = time.time() - self.flushed >= JOURNAL_FLUSH_INTERVAL
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            blocks = sorted(self.blocks)
+            self.flushed = time.time()
+        with TransactedConnection(self.dbtuple) as db:
+            db.put_transfer(self.objname, self.direction, self.etag,
+                            self.cachename, blocks, self.flushed)
+        self.stored = True
+
+    def discard(self):
+        if not self.stored:
+            return
+        with TransactedConnection(self.dbtuple) as db:
+            db.delete_transfer(self.objname, self.direction)
+        self.stored = False
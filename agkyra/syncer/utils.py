@@ -21,7 +21,12 @@ import watchdog.utils
 import sys
 import logging
 import platform
-import time
+import Queue
+import errno
+import select
+import socket
+import ctypes
+import ctypes.util
 
 logger = logging.getLogger(__name__)
 
@@ -91,6 +96,84 @@ def hash_string(s):
     return hashlib.sha256(s).hexdigest()
 
 
+def pithos_hash(block, block_hash):
+    h = hashlib.new(block_hash)
+    h.update(block.rstrip('\x00'))
+    return h.hexdigest()
+
+
+def pithos_hash_type(block_size, block_hash):
+    return "pithos-%s-%s" % (block_hash, block_size)
+
+
+def pithos_top_hash(hashes, block_hash):
+    """Compute the Pithos object hash, the merkle root of its blocks."""
+    if not hashes:
+        return hashlib.new(block_hash, '').hexdigest()
+    if len(hashes) == 1:
+        return hashes[0]
+    level = [h.decode('hex') for h in hashes]
+    size = 2
+    while size < len(level):
+        size *= 2
+    level += ['\x00' * len(level[0])] * (size - len(level))
+    while len(level) > 1:
+        level = [hashlib.new(block_hash, level[i] + level[i + 1]).digest()
+                 for i in range(0, len(level), 2)]
+    return level[0].encode('hex')
+
+
+class BlockHasher(object):
+    """Compute the Pithos hashmap of data fed in consecutive chunks."""
+
+    def __init__(self, block_size, block_hash):
+        self.block_size = block_size
+        self.block_hash = block_hash
+        self.hashes = []
+        self.size = 0
+        self.pending = []
+        self.pending_size = 0
+
+    def update(self, data):
+        self.size += len(data)
+        while data:
+            part = data[:self.block_size - self.pending_size]
+            data = data[len(part):]
+            self.pending.append(part)
+            self.pending_size += len(part)
+            if self.pending_size == self.block_size:
+                self._flush()
+
+    def _flush(self):
+        block = ''.join(self.pending)
+        self.hashes.append(pithos_hash(block, self.block_hash))
+        self.pending = []
+        self.pending_size = 0
+
+    def hashmap(self):
+        if self.pending_size:
+            self._flush()
+        return {"block_size": self.block_size,
+                "block_hash": self.block_hash,
+                "bytes": self.size,
+                "hashes": list(self.hashes),
+                "hash": pithos_top_hash(self.hashes, self.block_hash)}
+
+
+HASH_READ_SIZE = 1024 * 1024
+
+
+def hash_file(path, block_size, block_hash):
+    hasher = BlockHasher(block_size, block_hash)
+    with open(path, "rb") as f:
+        while True:
+            buf = f.read(HASH_READ_SIZE)
+            if not buf:
+                break
+            hasher.update(buf)
+    return hasher.hashmap()
+
+
 def time_stamp():
     return datetime.datetime.now()
 
@@ -141,28 +224,111 @@ def patch_user_agent(client_class):
 BaseStoppableThread = watchdog.utils.BaseThread
 
 
+def socketpair():
+    if hasattr(socket, "socketpair"):
+        return socket.socketpair()
+    # Windows
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        writer = socket.create_connection(listener.getsockname())
+        reader, _ = listener.accept()
+    finally:
+        listener.close()
+    return reader, writer
+
+
+class Waker(object):
+    """A flag that a thread can wait on, sleeping in the kernel.
+
+    On Python 2, threading.Event.wait with a timeout polls the flag in
+    sleeps of up to 50ms. Here waiting is a select on a socket pair,
+    which also works on Windows, unlike a pipe.
+    """
+
+    def __init__(self):
+        self._reader, self._writer = socketpair()
+        self._reader.setblocking(False)
+        self._writer.setblocking(False)
+        self.closed = False
+
+    def set(self):
+        try:
+            self._writer.send(b"x")
+        except socket.error as e:
+            # a full buffer means the flag is already set
+            if e.errno not in [errno.EAGAIN, errno.EWOULDBLOCK] and \
+                    not self.closed:
+                raise
+
+    def clear(self):
+        while True:
+            try:
+                if not self._reader.recv(4096):
+                    return
+            except socket.error as e:
+                if e.errno in [errno.EAGAIN, errno.EWOULDBLOCK] or \
+                        self.closed:
+                    return
+                raise
+
+    def wait(self, timeout=None):
+        """Return whether the flag is set, waiting up to timeout seconds.
+        An interrupted wait returns False early."""
+        try:
+            ready, _, _ = select.select([self._reader], [], [], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return False
+            raise
+        return bool(ready)
+
+    def fileno(self):
+        return self._reader.fileno()
+
+    def close(self):
+        self.closed = True
+        self._reader.close()
+        self._writer.close()
+
+
 class StoppableThread(BaseStoppableThread):
     period = 0
-    step = 0
+    coalesce = 0
 
     def run_body(self, period):
         raise NotImplementedError()
 
     def run(self):
-        remaining = 0
-        while True:
-            if not self.should_keep_running():
-                return
-            if remaining <= 0:
-                remaining = self.period
+        try:
+            while self.should_keep_running():
+                # wakeups that come while running are kept for the next wait
+                self.wakeup.clear()
                 self.run_body()
-            time.sleep(self.step)
-            remaining -= self.step
-
-    def __init__(self, period, target=None, step=0.1):
+                woken = self.wakeup.wait(self.period)
+                if woken and self.coalesce and self.should_keep_running():
+                    # let further wakeups pile up before running again
+                    self.stop_wakeup.wait(self.coalesce)
+        finally:
+            self.wakeup.close()
+            self.stop_wakeup.close()
+
+    def wake(self):
+        if not self.wakeup.closed:
+            self.wakeup.set()
+
+    def on_thread_stop(self):
+        self.wake()
+        if not self.stop_wakeup.closed:
+            self.stop_wakeup.set()
+
+    def __init__(self, period, target=None, coalesce=0):
         BaseStoppableThread.__init__(self)
         self.period = period
-        self.step = step
+        self.coalesce = coalesce
+        self.wakeup = Waker()
+        self.stop_wakeup = Waker()
         if target:
             self.run_body = target
 
@@ -183,6 +349,39 @@ def wait_joins(threads, timeout=None):
     return _remaining(timeout, total_elapsed)
 
 
+class UnsortedError(ValueError):
+    pass
+
+
+def _check_sorted(iterable):
+    previous = None
+    for item in iterable:
+        if previous is not None and item <= previous:
+            raise UnsortedError("'%s' follows '%s'" % (item, previous))
+        previous = item
+        yield item
+
+
+def sorted_difference(left, right):
+    """Yield the items of left that do not appear in right.
+
+    Both iterables must be strictly increasing; this is verified on the
+    fly and UnsortedError is raised otherwise. The right iterable is
+    always consumed to the end.
+    """
+    left = _check_sorted(left)
+    right = _check_sorted(right)
+    sentinel = object()
+    r = next(right, sentinel)
+    for l in left:
+        while r is not sentinel and r < l:
+            r = next(right, sentinel)
+        if r is sentinel or l != r:
+            yield l
+    for r in right:
+        pass
+
+
 class ThreadSafeDict(object):
     def __init__(self, *args, **kwargs):
         self._DICT = {}
@@ -199,3 +398,231 @@ class ThreadSafeDict(object):
                 if value is not None:
                     return False  # re-raise
         return Lock()
+
+
+class WorkerJob(object):
+    """A unit of work for a WorkerPool; can be watched like a thread.
+
+    An exception raised by the target is kept in error once the job is
+    done, and is logged by the worker that ran it.
+    """
+
+    def __init__(self, target, args=()):
+        self.target = target
+        self.args = args
+        self.error = None
+        self.done = threading.Event()
+
+    def run(self):
+        try:
+            self.target(*self.args)
+        except Exception as e:
+            self.error = e
+            raise
+        finally:
+            self.done.set()
+
+    def is_alive(self):
+        return not self.done.is_set()
+
+    def join(self, timeout=None):
+        self.done.wait(timeout)
+
+
+class WorkerPool(object):
+    """A bounded set of daemon threads that run submitted WorkerJobs.
+
+    Workers are started on demand, up to size, and exit after staying
+    idle for idle_timeout seconds.
+    """
+
+    def __init__(self, size, idle_timeout=10):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.queue = Queue.Queue()
+        self.workers = set()
+        self.cond = threading.Condition()
+        self.in_flight = 0
+
+    def submit(self, job):
+        with self.cond:
+            self.in_flight += 1
+            self.queue.put(job)
+            if len(self.workers) < min(self.size, self.in_flight):
+                worker = threading.Thread(target=self._work)
+                worker.daemon = True
+                self.workers.add(worker)
+                worker.start()
+        return job
+
+    def _work(self):
+        while True:
+            try:
+                job = self.queue.get(timeout=self.idle_timeout)
+            except Queue.Empty:
+                with self.cond:
+                    if self.queue.empty():
+                        self.workers.discard(threading.current_thread())
+                        return
+                continue
+            try:
+                job.run()
+            except Exception:
+                logger.exception("Worker job %s failed" % job.target)
+            finally:
+                with self.cond:
+                    self.in_flight -= 1
+                    self.cond.notify_all()
+
+    def wait(self, timeout=None):
+        total_elapsed = 0
+        with self.cond:
+            while self.in_flight > 0:
+                remaining = _remaining(timeout, total_elapsed)
+                if remaining == 0:
+                    break
+                tbefore = datetime.datetime.now()
+                self.cond.wait(remaining)
+                tafter = datetime.datetime.now()
+                total_elapsed += (tafter - tbefore).total_seconds()
+        return _remaining(timeout, total_elapsed)
+
+
+class Metrics(object):
+    """Thread-safe named counters describing the syncer's work."""
+
+    def __init__(self):
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def get(self, name):
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counters)
+
+
+COPY_REFLINK = "reflink"
+COPY_FILE_RANGE = "copy_file_range"
+COPY_SENDFILE = "sendfile"
+COPY_USERSPACE = "userspace"
+# in order of preference
+COPY_METHODS = [COPY_REFLINK, COPY_FILE_RANGE, COPY_SENDFILE, COPY_USERSPACE]
+
+FICLONE = 0x40049409
+KERNEL_COPY_CHUNK = 0x40000000
+COPY_UNSUPPORTED_ERRNOS = [
+    errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP,
+    errno.ENOTTY, errno.EBADF]
+
+
+class CopyMethodUnsupported(Exception):
+    pass
+
+
+_libc = []
+
+
+def get_libc():
+    if not _libc:
+        _libc.append(ctypes.CDLL(ctypes.util.find_library("c"),
+                                 use_errno=True))
+    return _libc[0]
+
+
+def _reflink(fsrc, fdest):
+    import fcntl
+    fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+
+
+def _kernel_copy(call, fsrc, fdest):
+    while True:
+        copied = call(fsrc.fileno(), fdest.fileno())
+        if copied < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        if copied == 0:
+            return
+
+
+def _copy_file_range(fsrc, fdest):
+    func = get_libc().copy_file_range
+    func.restype = ctypes.c_ssize_t
+    func.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                     ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+    _kernel_copy(lambda src, dest: func(src, None, dest, None,
+                                        KERNEL_COPY_CHUNK, 0),
+                 fsrc, fdest)
+
+
+def _sendfile(fsrc, fdest):
+    func = get_libc().sendfile
+    func.restype = ctypes.c_ssize_t
+    func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                     ctypes.c_size_t]
+    _kernel_copy(lambda src, dest: func(dest, src, None, KERNEL_COPY_CHUNK),
+                 fsrc, fdest)
+
+
+KERNEL_COPIERS = {
+    COPY_REFLINK: _reflink,
+    COPY_FILE_RANGE: _copy_file_range,
+    COPY_SENDFILE: _sendfile,
+}
+
+
+def copy_file_data(src, dest, method):
+    """Copy the contents of src to dest without going through userspace.
+
+    Raise CopyMethodUnsupported if the method cannot copy between these
+    files; dest is then left truncated.
+    """
+    if not islinux() or method not in KERNEL_COPIERS:
+        raise CopyMethodUnsupported(method)
+    with open(src, "rb") as fsrc:
+        with open(dest, "wb") as fdest:
+            try:
+                KERNEL_COPIERS[method](fsrc, fdest)
+            except AttributeError:
+                raise CopyMethodUnsupported(method)
+            except (OSError, IOError) as e:
+                if e.errno in COPY_UNSUPPORTED_ERRNOS:
+                    fdest.truncate(0)
+                    raise CopyMethodUnsupported(method)
+                raise
+
+
+def probe_copy_method(dirpath):
+    """Return the cheapest method that copies files within dirpath."""
+    src = os.path.join(dirpath, ".copy_probe_src")
+    dest = os.path.join(dirpath, ".copy_probe_dest")
+    data = "agkyra copy probe\n" * 1024
+    try:
+        with open(src, "wb") as f:
+            f.write(data)
+        for method in COPY_METHODS:
+            if method == COPY_USERSPACE:
+                break
+            try:
+                copy_file_data(src, dest, method)
+            except CopyMethodUnsupported:
+                continue
+            with open(dest, "rb") as f:
+                if f.read() == data:
+                    return method
+    except (OSError, IOError) as e:
+        logger.warning("Failed to probe copy methods in '%s': %s" %
+                       (dirpath, e))
+    finally:
+        for path in [src, dest]:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+    return COPY_USERSPACE
@@ -37,6 +37,7 @@ CLASSIFIERS = []
 # Package requirements
 INSTALL_REQUIRES = [
     'kamaki>=0.13.5',
+    'objpool>=0.2',
     'watchdog',
     'psutil',
     'ws4py',